@@ -0,0 +1,167 @@
+# Import Python Packages.
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import platform
+import argparse
+import tempfile
+import subprocess
+import multiprocessing
+
+# Command line options.
+parser = argparse.ArgumentParser(description='Time gmos-spike.py on '
+                                 'synthetic data sets made by gmos-synth.py.')
+parser.add_argument('--binning', nargs='+', default=['2x2', '1x1'],
+                    help='CCD binnings of the data sets (default: 2x2 1x1).')
+parser.add_argument('--rows', nargs='+', type=int, default=[4176],
+                    help='Unbinned detector rows of the data sets '
+                    '(default: 4176).')
+parser.add_argument('--flats', nargs='+', type=int, default=[3],
+                    help='Number of FLAT files of the data sets (default: 3).')
+parser.add_argument('--jobs', nargs='+', type=int, default=[1],
+                    help='Values of the --jobs option of gmos-spike.py '
+                    '(default: 1).')
+parser.add_argument('--repeat', type=int, default=1,
+                    help='Number of runs of each benchmark (default: 1).')
+parser.add_argument('--data', default='bench-data',
+                    help='Directory of the data sets, which are made once '
+                    'and reused (default: bench-data).')
+parser.add_argument('--results', default='bench-results.json',
+                    help='File the results are added to (default: '
+                    'bench-results.json).')
+parser.add_argument('--keep', action='store_true',
+                    help='Keep the working directories of the runs.')
+options = parser.parse_args()
+
+script_path = os.path.dirname(os.path.abspath(__file__))
+
+def git_version():
+    """ Commit of the pipeline and whether it has uncommitted changes.
+        Outside a git repository the version is the digest of the script. """
+
+    devnull = open(os.devnull, 'w')
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                         cwd=script_path, stderr=devnull).decode('ascii').strip()
+        changes = subprocess.check_output(['git', 'status', '--porcelain', '.'],
+                                          cwd=script_path, stderr=devnull).decode('ascii').strip()
+        devnull.close()
+        return commit, changes != ''
+    except (OSError, subprocess.CalledProcessError):
+        devnull.close()
+        f = open(os.path.join(script_path, 'gmos-spike.py'), 'rb')
+        digest = hashlib.sha1(f.read()).hexdigest()[:10]
+        f.close()
+        return digest, False
+
+def data_set(binning, rows, flats):
+    """ Directory of a synthetic data set, made if it does not exist. """
+
+    path = os.path.join(options.data, 'bin{}-rows{}-flats{}'.format(binning, rows, flats))
+    if not os.path.exists(os.path.join(path, 'manifest.json')):
+        subprocess.check_call([sys.executable, os.path.join(script_path, 'gmos-synth.py'),
+                               path, '--binning', binning, '--rows', str(rows),
+                               '--flats', str(flats)])
+    return path
+
+def run_pipeline(path, jobs):
+    """ Reduce a data set in a new working directory and return the run
+        time of the pipeline and of each stage. """
+
+    work = tempfile.mkdtemp(prefix='run-', dir=path)
+    # IRAF reads the raw files from the 'raw' directory of the working
+    # directory.
+    os.symlink(os.path.abspath(os.path.join(path, 'raw')), os.path.join(work, 'raw'))
+
+    start = time.time()
+    log = open(os.path.join(work, 'gmos-spike.log'), 'w')
+    status = subprocess.call([sys.executable, os.path.join(script_path, 'gmos-spike.py'),
+                              '--manifest', os.path.abspath(os.path.join(path, 'manifest.json')),
+                              '--no-cache', '--jobs', str(jobs)],
+                             cwd=work, stdout=log, stderr=subprocess.STDOUT)
+    log.close()
+    wall = time.time() - start
+
+    stages = []
+    if os.path.exists(os.path.join(work, 'trace.json')):
+        f = open(os.path.join(work, 'trace.json'), 'r')
+        stages = json.load(f)
+        f.close()
+
+    if status != 0:
+        print('The run failed, see {}'.format(os.path.join(work, 'gmos-spike.log')))
+    elif not options.keep:
+        shutil.rmtree(work)
+
+    return {'status':status, 'wall':wall, 'stages':stages}
+
+commit, changed = git_version()
+results = []
+if os.path.exists(options.results):
+    f = open(options.results, 'r')
+    results = json.load(f)
+    f.close()
+
+runs = []
+for binning in options.binning:
+    for rows in options.rows:
+        for flats in options.flats:
+            path = data_set(binning, rows, flats)
+            for jobs in options.jobs:
+                for n in range(options.repeat):
+                    print('# BINNING {} ROWS {} FLATS {} JOBS {} RUN {} #'.format(
+                            binning, rows, flats, jobs, n + 1))
+                    run = run_pipeline(path, jobs)
+                    run.update({'commit':commit, 'changed':changed,
+                                'date':time.strftime('%Y-%m-%dT%H:%M:%S'),
+                                'host':platform.node(),
+                                'cpus':multiprocessing.cpu_count(),
+                                'config':{'binning':binning, 'rows':rows,
+                                          'flats':flats, 'jobs':jobs}})
+                    runs.append(run)
+                    results.append(run)
+
+                    # Keep the results of the finished runs.
+                    f = open(options.results, 'w')
+                    json.dump(results, f, indent=1, sort_keys=True)
+                    f.close()
+
+def previous_run(run):
+    """ Latest successful run of the same benchmark at another commit. """
+
+    for other in reversed(results):
+        if (other['config'] == run['config'] and other['commit'] != run['commit']
+                and other['status'] == 0):
+            return other
+    return None
+
+# Print the run times, compared to the last run at another commit.
+print('')
+print('{:<10} {:>6} {:>6} {:>5} {:>10} {:>10} {:>9}'.format(
+        'BINNING', 'ROWS', 'FLATS', 'JOBS', 'WALL[s]', 'BEFORE[s]', 'RATIO'))
+for run in runs:
+    config = run['config']
+    before = previous_run(run)
+    line = '{:<10} {:>6} {:>6} {:>5} {:>10.1f}'.format(config['binning'], config['rows'],
+                                                      config['flats'], config['jobs'],
+                                                      run['wall'])
+    if run['status'] != 0:
+        line += '   (failed)'
+    elif before is not None:
+        line += ' {:>10.1f} {:>9.2f}   ({})'.format(before['wall'], run['wall']/before['wall'],
+                                                   before['commit'])
+    print(line)
+
+    # Stages that changed by more than 10 percent.
+    if run['status'] == 0 and before is not None:
+        times = dict((stage['stage'], stage['wall']) for stage in before['stages'])
+        for stage in run['stages']:
+            if stage['stage'] in times and times[stage['stage']] > 0:
+                ratio = stage['wall']/times[stage['stage']]
+                if abs(ratio - 1.0) > 0.1:
+                    print('    {:<24} {:>8.1f} {:>10.1f} {:>9.2f}'.format(
+                            stage['stage'], stage['wall'], times[stage['stage']], ratio))
+print('')
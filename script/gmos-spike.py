@@ -1,16 +1,571 @@
 # Import Python Packages.
 import numpy as np
-from pyraf import iraf
+from pyraf import iraf, iraftask
 from pyraf.iraf import gemini, gemtools, gmos, onedspec
 import os
+import time
+import resource
+import csv
+import functools
+import glob
+import gzip
+import bz2
+import shutil
+import hashlib
+import inspect
+import sqlite3
+import multiprocessing
+import multiprocessing.pool
 from astropy.io import fits
 import matplotlib.pyplot as plt
 import matplotlib.gridspec as gridspec
 from matplotlib.ticker import (MultipleLocator, FormatStrFormatter,
                                AutoMinorLocator)
+import sys
+import json
+import collections
+import contextlib
+import fcntl
+import argparse
+try:
+    import yaml
+except ImportError:
+    yaml = None
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+# Command line options.
+parser = argparse.ArgumentParser(description='GMOS Spectral reduction '
+                                 'Pipeline for Kilonova Events.')
+mode = parser.add_mutually_exclusive_group()
+mode.add_argument('--manifest', help='JSON or YAML file with the answers '
+                  'to the questions of the reduction. The pipeline runs '
+                  'without prompts (batch mode).')
+mode.add_argument('--replay', help='Decision log of a previous run. Its '
+                  'answers are given again and only the questions left '
+                  'without an answer are asked.')
+parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE',
+                    help='Answer that replaces the one of the manifest or of '
+                    'the decision log. VALUE is read as JSON when possible, '
+                    'e.g. --set obj.badcolumn.xmin=[1020,2050].')
+parser.add_argument('--jobs', type=int, default=1,
+                    help='Number of reduction stages run at the same time. '
+                    'With more than one job, the standard star and the '
+                    'science object are reduced in parallel (default: 1).')
+parser.add_argument('--no-cache', dest='cache', action='store_false',
+                    help='Run every stage, even when its products are in '
+                    'the stage cache.')
+parser.add_argument('--trace', default='trace',
+                    help='Write the run time, memory and I/O of each stage '
+                    'to TRACE.json and TRACE.csv.')
+parser.add_argument('--headless', action='store_true',
+                    help='Do not show the figures. They are only saved, '
+                    'in background processes (always the case in batch '
+                    'mode).')
+parser.add_argument('--record', default='decisions.json',
+                    help='File where the answers of this run are written '
+                    '(default: decisions.json).')
+options = parser.parse_args()
+
+def load_answers(path):
+    """ Load a JSON or YAML file of answers. Nested sections are joined
+        with dots, e.g. {'std': {'centwave': 520}} gives 'std.centwave'. """
+
+    f = open(path, 'r')
+    if path.endswith(('.yaml', '.yml')):
+        if yaml is None:
+            sys.exit('PyYAML is needed to read {}'.format(path))
+        content = yaml.safe_load(f)
+    else:
+        content = json.load(f)
+    f.close()
+
+    answers = {}
+    def flatten(section, prefix):
+        for key, value in section.items():
+            if isinstance(value, dict):
+                flatten(value, '{}{}.'.format(prefix, key))
+            else:
+                answers['{}{}'.format(prefix, key)] = value
+    flatten(content, '')
+
+    return answers
+
+# Answers given in the manifest or in the replayed decision log, and the
+# number of times each question has been answered.
+answers = None
+answered = {}
+# Batch mode: no prompts at all.
+batch = options.manifest is not None
+if batch:
+    answers = load_answers(options.manifest)
+# Headless mode: no figure windows, the figures are saved in background
+# processes while the reduction goes on.
+headless = batch or options.headless
+if headless:
+    plt.switch_backend('Agg')
+if options.replay:
+    answers = load_answers(options.replay)
+# Answers replaced from the command line.
+for option in options.set:
+    if answers is None:
+        answers = {}
+    key, value = option.split('=', 1)
+    try:
+        answers[key] = json.loads(value)
+    except ValueError:
+        answers[key] = value
+
+# Answers given in this run, written to the decision log after each answer.
+decisions = {}
+
+def record_decision(key, value):
+    """ Add an answer to the decision log. The log has the format of a
+        manifest and can be given back with '--replay'. """
+
+    decisions.setdefault(key, []).append(value)
+    content = {}
+    for name, values in decisions.items():
+        if len(values) == 1:
+            content[name] = values[0]
+        else:
+            content[name] = values
+    f = open(options.record, 'w')
+    json.dump(content, f, indent=2, sort_keys=True)
+    f.close()
+
+def has_answer(key):
+    """ Check if the manifest still holds an answer for a question. """
+
+    if answers is None or key not in answers:
+        return False
+    if isinstance(answers[key], list):
+        return answered.get(key, 0) < len(answers[key])
+    return answered.get(key, 0) == 0
+
+def ask(key, question, default=None):
+    """ Ask a question of the reduction. The answer is taken from the
+        manifest or the replayed decision log when they hold one: a single
+        value answers the question once, a list answers it successive
+        times. Otherwise the question is asked, or in batch mode takes its
+        default answer. Every answer is written to the decision log. """
+
+    if has_answer(key):
+        value = answers[key]
+        if isinstance(value, list):
+            value = value[answered.get(key, 0)]
+        answered[key] = answered.get(key, 0) + 1
+        # YAML reads unquoted yes/no as booleans.
+        if value is True:
+            value = 'y'
+        if value is False:
+            value = 'n'
+        value = str(value)
+        print('{}{}'.format(question, value))
+    elif batch and default is not None:
+        value = str(default)
+        print('{}{}'.format(question, value))
+    elif batch:
+        sys.exit("There is no answer for '{}' in {}".format(key, options.manifest))
+    else:
+        value = raw_input(question)
+
+    record_decision(key, value)
+
+    return value
 
 # Directory path for the uncalibrated files.
 raw_path = '/raw/'
+if answers is not None and 'raw_path' in answers:
+    raw_path = answers['raw_path']
+# Raw files can also be gzip or bzip2 compressed, or fpack compressed.
+# Their headers are read without unpacking them and only the selected files
+# are unpacked into 'raw_path'.
+raw_compression = ['.gz', '.bz2', '.fz']
+# Number of processes reading the raw file headers.
+scan_processes = multiprocessing.cpu_count()
+
+# Catalog of the raw file headers, kept in the working directory between
+# runs. Only new raw files, or files whose size or modification time
+# changed, are read again.
+catalog_path = 'raw_catalog.db'
+# Version of the catalog table. The catalog is rebuilt when it changes.
+catalog_version = 3
+
+# Header keywords stored in the catalog for the file selection.
+# Keys are the names used by the selection queries, values are the FITS
+# keywords, searched first in the second extension and then in the
+# primary header (as 'hselect' does with '[2,inherit=yes]').
+index_keywords = {'ObsType':'OBSTYPE', 'obsclass':'OBSCLASS',
+                  'CentWave':'CENTWAVE', 'GrWlen':'GRWLEN',
+                  'Ccdsum':'CCDSUM', 'title':'OBJECT',
+                  'DATE-OBS':'DATE-OBS', 'Detector':'DETECTOR',
+                  'ROI':'DETSEC', 'Grating':'GRATING', 'Mask':'MASKNAME'}
+# Keywords compared as numbers.
+numeric_keywords = ['CentWave', 'GrWlen']
+
+def open_raw_file(path):
+    """ Open a raw file, decompressing it on the fly if it is gzip or
+        bzip2 compressed. """
+
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    if path.endswith('.bz2'):
+        return bz2.BZ2File(path, 'rb')
+    return open(path, 'rb')
+
+def read_fits_header(f):
+    """ Read the next header of a FITS file and move to the start of the
+        following HDU. """
+
+    cards = []
+    while True:
+        block = f.read(2880)
+        if len(block) < 2880:
+            raise IOError('Unexpected end of FITS file')
+        block = block.decode('ascii')
+        cards.append(block)
+        if any(block[i:i+80].rstrip() == 'END' for i in range(0, 2880, 80)):
+            break
+    header = fits.Header.fromstring(''.join(cards))
+
+    # Skip the data of the HDU.
+    naxis = header.get('NAXIS', 0)
+    if naxis > 0:
+        size = 1
+        for n in range(1, naxis+1):
+            size = size*header['NAXIS{}'.format(n)]
+        size = abs(header['BITPIX'])//8*header.get('GCOUNT', 1)*(header.get('PCOUNT', 0) + size)
+        f.seek(((size + 2879)//2880)*2880, 1)
+
+    return header
+
+def raw_file_name(path):
+    """ Name of the unpacked raw file. """
+
+    name = os.path.basename(path)
+    for suffix in raw_compression:
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+def list_raw_files(path):
+    """ List the raw files of a directory. Compressed files are skipped
+        when they have already been unpacked. """
+
+    filenames = glob.glob('{}*.fits'.format(path))
+    unpacked = set(os.path.basename(filename) for filename in filenames)
+    for suffix in raw_compression:
+        for filename in glob.glob('{}*.fits{}'.format(path, suffix)):
+            if raw_file_name(filename) not in unpacked:
+                filenames.append(filename)
+                unpacked.add(raw_file_name(filename))
+
+    return sorted(filenames)
+
+def read_frame_header(path):
+    """ Read the selection keywords of a raw file from its primary header
+        and its second extension. Compressed files are only decompressed
+        up to the end of the second extension header. """
+
+    f = open_raw_file(path)
+    phu_header = read_fits_header(f)
+    read_fits_header(f)
+    ext_header = read_fits_header(f)
+    f.close()
+
+    frame = {'name':raw_file_name(path), 'path':path}
+    for key, keyword in index_keywords.items():
+        value = ext_header.get(keyword, phu_header.get(keyword))
+        if key in numeric_keywords:
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                value = None
+        elif value is not None:
+            value = str(value).strip()
+        frame[key] = value
+
+    return frame
+
+def unpack_raw_file(name):
+    """ Unpack a compressed raw file into 'raw_path' so the IRAF tasks
+        can read it. """
+
+    path = '{}{}'.format(raw_path, name)
+    if os.path.exists(path):
+        return
+
+    for frame in select_frames(name=name):
+        print('Unpacking {}'.format(frame['path']))
+        if frame['path'].endswith('.fz'):
+            # Write the tile-compressed extensions as plain images.
+            hdulist = fits.open(frame['path'])
+            unpacked = fits.HDUList([fits.PrimaryHDU(header=hdulist[0].header)])
+            for hdu in hdulist[1:]:
+                unpacked.append(fits.ImageHDU(data=hdu.data, header=hdu.header))
+            unpacked.writeto(path)
+            hdulist.close()
+        else:
+            f = open_raw_file(frame['path'])
+            out = open(path, 'wb')
+            shutil.copyfileobj(f, out)
+            out.close()
+            f.close()
+
+def open_catalog(path):
+    """ Open the raw file catalog. Create the table of frames and the
+        index used to match calibration files. """
+
+    catalog = sqlite3.connect(path)
+    catalog.row_factory = sqlite3.Row
+
+    # Rebuild catalogs written with another set of columns.
+    if catalog.execute('PRAGMA user_version').fetchone()[0] != catalog_version:
+        catalog.execute('DROP TABLE IF EXISTS frames')
+        catalog.execute('PRAGMA user_version = {}'.format(catalog_version))
+
+    columns = ['path TEXT PRIMARY KEY', 'name TEXT',
+               'mtime REAL', 'size INTEGER']
+    for key in sorted(index_keywords):
+        if key in numeric_keywords:
+            columns.append('"{}" REAL'.format(key))
+        else:
+            columns.append('"{}" TEXT'.format(key))
+    catalog.execute('CREATE TABLE IF NOT EXISTS frames ({})'.format(', '.join(columns)))
+    catalog.execute('CREATE INDEX IF NOT EXISTS frames_calib ON frames '
+                    '(ObsType, Ccdsum, CentWave)')
+    catalog.commit()
+
+    return catalog
+
+def update_catalog(catalog, path):
+    """ Read the headers of the raw files that are not in the catalog or
+        whose size or modification time changed. Remove from the catalog
+        the files that are no longer in the directory. """
+
+    known = {}
+    for row in catalog.execute('SELECT path, mtime, size FROM frames'):
+        known[row['path']] = (row['mtime'], row['size'])
+
+    filenames = list_raw_files(path)
+    changed = []
+    for filename in filenames:
+        stat = os.stat(filename)
+        if known.get(filename) != (stat.st_mtime, stat.st_size):
+            changed.append((filename, stat))
+
+    keys = ['path', 'name', 'mtime', 'size'] + sorted(index_keywords)
+    insert = 'INSERT OR REPLACE INTO frames ({}) VALUES ({})'.format(
+                ', '.join('"{}"'.format(key) for key in keys),
+                ', '.join('?' for key in keys))
+    # Read the headers in parallel.
+    if len(changed) > 1 and scan_processes > 1:
+        pool = multiprocessing.Pool(min(scan_processes, len(changed)))
+        frames = pool.map(read_frame_header, [filename for filename, stat in changed])
+        pool.close()
+        pool.join()
+    else:
+        frames = [read_frame_header(filename) for filename, stat in changed]
+
+    for frame, (filename, stat) in zip(frames, changed):
+        frame['mtime'] = stat.st_mtime
+        frame['size'] = stat.st_size
+        catalog.execute(insert, [frame[key] for key in keys])
+
+    removed = set(known) - set(filenames)
+    for filename in removed:
+        catalog.execute('DELETE FROM frames WHERE path = ?', (filename,))
+    catalog.commit()
+
+    print('Raw file catalog: {} file(s), {} read, {} removed.'.format(
+            len(filenames), len(changed), len(removed)))
+
+def select_frames(**criteria):
+    """ Select the raw files matching all the given keyword values.
+        'obsclass' matches as a substring, like the '?=' operator of
+        'hselect'. Numerical keywords are compared as numbers. """
+
+    conditions = []
+    values = []
+    for key, value in sorted(criteria.items()):
+        if key == 'obsclass':
+            conditions.append('instr("{}", ?) > 0'.format(key))
+            values.append(str(value))
+        elif key in numeric_keywords:
+            conditions.append('"{}" = ?'.format(key))
+            values.append(float(value))
+        else:
+            conditions.append('"{}" = ?'.format(key))
+            values.append(str(value).strip())
+
+    query = 'SELECT * FROM frames'
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    query += ' ORDER BY path'
+
+    selected=[]
+    for row in raw_catalog.execute(query, values):
+        selected.append(dict(zip(row.keys(), row)))
+
+    return selected
+
+# Library of master calibrations. Master bias and flat frames are kept
+# here with the settings and the raw files they were made from, and reused
+# by any later reduction with the same settings and files. Point it to a
+# shared directory to reuse the masters across nights and targets.
+library_path = 'calib_library/'
+if answers is not None and 'library_path' in answers:
+    library_path = answers['library_path']
+# Settings a master calibration must share with the reduced frames. The
+# detector section of the second extension identifies the region of
+# interest that was read out.
+library_keywords = ['Ccdsum', 'CentWave', 'Detector', 'ROI']
+
+def open_library():
+    """ Open the index of the calibration library. """
+
+    if not os.path.exists(library_path):
+        os.makedirs(library_path)
+    # Stages running in parallel can write to the library at once.
+    library = sqlite3.connect(library_path + 'library.db', timeout=60)
+    library.row_factory = sqlite3.Row
+    columns = ['kind TEXT', 'inputs TEXT', 'file TEXT']
+    for key in library_keywords:
+        if key in numeric_keywords:
+            columns.append('"{}" REAL'.format(key))
+        else:
+            columns.append('"{}" TEXT'.format(key))
+    columns.append('PRIMARY KEY (kind, inputs, {})'.format(
+                    ', '.join('"{}"'.format(key) for key in library_keywords)))
+    library.execute('CREATE TABLE IF NOT EXISTS masters ({})'.format(', '.join(columns)))
+    library.commit()
+
+    return library
+
+def master_key(kind, names, sources=(), method=None):
+    """ Library key of a master calibration made from the raw files
+        'names'. 'sources' are the other raw files used to make it, as
+        the bias frames of a master flat. 'method' names how it was made,
+        as 'native' for the masters made by the pipeline instead of an
+        IRAF task, so masters made both ways do not replace each other.
+        Returns None when the raw files do not share the same settings. """
+
+    frames = []
+    for name in names:
+        frames.extend(select_frames(name=name)[:1])
+    if not frames or len(frames) != len(names):
+        return None
+
+    if method is not None:
+        kind = '{}_{}'.format(kind, method)
+    key = {'kind':kind, 'inputs':json.dumps(sorted(names) + sorted(sources))}
+    for keyword in library_keywords:
+        values = set(frame[keyword] for frame in frames)
+        if len(values) != 1:
+            return None
+        key[keyword] = values.pop()
+
+    return key
+
+def find_master(key):
+    """ Path of the master calibration of the library matching 'key',
+        or None if there is none. """
+
+    if key is None:
+        return None
+
+    library = open_library()
+    conditions = ' AND '.join('"{}" IS ?'.format(name) for name in sorted(key))
+    row = library.execute('SELECT file FROM masters WHERE ' + conditions,
+                          [key[name] for name in sorted(key)]).fetchone()
+    library.close()
+    if row is None or not os.path.exists(library_path + row['file']):
+        return None
+
+    return library_path + row['file']
+
+def fetch_master(key, filename):
+    """ Copy the master calibration matching 'key' from the library to
+        'filename'. Returns False if the library has no such master. """
+
+    path = find_master(key)
+    if path is None:
+        return False
+
+    print('Using {} from the calibration library.'.format(path))
+    shutil.copy(path, filename)
+
+    return True
+
+def master_name(key, filename):
+    """ Name in the library of the master calibration 'filename' matching
+        'key'. """
+
+    digest = hashlib.sha1(json.dumps(key, sort_keys=True).encode('utf-8'))
+    return '{}-{}{}'.format(key['kind'], digest.hexdigest(), os.path.splitext(filename)[1])
+
+def index_master(library, key, name):
+    """ Record the library file 'name' as the master calibration matching
+        'key'. """
+
+    keys = sorted(key) + ['file']
+    library.execute('INSERT OR REPLACE INTO masters ({}) VALUES ({})'.format(
+                    ', '.join('"{}"'.format(name) for name in keys),
+                    ', '.join('?' for name in keys)),
+                    [key[name] for name in sorted(key)] + [name])
+
+def store_master(key, filename):
+    """ Add the master calibration 'filename' to the library. """
+
+    if key is None:
+        return
+
+    name = master_name(key, filename)
+    library = open_library()
+    # The file is copied under a temporary name and renamed, so the
+    # stages reading the library never see it half written.
+    temporary = '{}.{}'.format(library_path + name, os.getpid())
+    shutil.copy(filename, temporary)
+    os.rename(temporary, library_path + name)
+    index_master(library, key, name)
+    library.commit()
+    library.close()
+
+@contextlib.contextmanager
+def library_lock(key):
+    """ Hold the lock of the master calibration matching 'key' for a
+        block of code, so stages running in parallel with the same key
+        make the master only once and share it. """
+
+    if key is None:
+        yield
+        return
+
+    if not os.path.exists(library_path):
+        os.makedirs(library_path)
+    f = open(library_path + master_name(key, 'master.lock'), 'w')
+    fcntl.flock(f, fcntl.LOCK_EX)
+    try:
+        yield
+    finally:
+        f.close()
+
+# Bring the catalog up to date with the raw directory. All file selections
+# below are queries on this catalog.
+raw_catalog = open_catalog(catalog_path)
+update_catalog(raw_catalog, raw_path)
+
+def reopen_catalog():
+    """ Open the catalog again in a forked process, which must not use
+        the SQLite connection of its parent. """
+
+    global raw_catalog
+
+    raw_catalog = sqlite3.connect(catalog_path)
+    raw_catalog.row_factory = sqlite3.Row
 
 # Print the central wavelength and class for all files in the directory.
 # The Sciece Object file must match its wavelength coverage with BIAS,
@@ -20,8 +575,8 @@ print("The available values for central wavelength in this directory are: ")
 print('')
 print('ObsClass \ CentWave')
 print('')
-iraf.hselect("{}*.fits[2,inherit=yes]".format(raw_path), #IRAF task 'hselect'.
-            'obsclass && GrWlen', 'ObsType="OBJECT"')
+for frame in select_frames(ObsType='OBJECT'):
+    print('{}\t{}'.format(frame['obsclass'], frame['GrWlen']))
 print('')
 
 # Empty lists for saving the names of the selected files.
@@ -42,22 +597,21 @@ def selec_std():
     while True:
         try:
             # Ask for a central wavelength value.
-            wavelength = int(input("Type the central wavelength for the "
+            wavelength = int(ask('std.centwave', "Type the central wavelength for the "
                                    "STANDARD STAR: "))
-            # Parameters for the IRAF task 'hselect'.
-            select_std = ('ObsType="OBJECT" && obsclass?= "partnerCal" && '
-                         'CentWave = {}'.format(wavelength))
+            # Parameters for the file selection.
+            select_std = {'ObsType':'OBJECT', 'obsclass':'partnerCal',
+                          'CentWave':wavelength}
 
             print('')
             # Print the selected parameters.
-            print("Selecting " + select_std)
+            print("Selecting ObsType = OBJECT, obsclass = partnerCal, "
+                  "CentWave = {}".format(wavelength))
 
             # Confirm the existence of files with the selected parameters.
-            selected_files=[]
-            selected_files.append(iraf.hselect("{}*.fits[2,inherit=yes]".format(raw_path),
-                                    '$I', select_std, Stdout=1))
+            std_files = select_frames(**select_std)
 
-            if selected_files == [[]]:
+            if std_files == []:
                 print('')
                 print("There is no file matching the specified value.")
 
@@ -66,29 +620,18 @@ def selec_std():
                 # Print the number of STANDARD STAR files matching the specified
                 # values.
                 print("It has been found {} STANDARD STAR file(s) matching the "
-                                "specified values:".format(len(selected_files[0])))
+                                "specified values:".format(len(std_files)))
                 print('')
                 print(" Name \ CCDsum ")
                 print('')
 
-                std_title=[]
-                std_name=[]
-                std_ccdsum=[]
-                std_name.append(iraf.hselect("{}*.fits[2,inherit=yes]".format(raw_path),
-                                '$I', select_std, Stdout=1)) # File name.
-                std_ccdsum.append(iraf.hselect("{}*.fits[2,inherit=yes]".format(raw_path),
-                                 '$Ccdsum', select_std, Stdout=1)) # File CCD Binning.
-                std_title.append(iraf.hselect("{}*.fits[2,inherit=yes]".format(raw_path),
-                                '$title', select_std, Stdout=1)) # File title
-                for j in range(len(std_name[0])):
+                for frame in std_files:
                     # Print STANDARD STAR names, CCD binning and title.
-                    # Remove '[2,inherit=yes]' and 'raw_path' from their names.
-                    print(std_name[0][j].replace('[2,inherit=yes]','').replace(raw_path,''),
-                            std_ccdsum[0][j], std_title[0][j])
+                    print(frame['name'], frame['Ccdsum'], frame['title'])
 
                 break
 
-        except (NameError, SyntaxError,IndexError):
+        except (NameError, SyntaxError, IndexError, ValueError):
             print('')
             print("Check if you typed a correct central wavelength. ")
 
@@ -96,13 +639,13 @@ def selec_std():
     # and ask the user to continue. Give the user option for choosing another file.
     while True:
         try:
-            first_std_name=std_name[0][0].replace(raw_path,'').replace('[2,inherit=yes]','')
+            first_std_name=std_files[0]['name']
             print('')
             print("Selected STANDARD STAR file: {}".format(first_std_name))
             print('')
-            answer = raw_input("Continue? [y/n] ")
-            ccdsum_file = iraf.hselect("{}{}[2,inherit=yes]".format(raw_path,first_std_name),
-                                        'Ccdsum', select_std, Stdout=1)[0]
+            answer = ask('std.frame.continue', "Continue? [y/n] ",
+                         default='n' if has_answer('std.frame.name') else 'y')
+            ccdsum_file = std_files[0]['Ccdsum']
 
             if answer == 'y':
                 filename = first_std_name
@@ -110,9 +653,9 @@ def selec_std():
             if answer == 'n':
 
                 print('')
-                filename = raw_input("Type your selected file name: ")
-                ccdsum_file = iraf.hselect("{}{}[2,inherit=yes]".format(raw_path,filename),
-                                            'Ccdsum', select_std, Stdout=1)[0]
+                filename = ask('std.frame.name', "Type your selected file name: ")
+                ccdsum_file = [frame['Ccdsum'] for frame in std_files
+                                if frame['name'] == filename][0]
                 break
 
             else:
@@ -132,14 +675,12 @@ def selec_std():
     print("Selecting ARC, FLAT and BIAS...")
 
     # ARC
-    arc_file=[]
-    # Parameters for the IRAF task 'hselect'.
-    select_arc_std = ("ObsType='ARC' && Ccdsum = {} "
-                    "&& CentWave = {} ".format(ccdsum_file, wavelength))
-    arc_file.append(iraf.hselect("{}*.fits[2,inherit=yes]".format(raw_path),
-                                '$I', select_arc_std, Stdout=1))
-
-    if arc_file == [[]]:
+    # Parameters for the file selection.
+    select_arc_std = {'ObsType':'ARC', 'Ccdsum':ccdsum_file,
+                      'CentWave':wavelength}
+    arc_file = select_frames(**select_arc_std)
+
+    if arc_file == []:
         print('')
         print("There is no ARC file matching the specified values")
         print('')
@@ -148,26 +689,24 @@ def selec_std():
         print('')
         # Print the number of ARC files matching the specified values.
         print("It has been found {} ARC file(s) matching"
-                "the specified values:".format(len(arc_file[0])))
+                "the specified values:".format(len(arc_file)))
         print('')
-        arc_name=[]
-        arc_name.append(iraf.hselect("{}*.fits[2,inherit=yes]".format(raw_path),
-                                    '$I', select_arc_std, Stdout=1)) # File name.
-        for j in range(len(arc_name[0])):
-            # Print ARC names, CCD binning and title.
-            # Remove '[2,inherit=yes]' and the 'raw_path' from their names.
-            print(arc_name[0][j].replace('[2,inherit=yes]','').replace(raw_path,''))
+        arc_name = [frame['name'] for frame in arc_file] # File name.
+        for j in range(len(arc_name)):
+            # Print ARC names.
+            print(arc_name[j])
         print('')
 
     # Select a file matching the values for central wavelength and CCD binning,
     # and ask the user to continue. Give the user option to choose another file.
     while True:
         try:
-            first_arc_name=arc_name[0][0].replace(raw_path,'').replace('[2,inherit=yes]','')
+            first_arc_name=arc_name[0]
             print('')
             print("Selected ARC file: {}".format(first_arc_name))
             print('')
-            answer = raw_input("Continue? [y/n] ")
+            answer = ask('std.arc.continue', "Continue? [y/n] ",
+                         default='n' if has_answer('std.arc.name') else 'y')
 
             if answer == 'y':
                 filename = first_arc_name
@@ -175,7 +714,7 @@ def selec_std():
             if answer == 'n':
 
                 print('')
-                filename = raw_input("Type your selected file name: ")
+                filename = ask('std.arc.name', "Type your selected file name: ")
 
                 break
             else:
@@ -191,14 +730,12 @@ def selec_std():
     arc_std_name.append(filename)
 
     # FLAT
-    flat_file=[]
-    # Parameters for the IRAF task 'hselect'.
-    select_flat_std = ("ObsType='FLAT' && Ccdsum = {} && "
-                        "CentWave = {}".format(ccdsum_file, wavelength))
-    flat_file.append(iraf.hselect("{}*.fits[2,inherit=yes]".format(raw_path),
-                        '$I', select_flat_std, Stdout=1))
-
-    if flat_file == [[]]:
+    # Parameters for the file selection.
+    select_flat_std = {'ObsType':'FLAT', 'Ccdsum':ccdsum_file,
+                       'CentWave':wavelength}
+    flat_file = select_frames(**select_flat_std)
+
+    if flat_file == []:
         print('')
         print("There is no FLAT file matching the specified values")
         print('')
@@ -207,15 +744,12 @@ def selec_std():
         print('')
         # Print the number of FLAT files matching the specified values.
         print("It has been found {} FLAT file(s) matching "
-                "the specified values:".format(len(flat_file[0])))
+                "the specified values:".format(len(flat_file)))
         print('')
-        flat_name=[]
-        flat_name.append(iraf.hselect("{}*.fits[2,inherit=yes]".format(raw_path),
-                            '$I', select_flat_std, Stdout=1)) # File name.
-        for j in range(len(flat_name[0])):
-            # Print FLAT names, CCD binning and title.
-            # Remove '[2,inherit=yes]' and the 'raw_path' from their names.
-            print(flat_name[0][j].replace('[2,inherit=yes]','').replace(raw_path,''))
+        flat_name = [frame['name'] for frame in flat_file] # File name.
+        for j in range(len(flat_name)):
+            # Print FLAT names.
+            print(flat_name[j])
 
         print('')
     # Remove pre-existing FLAT list.
@@ -226,11 +760,12 @@ def selec_std():
     # and ask the user to continue. Give the user option to choose another file.
     while True:
         try:
-            first_flat_name=flat_name[0][0].replace(raw_path,'').replace('[2,inherit=yes]','')
+            first_flat_name=flat_name[0]
             print('')
             print("Selected FLAT file: {}".format(first_flat_name))
             print('')
-            answer = raw_input("Continue? [y/n] ")
+            answer = ask('std.flat.continue', "Continue? [y/n] ",
+                         default='n' if has_answer('std.flat.name') else 'y')
 
             if answer == 'y':
                 flat_std_list.append(first_flat_name)
@@ -238,7 +773,7 @@ def selec_std():
             if answer == 'n':
 
                 print('')
-                filename = raw_input("Type your selected file name: ")
+                filename = ask('std.flat.name', "Type your selected file name: ")
                 flat_std_list.append(filename)
 
                 break
@@ -254,11 +789,12 @@ def selec_std():
     while True:
         try:
             print('')
-            answer = raw_input('Do you wish to add more files? [y/n] ')
+            answer = ask('std.flat.more', 'Do you wish to add more files? [y/n] ',
+                         default='y' if has_answer('std.flat.extra') else 'n')
 
             if answer == "y":
                 print('')
-                filename = raw_input("Type your selected file name: ")
+                filename = ask('std.flat.extra', "Type your selected file name: ")
                 flat_std_list.append(filename)
 
             if answer == "n":
@@ -280,13 +816,11 @@ def selec_std():
         flat_std_txt.close()
 
     # BIAS
-    bias_file=[]
-    # Parameters for the IRAF task 'hselect'.
-    select_bias_std = 'ObsType="BIAS" && Ccdsum = {}'.format(ccdsum_file)
-    bias_file.append(iraf.hselect("{}*.fits[2,inherit=yes]".format(raw_path),
-                        '$I', select_bias_std, Stdout=1))
+    # Parameters for the file selection.
+    select_bias_std = {'ObsType':'BIAS', 'Ccdsum':ccdsum_file}
+    bias_file = select_frames(**select_bias_std)
 
-    if bias_file == [[]]:
+    if bias_file == []:
         print('')
         print("There is no BIAS file matching the specified values")
         print('')
@@ -295,16 +829,12 @@ def selec_std():
         print('')
         # Print the number of BIAS files matching the specified values.
         print("It has been found {} BIAS file(s) matching the"
-                "specified value:".format(len(bias_file[0])))
+                "specified value:".format(len(bias_file)))
         print('')
-        bias_name=[]
-
-        bias_name.append(iraf.hselect("{}*.fits[2,inherit=yes]".format(raw_path),
-                            '$I', select_bias_std, Stdout=1))# File name.
-        for j in range(len(bias_name[0])):
-            # Print BIAS names, CCD binning and title.
-            # Remove '[2,inherit=yes]' and the 'raw_path' from their names.
-            print(bias_name[0][j].replace('[2,inherit=yes]','').replace(raw_path,''))
+        bias_name = [frame['name'] for frame in bias_file] # File name.
+        for j in range(len(bias_name)):
+            # Print BIAS names.
+            print(bias_name[j])
 
         print('')
     # Remove pre-existing BIAS list.
@@ -315,11 +845,12 @@ def selec_std():
     # and ask the user to continue. Give the user option to choose another file.
     while True:
         try:
-            first_bias_name=bias_name[0][0].replace(raw_path,'').replace('[2,inherit=yes]','')
+            first_bias_name=bias_name[0]
             print('')
             print("Selected BIAS file: {}".format(first_bias_name))
             print('')
-            answer = raw_input("Continue? [y/n] ")
+            answer = ask('std.bias.continue', "Continue? [y/n] ",
+                         default='n' if has_answer('std.bias.name') else 'y')
 
             if answer == 'y':
                 bias_std_list.append(first_bias_name)
@@ -327,7 +858,7 @@ def selec_std():
             if answer == 'n':
 
                 print('')
-                filename = raw_input("Type your selected file name: ")
+                filename = ask('std.bias.name', "Type your selected file name: ")
                 bias_std_list.append(filename)
 
                 break
@@ -343,11 +874,12 @@ def selec_std():
     while True:
         try:
             print('')
-            answer = raw_input('Do you wish to add more files? [y/n] ')
+            answer = ask('std.bias.more', 'Do you wish to add more files? [y/n] ',
+                         default='y' if has_answer('std.bias.extra') else 'n')
 
             if answer == "y":
                 print('')
-                filename = raw_input("Type your selected file name: ")
+                filename = ask('std.bias.extra', "Type your selected file name: ")
                 bias_std_list.append(filename)
 
             if answer == "n":
@@ -371,8 +903,9 @@ def selec_std():
     # Ask the user to continue with the selected calibration files.
     while True:
         print('')
-        answer = raw_input("Do you want to continue the data reduction"
-                            "with the selected files [y/n]? ")
+        answer = ask('std.proceed', "Do you want to continue the data reduction"
+                            "with the selected files [y/n]? ",
+                     default='y')
         if answer == "y":
             break
 
@@ -382,6 +915,10 @@ def selec_std():
         else:
             print("Type y or n")
 
+    # Unpack the selected files that are only available compressed.
+    for name in obj_std_name + arc_std_name + flat_std_list + bias_std_list:
+        unpack_raw_file(name)
+
 def selec_obj():
     """ Select a Science Object and its calibration files matching their
     central wavelength and CCD binning. """
@@ -390,21 +927,21 @@ def selec_obj():
         try:
             print('')
             # Ask for a central wavelength value.
-            wavelength = int(input("Type the central wavelength for the SCIENCE OBJECT: "))
+            wavelength = int(ask('obj.centwave', "Type the central wavelength for the SCIENCE OBJECT: "))
 
-            # Parameters for the IRAF task 'hselect'.
-            select_obj = ("ObsType='OBJECT' && obsclass?='science' && CentWave = {}".format(wavelength))
+            # Parameters for the file selection.
+            select_obj = {'ObsType':'OBJECT', 'obsclass':'science',
+                          'CentWave':wavelength}
 
             print('')
             # Print the selected parameters.
-            print("Selecting " + select_obj)
+            print("Selecting ObsType = OBJECT, obsclass = science, "
+                  "CentWave = {}".format(wavelength))
 
             # Confirm the existence of files with the selected parameters.
-            selected_files=[]
-            selected_files.append(iraf.hselect("{}*.fits[2,inherit=yes]".format(raw_path),
-                                    '$I', select_obj, Stdout=1))
+            obj_files = select_frames(**select_obj)
 
-            if selected_files == [[]]:
+            if obj_files == []:
                 print('')
                 print("There is no file matching the specified value.")
 
@@ -413,26 +950,18 @@ def selec_obj():
                 # Print the number of SCIENCE OBJECT files matching the specified
                 # values.
                 print("It has been found {} SCIENCE OBJECT file(s)"
-                        "matching the specified values:".format(len(selected_files[0])))
+                        "matching the specified values:".format(len(obj_files)))
                 print('')
                 print(" Name \ CCDsum ")
                 print('')
 
-                obj_name=[]
-                obj_ccdsum=[]
-                obj_name.append(iraf.hselect("{}*.fits[2,inherit=yes]".format(raw_path),
-                                '$I', select_obj, Stdout=1)) # File name.
-                obj_ccdsum.append(iraf.hselect("{}*.fits[2,inherit=yes]".format(raw_path),
-                                    '$Ccdsum', select_obj, Stdout=1)) # File CCD Binning.
-                for j in range(len(obj_name[0])):
-                    # Print SCIENCE OBJECT names, CCD binning and title.
-                    # Remove '[2,inherit=yes]' and 'raw_path' from their names.
-                    print(obj_name[0][j].replace('[2,inherit=yes]','').replace(raw_path,''),
-                        obj_ccdsum[0][j])
+                for frame in obj_files:
+                    # Print SCIENCE OBJECT names and CCD binning.
+                    print(frame['name'], frame['Ccdsum'])
 
                 break
 
-        except (NameError, SyntaxError,IndexError):
+        except (NameError, SyntaxError, IndexError, ValueError):
             print('')
             print("Check if you typed a correct central wavelength. ")
 
@@ -440,13 +969,13 @@ def selec_obj():
     # and ask the user to continue. Give the user option for choosing another file.
     while True:
         try:
-            first_obj_name=obj_name[0][0].replace(raw_path,'').replace('[2,inherit=yes]','')
+            first_obj_name=obj_files[0]['name']
             print('')
             print("Selected SCIENCE OBJECT file: {}".format(first_obj_name))
             print('')
-            answer = raw_input("Continue? [y/n] ")
-            ccdsum_file = iraf.hselect("{}{}[2,inherit=yes]".format(raw_path,first_obj_name),
-                                        'Ccdsum', select_obj, Stdout=1)[0]
+            answer = ask('obj.frame.continue', "Continue? [y/n] ",
+                         default='n' if has_answer('obj.frame.name') else 'y')
+            ccdsum_file = obj_files[0]['Ccdsum']
 
             if answer == 'y':
                 filename = first_obj_name
@@ -454,9 +983,9 @@ def selec_obj():
             if answer == 'n':
 
                 print('')
-                filename = raw_input("Type your selected file name: ")
-                ccdsum_file = iraf.hselect("{}{}[2,inherit=yes]".format(raw_path,filename),
-                                            'Ccdsum', select_obj, Stdout=1)[0]
+                filename = ask('obj.frame.name', "Type your selected file name: ")
+                ccdsum_file = [frame['Ccdsum'] for frame in obj_files
+                                if frame['name'] == filename][0]
                 break
 
             else:
@@ -476,14 +1005,12 @@ def selec_obj():
     print("Selecting ARC, FLAT and BIAS...")
 
     # ARC
-    arc_file_obj=[]
-    # Parameters for the IRAF task 'hselect'.
-    select_arc_obj = ("ObsType='ARC' && Ccdsum = {} &&"
-                        "CentWave = {}".format(ccdsum_file, wavelength))
-    arc_file_obj.append(iraf.hselect("{}*.fits[2,inherit=yes]".format(raw_path),
-                        '$I', select_arc_obj, Stdout=1))
-
-    if arc_file_obj == [[]]:
+    # Parameters for the file selection.
+    select_arc_obj = {'ObsType':'ARC', 'Ccdsum':ccdsum_file,
+                      'CentWave':wavelength}
+    arc_file_obj = select_frames(**select_arc_obj)
+
+    if arc_file_obj == []:
         print('')
         print("There is no ARC file matching the specified values")
         print('')
@@ -492,26 +1019,24 @@ def selec_obj():
         print('')
         # Print the number of ARC files matching the specified values.
         print("It has been found {} ARC file(s) matching the"
-                "specified values:".format(len(arc_file_obj[0])))
+                "specified values:".format(len(arc_file_obj)))
         print('')
-        arc_name_obj=[]
-        arc_name_obj.append(iraf.hselect("{}*.fits[2,inherit=yes]".format(raw_path),
-                            '$I', select_arc_obj, Stdout=1)) # File name.
-        for j in range(len(arc_name_obj[0])):
-            # Print ARC names, CCD binning and title.
-            # Remove '[2,inherit=yes]' and the 'raw_path' from their names.
-            print(arc_name_obj[0][j].replace('[2,inherit=yes]','').replace(raw_path,''))
+        arc_name_obj = [frame['name'] for frame in arc_file_obj] # File name.
+        for j in range(len(arc_name_obj)):
+            # Print ARC names.
+            print(arc_name_obj[j])
         print('')
 
     # Select a file matching the values for central wavelength and CCD binning,
     # and ask the user to continue. Give the user option to choose another file.
     while True:
         try:
-            first_arc_name=arc_name_obj[0][0].replace(raw_path,'').replace('[2,inherit=yes]','')
+            first_arc_name=arc_name_obj[0]
             print('')
             print("Selected ARC file: {}".format(first_arc_name))
             print('')
-            answer = raw_input("Continue? [y/n] ")
+            answer = ask('obj.arc.continue', "Continue? [y/n] ",
+                         default='n' if has_answer('obj.arc.name') else 'y')
 
             if answer == 'y':
                 filename = first_arc_name
@@ -519,7 +1044,7 @@ def selec_obj():
             if answer == 'n':
 
                 print('')
-                filename = raw_input("Type your selected file name: ")
+                filename = ask('obj.arc.name', "Type your selected file name: ")
 
                 break
             else:
@@ -535,14 +1060,12 @@ def selec_obj():
     arc_sci_name.append(filename)
 
     # FLAT
-    flat_file_obj=[]
-    # Parameters for the IRAF task 'hselect'.
-    select_flat_obj = ("ObsType='FLAT' && Ccdsum = {}"
-                    "&& CentWave = {}".format(ccdsum_file, wavelength))
-    flat_file_obj.append(iraf.hselect("{}*.fits[2,inherit=yes]".format(raw_path),
-                        '$I', select_flat_obj, Stdout=1))
-
-    if flat_file_obj == [[]]:
+    # Parameters for the file selection.
+    select_flat_obj = {'ObsType':'FLAT', 'Ccdsum':ccdsum_file,
+                       'CentWave':wavelength}
+    flat_file_obj = select_frames(**select_flat_obj)
+
+    if flat_file_obj == []:
         print('')
         print("There is no FLAT file matching the specified values")
         print('')
@@ -551,15 +1074,12 @@ def selec_obj():
         print('')
         # Print the number of FLAT files matching the specified values.
         print("It has been found {} FLAT file(s) matching the specified"
-                    "values:".format(len(flat_file_obj[0])))
+                    "values:".format(len(flat_file_obj)))
         print('')
-        flat_name_obj=[]
-        flat_name_obj.append(iraf.hselect("{}*.fits[2,inherit=yes]".format(raw_path),
-                                '$I', select_flat_obj, Stdout=1)) # File name.
-        for j in range(len(flat_name_obj[0])):
-                # Print FLAT names, CCD binning and title.
-                # Remove '[2,inherit=yes]' and the 'raw_path' from their names.
-            print(flat_name_obj[0][j].replace('[2,inherit=yes]','').replace(raw_path,''))
+        flat_name_obj = [frame['name'] for frame in flat_file_obj] # File name.
+        for j in range(len(flat_name_obj)):
+            # Print FLAT names.
+            print(flat_name_obj[j])
 
         print('')
     # Remove pre-existing FLAT list.
@@ -570,11 +1090,12 @@ def selec_obj():
     # and ask the user to continue. Give the user option to choose another file.
     while True:
         try:
-            first_flat_name=flat_name_obj[0][0].replace(raw_path,'').replace('[2,inherit=yes]','')
+            first_flat_name=flat_name_obj[0]
             print('')
             print("Selected FLAT file: {}".format(first_flat_name))
             print('')
-            answer = raw_input("Continue? [y/n] ")
+            answer = ask('obj.flat.continue', "Continue? [y/n] ",
+                         default='n' if has_answer('obj.flat.name') else 'y')
 
             if answer == 'y':
                 flat_obj_list.append(first_flat_name)
@@ -582,7 +1103,7 @@ def selec_obj():
             if answer == 'n':
 
                 print('')
-                filename = raw_input("Type your selected file name: ")
+                filename = ask('obj.flat.name', "Type your selected file name: ")
                 flat_obj_list.append(filename)
 
                 break
@@ -598,11 +1119,12 @@ def selec_obj():
     while True:
         try:
             print('')
-            answer = raw_input('Do you wish to add more files? [y/n] ')
+            answer = ask('obj.flat.more', 'Do you wish to add more files? [y/n] ',
+                         default='y' if has_answer('obj.flat.extra') else 'n')
 
             if answer == "y":
                 print('')
-                filename = raw_input("Type your selected file name: ")
+                filename = ask('obj.flat.extra', "Type your selected file name: ")
                 flat_obj_list.append(filename)
 
             if answer == "n":
@@ -624,13 +1146,11 @@ def selec_obj():
         flat_obj_txt.close()
 
     # BIAS
-    bias_file_obj=[]
-    # Parameters for the IRAF task 'hselect'.
-    select_bias_obj = 'ObsType="BIAS" && Ccdsum = {}'.format(ccdsum_file)
-    bias_file_obj.append(iraf.hselect("{}*.fits[2,inherit=yes]".format(raw_path),
-                            '$I', select_bias_obj, Stdout=1))
+    # Parameters for the file selection.
+    select_bias_obj = {'ObsType':'BIAS', 'Ccdsum':ccdsum_file}
+    bias_file_obj = select_frames(**select_bias_obj)
 
-    if bias_file_obj == [[]]:
+    if bias_file_obj == []:
         print('')
         print("There is no BIAS file matching the specified values")
         print('')
@@ -639,17 +1159,13 @@ def selec_obj():
         print('')
         # Print the number of BIAS files matching the specified values.
         print("It has been found {} BIAS file(s) matching the specified"
-                "values:".format(len(bias_file_obj[0])))
+                "values:".format(len(bias_file_obj)))
         print('')
-        bias_name_obj=[]
-
-        bias_name_obj.append(iraf.hselect("{}*.fits[2,inherit=yes]".format(raw_path),
-                                '$I', select_bias_obj, Stdout=1))
+        bias_name_obj = [frame['name'] for frame in bias_file_obj] # File name.
 
-        for j in range(len(bias_name_obj[0])):
-            # Print BIAS names, CCD binning and title.
-            # Remove '[2,inherit=yes]' and the 'raw_path' from their names.
-            print(bias_name_obj[0][j].replace('[2,inherit=yes]','').replace(raw_path,''))
+        for j in range(len(bias_name_obj)):
+            # Print BIAS names.
+            print(bias_name_obj[j])
 
         print('')
     # Remove pre-existing BIAS list.
@@ -660,11 +1176,12 @@ def selec_obj():
     # and ask the user to continue. Give the user option to choose another file.
     while True:
         try:
-            first_bias_name=bias_name_obj[0][0].replace(raw_path,'').replace('[2,inherit=yes]','')
+            first_bias_name=bias_name_obj[0]
             print('')
             print("Selected BIAS file: {}".format(first_bias_name))
             print('')
-            answer = raw_input("Continue? [y/n] ")
+            answer = ask('obj.bias.continue', "Continue? [y/n] ",
+                         default='n' if has_answer('obj.bias.name') else 'y')
 
             if answer == 'y':
                 bias_obj_list.append(first_bias_name)
@@ -672,7 +1189,7 @@ def selec_obj():
             if answer == 'n':
 
                 print('')
-                filename = raw_input("Type your selected file name: ")
+                filename = ask('obj.bias.name', "Type your selected file name: ")
                 bias_obj_list.append(filename)
 
                 break
@@ -688,11 +1205,12 @@ def selec_obj():
     while True:
         try:
             print('')
-            answer = raw_input('Do you wish to add more files? [y/n] ')
+            answer = ask('obj.bias.more', 'Do you wish to add more files? [y/n] ',
+                         default='y' if has_answer('obj.bias.extra') else 'n')
 
             if answer == "y":
                 print('')
-                filename = raw_input("Type your selected file name: ")
+                filename = ask('obj.bias.extra', "Type your selected file name: ")
                 bias_std_list.append(filename)
 
             if answer == "n":
@@ -716,8 +1234,9 @@ def selec_obj():
     # Ask the user to continue with the selected calibration files.
     while True:
         print('')
-        answer = raw_input("Do you want to continue the data reduction "
-                            "with the selected files [y/n]? ")
+        answer = ask('obj.proceed', "Do you want to continue the data reduction "
+                            "with the selected files [y/n]? ",
+                     default='y')
         if answer == "y":
             break
 
@@ -727,11 +1246,1528 @@ def selec_obj():
         else:
             print("Type y or n")
 
+    # Unpack the selected files that are only available compressed.
+    for name in obj_sci_name + arc_sci_name + flat_obj_list + bias_obj_list:
+        unpack_raw_file(name)
+
 # Reduction and calibration of STANDARD STAR files.
 print "------------------------------"
 print "# REDUCTION OF STANDARD STAR #"
 print "------------------------------"
 
+# FITS files opened by the running stage and by the functions it calls.
+# They are memory-mapped, except for the scaled data of the raw files,
+# their extensions are only read when they are used, and they are all
+# closed when the stage ends, with the images kept for its figures, so the
+# memory and the open files do not grow from one stage to the next.
+open_files = []
+
+def open_fits(path, **options):
+    """ Open the FITS file 'path' for the running stage. 'options' are
+        passed to fits.open. """
+
+    hdulist = fits.open(path, lazy_load_hdus=True, **options)
+    open_files.append(hdulist)
+
+    return hdulist
+
+def close_fits(hdulist=None):
+    """ Close the FITS file 'hdulist', or all the files opened by the
+        stage and the images kept for its figures. """
+
+    if hdulist is not None:
+        open_files.remove(hdulist)
+        hdulist.close()
+        return
+
+    while open_files:
+        open_files.pop().close()
+    display_images.clear()
+
+@contextlib.contextmanager
+def opened_fits(path, **options):
+    """ Open the FITS file 'path' for the running stage and close it at
+        the end of the block. """
+
+    hdulist = open_fits(path, **options)
+    try:
+        yield hdulist
+    finally:
+        close_fits(hdulist)
+
+# Quality assessment figures. The stages describe each figure with a
+# dictionary of arrays and labels (its 'spec') and one of the functions
+# below draws it.
+figure_pool = None
+figure_results = []
+# Number of processes drawing the figures in headless mode, divided
+# between the stage workers when there are several.
+figure_processes = multiprocessing.cpu_count()
+
+def show_figure(plot, spec, filename=None):
+    """ Draw a figure with 'plot' from 'spec', save it to 'filename' and
+        show it. In headless mode the figure is drawn and saved in a
+        background process, or not drawn at all if it is not saved. """
+
+    global figure_pool
+
+    if not headless:
+        plot(spec)
+        if filename is not None:
+            plt.savefig(filename)
+        plt.show()
+        plt.close()
+        return
+
+    if filename is None:
+        return
+    if figure_pool is None:
+        # Do not share the IRAF processes of this process.
+        iraf.flprcache()
+        figure_pool = multiprocessing.Pool(figure_processes, isolate_figure_worker)
+    # The arrays are copied now, as their files can change before the
+    # figure is drawn.
+    job = pickle.dumps((plot, spec, filename), 2)
+    figure_results.append((filename, figure_pool.apply_async(render_figure, (job,))))
+
+def isolate_figure_worker():
+    """ Prepare a background process to draw figures. """
+
+    reopen_catalog()
+    plt.switch_backend('Agg')
+
+def render_figure(job):
+    """ Draw and save a figure in a background process. """
+
+    plot, spec, filename = pickle.loads(job)
+    plot(spec)
+    plt.savefig(filename)
+    plt.close()
+
+def finish_figures():
+    """ Wait for the figures drawn in background processes. """
+
+    global figure_pool
+
+    if figure_pool is None:
+        return
+    figure_pool.close()
+    figure_pool.join()
+    for filename, result in figure_results:
+        try:
+            result.get()
+        except Exception as error:
+            print('The figure {} could not be saved: {}'.format(filename, error))
+    del figure_results[:]
+    figure_pool = None
+
+# Largest size, in pixels, of the images drawn in the figures. Larger
+# images are binned down to this size.
+display_size = 1024
+# Number of pixels sampled to find the clip levels of an image.
+level_samples = 100000
+# Binned images and sorted samples of their pixels, by file, extension
+# and version of the file, reused by all the figures of the same image
+# until the stage ends.
+display_images = {}
+
+def display_image(hdulist, extension):
+    """ Image of an extension binned down to the display size, and a
+        sorted sample of its pixels. """
+
+    key = None
+    if hdulist.filename() is not None:
+        stat = os.stat(hdulist.filename())
+        key = (os.path.abspath(hdulist.filename()), extension,
+               stat.st_mtime, stat.st_size)
+        if key in display_images:
+            return display_images[key]
+
+    data = hdulist[extension].data
+    step = max(1, int(np.sqrt(data.size/float(level_samples))))
+    sample = np.sort(data[::step,::step], axis=None)
+    sample = sample[np.isfinite(sample)]
+
+    # Average blocks of pixels. The extent keeps the axes in pixels of
+    # the original image.
+    ybin = -(-data.shape[0]//display_size)
+    xbin = -(-data.shape[1]//display_size)
+    ny = data.shape[0]//ybin
+    nx = data.shape[1]//xbin
+    image = data[:ny*ybin,:nx*xbin]
+    if ybin > 1 or xbin > 1:
+        image = image.reshape(ny, ybin, nx, xbin).mean(axis=(1, 3))
+    else:
+        image = np.array(image)
+
+    display = {'data':image, 'sample':sample,
+               'extent':(-0.5, nx*xbin - 0.5, -0.5, ny*ybin - 0.5)}
+    if key is not None:
+        display_images[key] = display
+
+    return display
+
+def qa_image(hdulist, extension, clip=(5, 90)):
+    """ Image of an extension for the figures, binned down to the display
+        size, with its counts at the 'clip' percentiles. """
+
+    display = display_image(hdulist, extension)
+    sample = display['sample']
+    # Extensions without any finite pixel are drawn without clip levels.
+    vmin = vmax = 0.0
+    if len(sample) > 0:
+        vmin, vmax = [sample[int(round(percent/100.0*(len(sample) - 1)))] for percent in clip]
+
+    return {'data':display['data'], 'vmin':vmin, 'vmax':vmax,
+            'extent':display['extent']}
+
+def plot_images(spec):
+    """ Images in a grid of panels. 'images' is a list of rows of images
+        made by 'qa_image'. A dashed line marks the row 'line'. """
+
+    images = spec['images']
+    plt.figure(figsize=spec['figsize'])
+    for i, row in enumerate(images):
+        for j, image in enumerate(row):
+            ax = plt.subplot(len(images), len(row), i*len(row) + j + 1)
+            ax.imshow(image['data'], origin='lower',cmap='afmhot',
+                      vmin=image['vmin'], vmax=image['vmax'],
+                      extent=image['extent'], aspect='auto')
+            if spec.get('line') is not None:
+                ax.axhline(y=spec['line'], linestyle='--', color='red',linewidth=2., alpha=0.7)
+            if j == 0:
+                ax.set_ylabel('Position Along Slit', fontsize=14)
+            else:
+                ax.yaxis.set_visible(False)
+            if i == len(images) - 1 and 'xlabel' in spec:
+                ax.set_xlabel(spec['xlabel'], fontsize=14)
+    plt.tight_layout(w_pad=-0.9)
+    plt.suptitle(spec['title'], y=1.0, fontsize=14)
+
+def line_cuts(hdulist, extensions, reference):
+    """ Spec of the pixel counting through the rows at 30, 50 and 70 per
+        cent of the height of the image extensions, with the count range
+        of the 'reference' extension. """
+
+    data = hdulist[reference].data
+    rows = [int(0.3*data.shape[0]), int(0.5*data.shape[0]), int(0.7*data.shape[0])]
+
+    return {'rows':rows,
+            'limits':[(data[row,1:].min(), data[row,1:].max()) for row in rows],
+            'cuts':[[hdulist[n].data[row,1:] for n in extensions] for row in rows]}
+
+def plot_line_cuts(spec):
+    """ Pixel counting through rows of one or more images. 'cuts' holds,
+        for each row, the counts of each image. """
+
+    cuts = spec['cuts']
+    plt.figure(figsize=(16.0,8.0))
+    for i, (row, limits, counts) in enumerate(zip(spec['rows'], spec['limits'], cuts)):
+        for j, values in enumerate(counts):
+            ax = plt.subplot(len(cuts), len(counts), i*len(counts) + j + 1)
+            ax.set_ylim(*limits)
+            ax.plot(np.arange(1,len(values)+1,1), values, linewidth=0.5)
+            if j == 0:
+                ax.set_ylabel('Counts [row={}]'.format(row), fontsize=14)
+            else:
+                ax.yaxis.set_visible(False)
+            if i == len(cuts) - 1 and 'xlabel' in spec:
+                ax.set_xlabel(spec['xlabel'], fontsize=14)
+    plt.tight_layout(w_pad=-0.9)
+    plt.suptitle('Pixel Counting',y=1.0, fontsize=14)
+
+def plot_identify(spec):
+    """ Difference of the identified and fitted wavelengths of the arc
+        lines, against their pixel position and wavelength. """
+
+    fig = plt.figure(figsize=(14.0,6.0))
+    ax1 = fig.add_subplot(111)
+    ax2 = ax1.twiny()
+    ax3 = ax1.twiny()
+    ax4 = ax1.twiny()
+    ax1.scatter(spec['pixels'], np.abs(spec['delta']), color='white' )
+    ax2.scatter(spec['wavelengths'], np.abs(spec['delta']), color='coral')
+    ax2.invert_xaxis()
+    plt.title(spec['title'], y=1.10, fontsize=14)
+    ax2.set_xlabel(r'$\lambda_{identified} \ [\AA]$', fontsize=14)
+    ax1.set_xlabel('Pixel position', fontsize=14)
+    ax1.set_ylabel(r'|$\lambda_{identified} - \lambda_{fitted}| \ [\AA]$', fontsize=14)
+    ax3.axhline(y=0.2, linestyle='--')
+    ax3.xaxis.set_visible(False)
+    ax4.axhline(y=spec['rms'], linestyle=':', label='RMS = {}'.format(spec['rms']))
+    ax4.xaxis.set_visible(False)
+    plt.tight_layout(w_pad=-0.9)
+    ax4.legend()
+
+def plot_residual_map(spec):
+    """ Mean residual of the arc lines by row of the arc and pixel. """
+
+    plt.figure(figsize=(14.0,4.0))
+    limit = np.nanmax(np.abs(spec['map'])) if np.isfinite(spec['map']).any() else 1.0
+    plt.imshow(spec['map'], aspect='auto', interpolation='nearest', cmap='coolwarm',
+               vmin=-limit, vmax=limit, origin='lower',
+               extent=(spec['pixels'][0], spec['pixels'][1], -0.5, len(spec['rows']) - 0.5))
+    plt.yticks(range(len(spec['rows'])), spec['rows'])
+    plt.colorbar(label=r'$\lambda_{identified} - \lambda_{fitted} \ [\AA]$')
+    plt.xlabel('Pixel position', fontsize=12)
+    plt.ylabel('Row', fontsize=12)
+    plt.title(spec['title'], fontsize=14)
+    plt.tight_layout()
+
+def plot_line_check(spec):
+    """ Frame with the selected row, and pixel counting through the row
+        for bad column checking. """
+
+    image = spec['image']
+    plt.figure(figsize=(16.0,8.0))
+    ax1=plt.subplot(211)
+    ax1.imshow(image['data'], origin='lower',cmap='afmhot',
+               vmin=image['vmin'], vmax=image['vmax'],
+               extent=image['extent'], aspect='auto')
+    ax1.axhline(y=spec['line'], linestyle='--', color='red',linewidth=2., alpha=0.7)
+    ax1.set_ylabel('Position Along Slit', fontsize=14)
+    ax2=plt.subplot(212)
+    ax2.plot(spec['x'], spec['y'], color='red' )
+    ax2.set_xlim(left=np.min(spec['x']), right=np.max(spec['x']))
+    ax2.set_ylabel('Counts', fontsize=14)
+    ax2.set_xlabel('Dispersion Axis', fontsize=14)
+
+def plot_spectra(spec):
+    """ Spectra, or other curves along the wavelength. 'curves' is a list
+        of (x, y, options), with the options of 'plot'. 'ylim' limits the
+        counts, 'grid' holds the options of the grid, 'ticks' the size of
+        the tick labels. """
+
+    fontsize = spec.get('fontsize', 14)
+    fig, ax = plt.subplots(figsize=(14.0,6.0))
+    for x, y, style in spec['curves']:
+        plt.plot(x, y, **style)
+    if spec.get('locators', True):
+        ax.xaxis.set_major_locator(MultipleLocator(500))
+        ax.xaxis.set_minor_locator(MultipleLocator(50))
+    if 'ylim' in spec:
+        ax.set_ylim(*spec['ylim'])
+    if 'grid' in spec:
+        plt.grid(**spec['grid'])
+    if 'ylabel' in spec:
+        plt.ylabel(spec['ylabel'], fontsize=fontsize)
+    plt.xlabel(spec.get('xlabel', r'Wavelength $\ [\AA]$'), fontsize=fontsize)
+    plt.title(spec['title'], fontsize=fontsize)
+    if 'ticks' in spec:
+        plt.xticks(fontsize=spec['ticks'])
+        plt.yticks(fontsize=spec['ticks'])
+    plt.tight_layout(w_pad=-0.9)
+    if spec.get('legend'):
+        plt.legend()
+
+def plot_sensitivity(spec):
+    """ Sensitivity function, with the fitted points and their residuals. """
+
+    plt.figure(figsize=(14.0,6.0))
+    ax1 = plt.subplot(2,1,1)
+    ax1.plot(spec['wavelength'], spec['sensitivity'])
+    ax1.scatter(spec['points'], spec['fit'], color='red', s=25, marker='x')
+    ax1.set_ylabel('Sensitivity', fontsize=12)
+    ax1.set_xlabel('Wavelength', fontsize=12)
+    ax2 = plt.subplot(2,1,2)
+    ax2.scatter(spec['points'], spec['residual'], s=25, color='red', marker='x')
+    ax2.axhline(y=0, linestyle='--')
+    ax2.set_xlabel('Wavelength', fontsize=12)
+    ax2.set_ylabel('Residual', fontsize=12)
+    plt.tight_layout(w_pad=-0.9)
+    plt.suptitle(spec['title'], fontsize=12,y=1.0)
+
+# Columns of the features of an IRAF identify database: pixel position,
+# line wavelength fitted by the dispersion function, identified line
+# wavelength, feature width, feature type and gswavelength flag (0 for
+# the lines rejected from the fit).
+feature_dtype = [('pixel', float), ('fitted', float), ('identified', float),
+                 ('width', float), ('type', int), ('flag', int)]
+# Parsed database files, by path and version of the file.
+databases = {}
+
+def read_database(path):
+    """ Read an IRAF identify or fitcoords database, such as the wavelength
+        solution of gswavelength, in one pass. Return its blocks, in file
+        order, as dictionaries of the block parameters with the 'features'
+        as a structured array and the 'coefficients' and 'surface' as
+        arrays. """
+
+    status = os.stat(path)
+    version = (os.path.abspath(path), status.st_mtime, status.st_size)
+    if version in databases:
+        return databases[version]
+
+    f = open(path, 'r')
+    lines = [line.split() for line in f]
+    f.close()
+
+    blocks = []
+    i = 0
+    while i < len(lines):
+        words = lines[i]
+        i += 1
+        if len(words) == 0 or words[0].startswith('#'):
+            continue
+        if words[0] == 'begin':
+            blocks.append(collections.OrderedDict([('begin', ' '.join(words[1:]))]))
+        elif words[0] == 'features':
+            n = int(words[1])
+            blocks[-1]['features'] = np.array(
+                [tuple(float(word) for word in line[:len(feature_dtype)]) for line in lines[i:i+n]],
+                dtype=feature_dtype)
+            i += n
+        elif words[0] in ('coefficients', 'surface'):
+            n = int(words[1])
+            blocks[-1][words[0]] = np.array([float(line[0]) for line in lines[i:i+n]])
+            i += n
+        else:
+            blocks[-1][words[0]] = ' '.join(words[1:])
+
+    databases[version] = blocks
+    return blocks
+
+def write_database(path, blocks):
+    """ Write the blocks of an IRAF identify or fitcoords database, as
+        read by read_database(). """
+
+    f = open(path, 'w')
+    for block in blocks:
+        f.write('# {}\n'.format(time.strftime('%a %H:%M:%S %d-%b-%Y')))
+        for key, value in block.items():
+            if key == 'begin':
+                f.write('begin\t{}\n'.format(value))
+            elif key == 'features':
+                f.write('\tfeatures\t{}\n'.format(len(value)))
+                for feature in value:
+                    f.write('\t    {:10.2f} {:10.9g} {:10.9g} {:5.1f} {:d} {:d}\n'.format(
+                            feature['pixel'], feature['fitted'], feature['identified'],
+                            feature['width'], int(feature['type']), int(feature['flag'])))
+            elif key in ('coefficients', 'surface'):
+                f.write('\t{}\t{}\n'.format(key, len(value)))
+                for coefficient in value:
+                    f.write('\t\t{!r}\n'.format(float(coefficient)))
+            else:
+                f.write('\t{}\t{}\n'.format(key, value))
+        f.write('\n')
+    f.close()
+
+    # Forget the blocks read before.
+    for version in list(databases):
+        if version[0] == os.path.abspath(path):
+            del databases[version]
+
+# Quality of the wavelength solutions. The residuals of the arc lines are
+# sigma clipped in each block of the solution, that is in each row of the
+# arc where the lines were identified, and a solution fails if a block
+# keeps fewer lines than its fit has coefficients or has a clipped RMS
+# above the limit, in Angstroms.
+wavelength_clip = 3.0
+wavelength_iterations = 5
+wavelength_rms_limit = 1.0
+if answers is not None and 'wavelength_rms_limit' in answers:
+    wavelength_rms_limit = float(answers['wavelength_rms_limit'])
+# Number of pixel bins along the dispersion axis of the residual maps.
+residual_map_bins = 64
+# Metrics of the running stage, added to its trace record.
+stage_metrics = {}
+
+def wavelength_qa(blocks):
+    """ Residuals of the arc lines of the blocks of a wavelength solution,
+        clipped in all the blocks at once. Return the RMS of the lines
+        used by gswavelength and the clipped RMS of each block, their
+        lines and a map of the mean residual by row and pixel. """
+
+    features = np.concatenate([block['features'] for block in blocks])
+    index = np.repeat(np.arange(len(blocks)), [len(block['features']) for block in blocks])
+    used = features['flag'] == 1
+    delta = features['identified'] - features['fitted']
+
+    def block_rms(keep):
+        count = np.bincount(index, weights=keep, minlength=len(blocks))
+        square = np.bincount(index, weights=keep*delta**2, minlength=len(blocks))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.sqrt(square/count), count
+
+    rms, lines = block_rms(used)
+    keep = used
+    for i in range(wavelength_iterations):
+        clipped_rms, kept = block_rms(keep)
+        clipped = used & (np.abs(delta) <= wavelength_clip*clipped_rms[index])
+        if np.array_equal(clipped, keep):
+            break
+        keep = clipped
+    clipped_rms, kept = block_rms(keep)
+
+    # Row of the arc of each block, from its image section.
+    rows = []
+    for block in blocks:
+        section = block.get('image', '').rpartition('[')[2].rstrip(']').split(',')
+        rows.append(int(section[-1]) if section[-1].isdigit() else None)
+
+    # Mean residual of the kept lines by block and pixel bin.
+    edges = np.linspace(features['pixel'].min(), features['pixel'].max(), residual_map_bins + 1)
+    cell = index*residual_map_bins + np.clip(np.digitize(features['pixel'], edges) - 1,
+                                             0, residual_map_bins - 1)
+    size = len(blocks)*residual_map_bins
+    with np.errstate(invalid='ignore', divide='ignore'):
+        residual_map = (np.bincount(cell[keep], weights=delta[keep], minlength=size)
+                        / np.bincount(cell[keep], minlength=size))
+
+    qa = {'blocks':[], 'pixels':(edges[0], edges[-1]),
+          'map':residual_map.reshape(len(blocks), residual_map_bins),
+          'rms':float(np.sqrt(np.sum(delta[keep]**2)/max(keep.sum(), 1)))}
+    for i, block in enumerate(blocks):
+        inside = index == i
+        qa['blocks'].append({'row':rows[i], 'rms':float(rms[i]), 'lines':int(lines[i]),
+                             'clipped_rms':float(clipped_rms[i]), 'kept':int(kept[i]),
+                             'coefficients':int(block['coefficients'][1]) if 'coefficients' in block else 0,
+                             'pixels':features['pixel'][inside & used],
+                             'wavelengths':features['identified'][inside & used],
+                             'delta':delta[inside & used],
+                             'outliers':features['identified'][inside & used & ~keep]})
+
+    return qa
+
+def wavelength_metrics(qa):
+    """ Summary of a wavelength QA for the trace. """
+
+    return {'rms':qa['rms'],
+            'block_rms':[block['clipped_rms'] for block in qa['blocks']],
+            'block_lines':[block['kept'] for block in qa['blocks']],
+            'block_rows':[block['row'] for block in qa['blocks']]}
+
+def print_wavelength_qa(qa):
+    """ Print the RMS of each block and the lines rejected by the clipping. """
+
+    for i, block in enumerate(qa['blocks']):
+        label = '[AUTOIDENTIFY]' if i == 0 else '[REIDENTIFY]'
+        print('{} Row {}: RMS = {:.4f}, clipped RMS = {:.4f} with {} of {} lines'.format(
+                label, block['row'], block['rms'], block['clipped_rms'],
+                block['kept'], block['lines']))
+        if len(block['outliers']) > 0:
+            print('{} There are {} identified lines diverging from the fit by more than '
+                  '{} times the RMS :'.format(label, len(block['outliers']), wavelength_clip),
+                  block['outliers'].tolist())
+    print('Clipped RMS of the wavelength solution = {:.4f}'.format(qa['rms']))
+
+def wavelength_problem(qa):
+    """ Description of the first block of a wavelength QA with too few
+        lines or a clipped RMS above the limit, or None. """
+
+    for block in qa['blocks']:
+        if block['kept'] <= block['coefficients']:
+            problem = 'only {} lines for {} coefficients'.format(block['kept'], block['coefficients'])
+        elif not block['clipped_rms'] <= wavelength_rms_limit:
+            problem = 'a clipped RMS of {:.3f} A, above the limit of {} A'.format(
+                block['clipped_rms'], wavelength_rms_limit)
+        else:
+            continue
+        return '{} in row {}'.format(problem, block['row'])
+
+    return None
+
+def check_wavelength_qa(qa, arc):
+    """ Stop the reduction if a block of the wavelength solution of 'arc'
+        has too few lines or a clipped RMS above the limit. """
+
+    problem = wavelength_problem(qa)
+    if problem is not None:
+        finish_figures()
+        sys.exit('The wavelength solution of {} has {}.'.format(arc, problem))
+
+# Rectification of the frames with the wavelength solution of an arc, in
+# place of gstransform. The fitcoords surface of the arc gives the
+# wavelength of each pixel. Every pixel of the output, on a linear
+# wavelength grid, is interpolated between the two input pixels of its
+# row around its wavelength, and scaled by the number of input pixels it
+# covers, so the flux is conserved. The indices and weights of these
+# pairs are the operator of the arc, kept in memory and in the database
+# directory, and are applied to the SCI, VAR and DQ extensions of every
+# frame reduced with the arc.
+rectifiers = {}
+# DQ value of the output pixels outside the wavelength range of their row.
+no_data = 16
+
+def polynomial_basis(function, values, low, high, order):
+    """ Chebyshev (function 1) or Legendre (function 2) polynomials of
+        IRAF, up to 'order' terms, at 'values' normalized to the range
+        from 'low' to 'high'. """
+
+    if function == 1:
+        basis = np.polynomial.chebyshev.chebvander
+    elif function == 2:
+        basis = np.polynomial.legendre.legvander
+    else:
+        sys.exit('The IRAF function {} is not supported.'.format(function))
+
+    return basis((2*np.asarray(values, dtype=float) - (high + low))/(high - low), order - 1)
+
+def dispersion_values(coefficients, x):
+    """ Evaluate the dispersion function of an IRAF identify database at
+        the pixel positions 'x'. """
+
+    function, order = int(coefficients[0]), int(coefficients[1])
+    basis = polynomial_basis(function, x, coefficients[2], coefficients[3], order)
+
+    return basis.dot(coefficients[4:4+order])
+
+def surface_terms(surface):
+    """ Number of x terms of each y term of a fitcoords (gsurfit) surface.
+        The coefficients follow x first. Without cross terms only the
+        constant x term has y terms, and with half of them the sum of the
+        orders is below the highest order. """
+
+    xorder, yorder, xterms = [int(value) for value in surface[1:4]]
+    if xterms == 0:
+        return [xorder] + [1]*(yorder - 1)
+    if xterms == 2:
+        return [min(xorder, max(xorder, yorder) - j) for j in range(yorder)]
+    return [xorder]*yorder
+
+def surface_values(surface, x, y):
+    """ Evaluate an IRAF fitcoords (gsurfit) surface, a Chebyshev or
+        Legendre polynomial, on the grid of the pixel positions 'x' and
+        rows 'y'. """
+
+    function, xorder, yorder = [int(value) for value in surface[:3]]
+    xmin, xmax, ymin, ymax = surface[4:8]
+
+    coefficients = np.zeros((yorder, xorder))
+    n = 8
+    for j, terms in enumerate(surface_terms(surface)):
+        coefficients[j, :terms] = surface[n:n+terms]
+        n += terms
+
+    bx = polynomial_basis(function, x, xmin, xmax, xorder)
+    by = polynomial_basis(function, y, ymin, ymax, yorder)
+
+    return by.dot(coefficients).dot(bx.T)
+
+def rectifier(wavtran, version, shape):
+    """ Operator rectifying an extension of 'shape' with the wavelength
+        solution of extension 'version' of the arc 'wavtran'. """
+
+    path = 'database/fc{}_{:03d}'.format(wavtran.replace('.fits',''), version)
+    source = file_digest(path)
+    key = (path, source, shape)
+    if key in rectifiers:
+        return rectifiers[key]
+
+    cached = 'database/rect{}_{:03d}_{}x{}.npz'.format(wavtran.replace('.fits',''), version, *shape)
+    if os.path.exists(cached):
+        operator = dict(np.load(cached))
+        if str(operator['source']) == source:
+            rectifiers[key] = operator
+            return operator
+
+    ny, nx = shape
+    x = np.arange(1, nx + 1, dtype=float)
+    wavelength = surface_values(read_database(path)[0]['surface'], x,
+                                np.arange(1, ny + 1, dtype=float))
+    # Linear grid over the wavelengths of the first and last pixels of
+    # all the rows, with the number of pixels of the input.
+    ends = wavelength[:, [0, -1]]
+    w1 = ends.min()
+    dw = (ends.max() - w1)/(nx - 1)
+    grid = w1 + dw*np.arange(nx)
+
+    edges = grid - dw/2
+    edges = np.append(edges, edges[-1] + dw)
+
+    # Input position of every output pixel, and number of input pixels
+    # between its edges.
+    position = np.empty(shape)
+    scale = np.empty(shape)
+    for row in range(ny):
+        order = slice(None, None, -1) if wavelength[row, -1] < wavelength[row, 0] else slice(None)
+        position[row] = np.interp(grid, wavelength[row, order], x[order], left=np.nan, right=np.nan)
+        scale[row] = np.abs(np.diff(np.interp(edges, wavelength[row, order], x[order])))
+    outside = np.isnan(position)
+    position[outside] = 1.0
+    scale[outside] = 0.0
+
+    first = np.minimum(np.floor(position).astype(int), nx - 1)
+    fraction = position - first
+    index = (np.arange(ny)[:, None]*nx + first - 1).ravel()
+    operator = {'source':source, 'outside':outside.ravel(), 'w1':w1, 'dw':dw,
+                'index':index.astype(np.int32),
+                'weight0':((1.0 - fraction)*scale).ravel(),
+                'weight1':(fraction*scale).ravel()}
+
+    # Write a new file and rename it, as other stages may read it.
+    partial = '{}.{}.npz'.format(cached[:-len('.npz')], os.getpid())
+    np.savez(partial, **operator)
+    os.rename(partial, cached)
+    rectifiers[key] = operator
+    return operator
+
+def rectify(operator, data, plane):
+    """ Apply a rectification operator to the data of a SCI, VAR or DQ
+        extension. """
+
+    flat = data.ravel()
+    # The second pixel of a pair is the next one in the row.
+    second = operator['index'] + 1
+    if plane == 'DQ':
+        result = (np.where(operator['weight0'] > 0, flat[operator['index']], 0)
+                  | np.where(operator['weight1'] > 0, flat[second], 0))
+        result[operator['outside']] |= no_data
+        return result.reshape(data.shape).astype(data.dtype)
+    if plane == 'VAR':
+        result = flat[operator['index']]*operator['weight0']**2 + flat[second]*operator['weight1']**2
+    else:
+        result = flat[operator['index']]*operator['weight0'] + flat[second]*operator['weight1']
+
+    return result.reshape(data.shape).astype(np.float32)
+
+def transform_frame(frame, wavtran):
+    """ Rectify the SCI, VAR and DQ extensions of 'frame' with the
+        wavelength solution of the arc 'wavtran' and write them to 't' +
+        'frame', with a linear wavelength WCS, as gstransform does. """
+
+    if os.path.exists('t' + frame):
+        os.remove('t' + frame)
+
+    with opened_fits(frame) as hdulist:
+        for hdu in hdulist[1:]:
+            plane = hdu.header.get('EXTNAME')
+            if plane not in ('SCI', 'VAR', 'DQ'):
+                continue
+            operator = rectifier(wavtran, hdu.header.get('EXTVER', 1), hdu.data.shape)
+            hdu.data = rectify(operator, hdu.data, plane)
+            for keyword in ('CD1_2', 'CD2_1', 'LTV1', 'LTV2'):
+                if keyword in hdu.header:
+                    del hdu.header[keyword]
+            hdu.header.update([('WCSDIM', 2), ('DISPAXIS', 1), ('DC-FLAG', 0),
+                               ('CTYPE1', 'LINEAR'), ('CRPIX1', 1.0),
+                               ('CRVAL1', float(operator['w1'])),
+                               ('CD1_1', float(operator['dw'])), ('CDELT1', float(operator['dw'])),
+                               ('CTYPE2', 'LINEAR'), ('CRPIX2', 1.0), ('CRVAL2', 1.0),
+                               ('CD2_2', 1.0), ('CDELT2', 1.0), ('LTM1_1', 1.0), ('LTM2_2', 1.0),
+                               ('WAT0_001', 'system=world'),
+                               ('WAT1_001', 'wtype=linear label=Wavelength units=Angstroms'),
+                               ('WAT2_001', 'wtype=linear')])
+        hdulist[0].header['WAVTRAN'] = wavtran
+        hdulist[0].header['GSTRANSF'] = (time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime()),
+                                         'UT Time stamp for GSTRANSFORM')
+        hdulist.writeto('t' + frame)
+
+# Wavelength solutions of the arcs are kept in the calibration library by
+# their settings, grating and slit. A new arc with the same settings is
+# cross-correlated with the arc of the library solution. If they match,
+# the solution is shifted to the new arc, its lines are centered again
+# and only the zero point and the slope of the solution are fitted to
+# them, instead of identifying the lines again with gswavelength.
+arc_correlation_limit = 0.8
+# Half width, in pixels, of the window where the lines are centered.
+arc_window = 3
+
+def solution_key(arc):
+    """ Library key of the wavelength solutions of the arcs with the same
+        settings, grating and slit as 'arc'. """
+
+    key = master_key('arc_solution', [arc])
+    if key is None:
+        return None
+    frame = select_frames(name=arc)[0]
+    key['inputs'] = json.dumps([frame['Grating'], frame['Mask']])
+
+    return key
+
+def collapsed_arc(reduced):
+    """ Spectrum of the central third of the rows of a reduced arc. """
+
+    with opened_fits(reduced) as hdulist:
+        data = hdulist['SCI'].data
+        spectrum = np.median(data[data.shape[0]//3:2*data.shape[0]//3], axis=0)
+
+    return spectrum
+
+def arc_shift(reference, spectrum):
+    """ Shift, in pixels, of 'spectrum' from 'reference' and their
+        correlation coefficient at that shift, from the FFT of their cross
+        correlation. """
+
+    a = reference - np.median(reference)
+    b = spectrum - np.median(spectrum)
+    n = len(a)
+    correlation = np.fft.irfft(np.conj(np.fft.rfft(a, 2*n))*np.fft.rfft(b, 2*n), 2*n)
+    peak = np.argmax(correlation)
+    # Sub-pixel position of the peak, from a parabola through it.
+    left, right = correlation[peak - 1], correlation[(peak + 1) % (2*n)]
+    curvature = left - 2*correlation[peak] + right
+    offset = 0.5*(left - right)/curvature if curvature != 0 else 0.0
+    shift = peak + offset
+    if shift > n:
+        shift -= 2*n
+
+    return shift, correlation[peak]/np.sqrt(np.sum(a**2)*np.sum(b**2))
+
+def line_centers(spectrum, guesses):
+    """ Centroids of the lines of 'spectrum' around the pixel positions
+        'guesses', or NaN where the window leaves the spectrum. """
+
+    window = np.round(guesses).astype(int)[:, None] + np.arange(-arc_window, arc_window + 1)
+    inside = (window[:, 0] >= 1) & (window[:, -1] <= len(spectrum))
+    window = np.clip(window, 1, len(spectrum))
+    counts = spectrum[window - 1]
+    counts = counts - counts.min(axis=1)[:, None]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        centers = np.sum(counts*window, axis=1)/np.sum(counts, axis=1)
+    centers[~inside] = np.nan
+
+    return centers
+
+def shift_arc_solution(arc):
+    """ Make the wavelength solution of the reduced 'arc' from the library
+        solution of an arc with the same settings. Returns False, leaving
+        no solution, when there is none or the arcs do not match. """
+
+    path = find_master(solution_key(arc))
+    if path is None:
+        return False
+    reference = np.load(path)
+
+    reduced = 'gs{}'.format(arc)
+    spectrum = collapsed_arc(reduced)
+    if reference['spectrum'].shape != spectrum.shape:
+        return False
+    shift, correlation = arc_shift(reference['spectrum'], spectrum)
+    if correlation < arc_correlation_limit:
+        print('The arc {} does not match the library solution {} (correlation {:.2f}).'.format(
+                arc, path, correlation))
+        return False
+
+    # Database files of the new arc, with the names of the arc changed.
+    name = reduced.replace('.fits','')
+    identify = 'database/id{}_001'.format(name)
+    fitcoords = 'database/fc{}_001'.format(name)
+    for kind, filename in (('identify', identify), ('fitcoords', fitcoords)):
+        f = open(filename, 'w')
+        f.write(str(reference[kind]).replace(str(reference['name']), name))
+        f.close()
+
+    # Center the lines of each block, moved by the shift, on the rows of
+    # the new arc.
+    with opened_fits(reduced) as hdulist:
+        data = hdulist['SCI'].data
+        blocks = []
+        for block in read_database(identify):
+            block = collections.OrderedDict(block)
+            features = block['features'].copy()
+            row = int(block['image'].rpartition(',')[2].rstrip(']'))
+            rows = data[max(row - 1 - arc_window, 0):row + arc_window]
+            centers = line_centers(rows.mean(axis=0), features['pixel'] + shift)
+            lost = np.isnan(centers)
+            features['pixel'] = np.where(lost, features['pixel'] + shift, centers)
+            features['flag'][lost] = 0
+            block['features'] = features
+            blocks.append(block)
+
+    # Zero point and slope of the difference of the identified wavelengths
+    # and of the shifted solution.
+    pixels = np.concatenate([block['features']['pixel'] for block in blocks])
+    used = np.concatenate([block['features']['flag'] for block in blocks]) == 1
+    delta = np.concatenate([block['features']['identified']
+                            - dispersion_values(block['coefficients'], block['features']['pixel'] - shift)
+                            for block in blocks])
+    if used.sum() < 2:
+        return False
+    slope, zero = np.polyfit(pixels[used], delta[used], 1)
+
+    def shifted(values, x):
+        return values(x - shift) + zero + slope*x
+
+    # Fit the dispersion functions and the fitcoords surface, with their
+    # orders, to the shifted solutions.
+    x = np.linspace(1, spectrum.size, 4*spectrum.size)
+    for block in blocks:
+        coefficients = block['coefficients']
+        function, order = int(coefficients[0]), int(coefficients[1])
+        target = shifted(lambda values: dispersion_values(coefficients, values), x)
+        basis = polynomial_basis(function, x, coefficients[2], coefficients[3], order)
+        block['coefficients'] = np.concatenate([coefficients[:4],
+                                                np.linalg.lstsq(basis, target, rcond=-1)[0]])
+        block['features']['fitted'] = dispersion_values(block['coefficients'],
+                                                        block['features']['pixel'])
+    write_database(identify, blocks)
+
+    surfaces = []
+    y = np.linspace(1, data.shape[0], 50)
+    for block in read_database(fitcoords):
+        block = collections.OrderedDict(block)
+        surface = block['surface']
+        function, xorder, yorder = [int(value) for value in surface[:3]]
+        target = shifted(lambda values: surface_values(surface, values, y), x[::8])
+        bx = polynomial_basis(function, x[::8], surface[4], surface[5], xorder)
+        by = polynomial_basis(function, y, surface[6], surface[7], yorder)
+        basis = np.column_stack([np.outer(by[:, j], bx[:, i]).ravel()
+                                 for j, terms in enumerate(surface_terms(surface))
+                                 for i in range(terms)])
+        block['surface'] = np.concatenate([surface[:8],
+                                           np.linalg.lstsq(basis, target.ravel(), rcond=-1)[0]])
+        surfaces.append(block)
+    write_database(fitcoords, surfaces)
+
+    problem = wavelength_problem(wavelength_qa(read_database(identify)))
+    if problem is not None:
+        print('The shifted library solution {} has {}.'.format(path, problem))
+        os.remove(identify)
+        os.remove(fitcoords)
+        return False
+
+    print('Using the library solution {}, shifted by {:.2f} pixels.'.format(path, shift))
+    return True
+
+def store_arc_solution(arc):
+    """ Add the wavelength solution of the reduced 'arc' to the library. """
+
+    key = solution_key(arc)
+    if key is None:
+        return
+
+    reduced = 'gs{}'.format(arc)
+    name = reduced.replace('.fits','')
+    texts = {}
+    for kind, prefix in (('identify', 'id'), ('fitcoords', 'fc')):
+        f = open('database/{}{}_001'.format(prefix, name), 'r')
+        texts[kind] = f.read()
+        f.close()
+    filename = 'database/ref{}.npz'.format(name)
+    np.savez(filename, spectrum=collapsed_arc(reduced), name=name, **texts)
+    store_master(key, filename)
+
+# Combination of the bias frames into the Master Bias, in place of gbias.
+# Each amplifier is overscan corrected, trimmed and combined in a thread
+# of its own, reading the frames a block of rows at a time from their
+# memory-mapped files, so the memory used does not grow with the number
+# of frames. Pixels more than 'combine_clip' standard deviations from
+# the mean of the stack are rejected, as with the avsigclip rejection of
+# gemcombine.
+combine_method = 'average'
+combine_clip = 3.0
+combine_iterations = 3
+# Memory, in bytes, of the blocks of rows of one amplifier.
+combine_memory = 64*1024**2
+# Order of the fit of the overscan level along the rows, and number of
+# overscan columns next to the data that are left out, as in gireduce.
+overscan_order = 1
+overscan_contamination = 4
+
+def section_slices(section):
+    """ Row and column slices of a FITS section such as '[33:544,1:2112]'. """
+
+    columns, rows = section.strip('[]').split(',')
+    x1, x2 = [int(value) for value in columns.split(':')]
+    y1, y2 = [int(value) for value in rows.split(':')]
+
+    return slice(y1 - 1, y2), slice(x1 - 1, x2)
+
+def overscan_levels(hdu, chunk):
+    """ Overscan level of each row of a raw amplifier, fitted along the
+        rows with a Chebyshev polynomial of 'overscan_order' terms. The
+        rows are read 'chunk' rows at a time. """
+
+    rows, columns = section_slices(hdu.header['BIASSEC'])
+    data_columns = section_slices(hdu.header['DATASEC'])[1]
+    # Leave out the columns next to the data.
+    if columns.stop <= data_columns.start:
+        columns = slice(columns.start, columns.stop - overscan_contamination)
+    else:
+        columns = slice(columns.start + overscan_contamination, columns.stop)
+    # Whole rows are read at once, which is faster than reading the
+    # columns of each row.
+    level = np.concatenate([np.median(hdu.section[start:min(start + chunk, rows.stop)][:, columns], axis=1)
+                            for start in range(rows.start, rows.stop, chunk)])
+    y = np.arange(len(level))
+    fit = np.polynomial.chebyshev.Chebyshev.fit(y, level, overscan_order - 1)
+
+    return fit(y)
+
+def combine_stack(stack):
+    """ Combine a stack of frames along its first axis, rejecting the
+        outliers. Returns the combined frame and the number of frames
+        kept at each pixel. """
+
+    if combine_method == 'median':
+        return np.median(stack, axis=0), np.full(stack.shape[1:], len(stack))
+    # Stacks too small to clip are averaged.
+    if len(stack) < 3:
+        return np.mean(stack, axis=0), np.full(stack.shape[1:], len(stack))
+
+    # The first rejection is around the median, with the standard
+    # deviation estimated from the median absolute deviation, so a single
+    # outlier of a small stack does not hide itself.
+    keep = np.ones(stack.shape, dtype=bool)
+    center = np.median(stack, axis=0)
+    sigma = 1.4826*np.median(np.abs(stack - center), axis=0)
+    for i in range(combine_iterations):
+        count = keep.sum(axis=0)
+        if i > 0 or not sigma.all():
+            deviation = np.where(keep, stack - center, 0.0)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                std = np.sqrt(np.sum(deviation**2, axis=0)/np.maximum(count - 1, 1))
+            sigma = std if i > 0 else np.where(sigma > 0, sigma, std)
+        clipped = np.abs(stack - center) <= combine_clip*sigma
+        if np.array_equal(clipped, keep):
+            break
+        keep = clipped
+        count = keep.sum(axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            center = np.sum(np.where(keep, stack, 0.0), axis=0)/count
+
+    count = keep.sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.sum(np.where(keep, stack, 0.0), axis=0)/count, count
+
+def combine_amplifier(job):
+    """ Overscan correct, trim and combine one amplifier of the raw files
+        'paths'. Returns its SCI, VAR and DQ data and its header. """
+
+    paths, extension = job
+    # The files are memory mapped, and only the rows of each block are
+    # read and scaled to unsigned integers.
+    hdulists = [open_fits(path, uint=True) for path in paths]
+    try:
+        hdus = [hdulist[extension] for hdulist in hdulists]
+        header = hdus[0].header.copy()
+        # The raw integer data were scaled.
+        for keyword in ('BZERO', 'BSCALE'):
+            if keyword in header:
+                del header[keyword]
+        rows, columns = section_slices(header['DATASEC'])
+        ny, nx = rows.stop - rows.start, columns.stop - columns.start
+        sci = np.empty((ny, nx), dtype=np.float32)
+        count = np.empty((ny, nx), dtype=np.int16)
+        chunk = max(1, combine_memory//(8*len(paths)*header['NAXIS1']))
+        levels = [overscan_levels(hdu, chunk) for hdu in hdus]
+        for start in range(0, ny, chunk):
+            stop = min(start + chunk, ny)
+            stack = np.array([hdu.section[rows.start + start:rows.start + stop][:, columns]
+                              - level[rows.start + start:rows.start + stop, None]
+                              for hdu, level in zip(hdus, levels)], dtype=float)
+            sci[start:stop], count[start:stop] = combine_stack(stack)
+    finally:
+        for hdulist in hdulists:
+            close_fits(hdulist)
+
+    # Read noise of the mean of the frames kept, in ADU.
+    noise = header.get('RDNOISE', 0.0)/header.get('GAIN', 1.0)
+    with np.errstate(divide='ignore'):
+        var = np.where(count > 0, noise**2/count, 0.0).astype(np.float32)
+    dq = (count == 0).astype(np.int16)
+    sci[count == 0] = 0.0
+
+    header['OVERSCAN'] = (float(np.mean(levels)), 'Overscan mean value')
+    header['OVERSEC'] = header['BIASSEC']
+    header['TRIMSEC'] = header['DATASEC']
+    header['TRIMMED'] = 'yes'
+    header['DATASEC'] = '[1:{},1:{}]'.format(nx, ny)
+    header['NCOMBINE'] = len(paths)
+
+    return sci, var, dq, header
+
+def combine_biases(names, output):
+    """ Make the Master Bias 'output', with SCI, VAR and DQ extensions,
+        from the raw bias frames 'names'. """
+
+    if os.path.exists(output):
+        os.remove(output)
+
+    paths = [os.path.join(raw_path, name) for name in names]
+    with opened_fits(paths[0]) as first:
+        phu = first[0].header.copy()
+        extensions = [i for i, hdu in enumerate(first) if i > 0
+                      and hdu.header.get('EXTNAME', 'SCI') == 'SCI']
+    jobs = [(paths, extension) for extension in extensions]
+
+    pool = multiprocessing.pool.ThreadPool(max(1, min(frame_processes, len(jobs))))
+    amplifiers = pool.map(combine_amplifier, jobs)
+    pool.close()
+    pool.join()
+
+    stamp = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime())
+    for keyword in ('GPREPARE', 'GIREDUCE', 'GEMCOMB', 'GBIAS'):
+        phu[keyword] = (stamp, 'UT Time stamp for {}'.format(keyword))
+    phu['NCOMBINE'] = len(names)
+    phu['NSCIEXT'] = len(amplifiers)
+    phu['NEXTEND'] = 3*len(amplifiers)
+    hdulist = fits.HDUList([fits.PrimaryHDU(header=phu)])
+    # The SCI, VAR and DQ extensions of each amplifier in turn, as gbias
+    # writes them.
+    for i, amplifier in enumerate(amplifiers):
+        for plane, name in ((0, 'SCI'), (1, 'VAR'), (2, 'DQ')):
+            header = amplifier[3].copy()
+            header['EXTNAME'] = name
+            header['EXTVER'] = i + 1
+            hdulist.append(fits.ImageHDU(data=amplifier[plane], header=header))
+    hdulist.writeto(output)
+
+# Master Flat from the mosaicked flat frames, in place of gsflat. The
+# frames are scaled to the same level and combined as the bias frames,
+# and the combined flat is divided by its spectral response: a Chebyshev
+# polynomial of 'flat_order' terms along the dispersion axis, fitted to
+# all the rows in one least-squares solve. Pixels where the response is
+# below 'flat_threshold' times its median, as the chip gaps and the rows
+# outside the slit, are set to 1.
+flat_order = 29
+flat_threshold = 0.05
+
+def build_flat(names, output):
+    """ Make the normalized Master Flat 'output' from the mosaicked flat
+        frames 'names', keeping the extensions of the first frame. """
+
+    if os.path.exists(output):
+        os.remove(output)
+
+    hdulists = [open_fits(name) for name in names]
+    try:
+        # Variance planes are combined if all the frames have them.
+        planes = set(hdu.name for hdu in hdulists[0])
+        for hdulist in hdulists[1:]:
+            planes &= set(hdu.name for hdu in hdulist)
+        first = hdulists[0]
+        ny, nx = first['SCI'].header['NAXIS2'], first['SCI'].header['NAXIS1']
+
+        # Level of each frame, from the illuminated pixels of its central rows.
+        scales = []
+        for hdulist in hdulists:
+            center = hdulist['SCI'].section[ny//2 - ny//20:ny//2 + ny//20 + 1]
+            scales.append(np.median(center[center > 0]))
+
+        combined = np.empty((ny, nx), dtype=np.float32)
+        var = np.zeros((ny, nx), dtype=np.float32)
+        count = np.empty((ny, nx), dtype=np.int16)
+        chunk = max(1, combine_memory//(8*len(names)*nx))
+        for start in range(0, ny, chunk):
+            stop = min(start + chunk, ny)
+            stack = np.array([hdulist['SCI'].section[start:stop]/scale
+                              for hdulist, scale in zip(hdulists, scales)], dtype=float)
+            combined[start:stop], count[start:stop] = combine_stack(stack)
+            if 'VAR' in planes:
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    var[start:stop] = np.mean([hdulist['VAR'].section[start:stop]/scale**2
+                                               for hdulist, scale in zip(hdulists, scales)],
+                                              axis=0)/count[start:stop]
+
+        # Fit the response of every row to the illuminated columns.
+        profile = np.median(combined, axis=0)
+        columns = profile > flat_threshold*np.median(profile[profile > 0])
+        basis = polynomial_basis(1, np.arange(nx), 0, nx - 1, flat_order)
+        coefficients = np.linalg.lstsq(basis[columns], combined[:, columns].T, rcond=-1)[0]
+        response = basis.dot(coefficients).T
+        illuminated = response > flat_threshold*np.median(response[:, columns])
+        illuminated &= columns
+        with np.errstate(invalid='ignore', divide='ignore'):
+            flat = np.where(illuminated, combined/response, 1.0).astype(np.float32)
+            var = np.where(illuminated, var/response**2, 0.0).astype(np.float32)
+
+        phu = first[0].header.copy()
+        phu['GSFLAT'] = (time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime()), 'UT Time stamp for GSFLAT')
+        phu['NCOMBINE'] = len(names)
+        hdulist = fits.HDUList([fits.PrimaryHDU(header=phu)])
+        for hdu in first[1:]:
+            if hdu.name == 'SCI':
+                hdulist.append(fits.ImageHDU(data=flat, header=hdu.header))
+            elif hdu.name == 'VAR':
+                if 'VAR' in planes:
+                    hdulist.append(fits.ImageHDU(data=var, header=hdu.header))
+            elif hdu.name == 'DQ':
+                hdulist.append(fits.ImageHDU(data=(count == 0).astype(np.int16), header=hdu.header))
+            else:
+                hdulist.append(hdu.copy())
+        hdulist.writeto(output)
+    finally:
+        for hdulist in hdulists:
+            close_fits(hdulist)
+
+# Bad columns. The profile of a frame is its median along the illuminated
+# rows. A bad column starts and ends with a step of the profile from one
+# column to the next which is larger than 'badcolumn_sigma' times the
+# noise of the steps, and which changes the profile by 'badcolumn_depth'
+# more than the step next to it outside the range. The sky lines change
+# the profile by similar amounts from column to column. Low ranges are
+# bad columns up to 'badcolumn_width' columns wide and high ranges up to
+# 'hot_column_width'.
+badcolumn_sigma = 8.0
+badcolumn_depth = 0.3
+badcolumn_width = 10
+hot_column_width = 2
+
+def detect_bad_columns(data):
+    """ Ranges of bad columns of a frame, as the first and last column
+        of each range, counted from 1. """
+
+    levels = np.median(data, axis=1)
+    if not (levels > 0).any():
+        return []
+    profile = np.median(data[levels > 0.5*np.median(levels[levels > 0])], axis=0)
+
+    # Steps between neighbouring columns, leaving out the chip gaps, where
+    # the profile is 0.
+    step = profile[1:] - profile[:-1]
+    valid = (profile[1:] > 0) & (profile[:-1] > 0)
+    if not valid.any():
+        return []
+    noise = 1.4826*np.median(np.abs(step[valid] - np.median(step[valid])))
+    sharp = valid & (np.abs(step) > badcolumn_sigma*noise)
+    ratio = np.where(valid, profile[1:]/np.where(valid, profile[:-1], 1), 1)
+    before = np.concatenate([[1], ratio[:-1]])
+    after = np.concatenate([ratio[1:], [1]])
+    scale = 1 - badcolumn_depth
+    low = (sharp & (ratio < scale*np.minimum(1, before)),
+           sharp & (ratio > np.maximum(1, after)/scale))
+    high = (sharp & (ratio > np.maximum(1, before)/scale),
+            sharp & (ratio < scale*np.minimum(1, after)))
+
+    # Each step into a range is paired with the next step out of it, and
+    # a step is used by one range only.
+    columns = []
+    used = np.zeros(len(step), dtype=bool)
+    for (entries, exits), width in ((low, badcolumn_width), (high, hot_column_width)):
+        ends = np.flatnonzero(exits)
+        for start in np.flatnonzero(entries):
+            end = ends[np.searchsorted(ends, start + 1):][:1]
+            if len(end) == 0 or end[0] - start > width or used[start:end[0] + 1].any():
+                continue
+            # A bad column scales the profile by about the same factor
+            # across the range, unlike the gap between two sky lines.
+            chord = np.interp(np.arange(start + 1, end[0] + 1), [start, end[0] + 1],
+                              [profile[start], profile[end[0] + 1]])
+            factor = profile[start + 1:end[0] + 1]/chord
+            if factor.max() - factor.min() > badcolumn_depth:
+                continue
+            used[start:end[0] + 1] = True
+            columns.append((int(start) + 2, int(end[0]) + 1))
+
+    return sorted(columns)
+
+def read_bad_columns(path):
+    """ Ranges of bad pixels of the mask text file 'path', as the first
+        and last column and the first and last row of each range. """
+
+    ranges = []
+    if os.path.exists(path):
+        for line in open(path):
+            words = line.split()
+            if len(words) >= 4:
+                ranges.append(tuple(int(word) for word in words[:4]))
+
+    return ranges
+
+def add_bad_columns(path, columns, ny):
+    """ Add the ranges of bad columns 'columns' that are not in the mask
+        text file 'path' yet, as 'x1 x2 1 ny' lines. """
+
+    known = set(line[:2] for line in read_bad_columns(path))
+
+    f = open(path, 'a')
+    for x1, x2 in columns:
+        if (x1, x2) not in known:
+            f.write('{} {} 1 {}\n'.format(x1, x2, ny))
+            known.add((x1, x2))
+    f.close()
+
+def mask_columns(mask, ranges):
+    """ Flag in the boolean 'mask' the ranges of bad columns, given as
+        (x1, x2) or (x1, x2, y1, y2) and counted from 1. """
+
+    for columns in ranges:
+        x1, x2 = columns[:2]
+        y1, y2 = columns[2:] if len(columns) == 4 else (1, mask.shape[0])
+        mask[max(y1 - 1, 0):y2, max(x1 - 1, 0):x2] = True
+
+# Bad column masks are kept in the calibration library by detector, binning
+# and region of interest, as boolean images of the mosaicked frames. Each
+# reduction starts from the mask of its settings, unless it is refused for
+# that reduction. The columns checked or given by hand are merged into the
+# mask at once. The columns only found by the pipeline are kept as
+# candidates, in a second image of the same file, and merged into the mask
+# when they are found again in another frame, so a single false detection
+# does not reach the later reductions.
+
+def mask_key(name):
+    """ Library key of the bad column mask of the raw file 'name'. """
+
+    key = master_key('badcolumn_mask', [name])
+    if key is None:
+        return None
+    # The mosaicked frames have the same columns at all central
+    # wavelengths.
+    key['CentWave'] = None
+    key['inputs'] = json.dumps([])
+
+    return key
+
+def library_mask(key, shape):
+    """ Bad column mask of the library matching 'key', or an empty mask
+        if there is none, of the given shape. """
+
+    mask = np.zeros(shape, dtype=bool)
+    path = find_master(key)
+    if path is not None:
+        f = np.load(path)
+        if f['mask'].shape == mask.shape:
+            mask |= f['mask']
+        f.close()
+
+    return mask
+
+def merge_columns(key, shape, columns, checked=True):
+    """ Add the bad columns 'columns', as given to 'mask_columns', to the
+        mask of the library matching 'key', of the given shape. Columns
+        that were not 'checked' are only added once they were found
+        before. """
+
+    if key is None or not columns:
+        return
+
+    name = master_name(key, 'mask.npz')
+    library = open_library()
+    # The standard star and the science object can update the same mask
+    # at once, so the library is locked while the mask is read and
+    # written again. Closing the library without the commit unlocks it.
+    library.isolation_level = None
+    library.execute('BEGIN IMMEDIATE')
+    try:
+        merged = library_mask(key, shape)
+        candidates = np.zeros(shape, dtype=bool)
+        path = find_master(key)
+        if path is not None:
+            f = np.load(path)
+            if 'candidates' in f and f['candidates'].shape == shape:
+                candidates |= f['candidates']
+            f.close()
+        found = np.zeros(shape, dtype=bool)
+        mask_columns(found, columns)
+        if checked:
+            merged |= found
+        else:
+            merged |= found & candidates
+            candidates |= found
+        candidates &= ~merged
+        temporary = '{}.{}.npz'.format(library_path + name, os.getpid())
+        np.savez_compressed(temporary, mask=merged, candidates=candidates)
+        os.rename(temporary, library_path + name)
+        index_master(library, key, name)
+        library.execute('COMMIT')
+    finally:
+        library.close()
+
+# Interpolation of the bad pixels, in place of fixpix. Each bad pixel is
+# interpolated along its row, between the nearest good pixels on each side,
+# or takes the value of the only one there is. The pairs of good pixels
+# and their weights are found once for a mask and applied to the SCI, VAR
+# and DQ extensions, as the rectification operators are.
+
+def interpolation_pairs(mask):
+    """ Rows and columns of the bad pixels of the boolean 'mask' that can
+        be interpolated, the columns of the good pixels before and after
+        each of them and the weight of the one after. """
+
+    nx = mask.shape[1]
+    columns = np.arange(nx, dtype=np.int32)
+    before = np.maximum.accumulate(np.where(mask, -1, columns), axis=1)
+    after = np.minimum.accumulate(np.where(mask, nx, columns)[:, ::-1], axis=1)[:, ::-1]
+
+    y, x = np.nonzero(mask & ((before >= 0) | (after < nx)))
+    before = before[y, x]
+    after = after[y, x]
+    before = np.where(before >= 0, before, after)
+    after = np.where(after < nx, after, before)
+    span = after - before
+    weight = np.where(span > 0, (x - before)/np.maximum(span, 1).astype(float), 0.0)
+
+    return {'y':y, 'x':x, 'before':before, 'after':after, 'weight':weight}
+
+def interpolate_pixels(pairs, data, plane):
+    """ Interpolate the bad pixels of 'pairs' in the data of a SCI, VAR
+        or DQ extension, in place. """
+
+    y = pairs['y']
+    first = data[y, pairs['before']]
+    second = data[y, pairs['after']]
+    weight = pairs['weight']
+    if plane == 'DQ':
+        data[y, pairs['x']] = first | second
+    elif plane == 'VAR':
+        data[y, pairs['x']] = first*(1 - weight)**2 + second*weight**2
+    else:
+        data[y, pairs['x']] = first*(1 - weight) + second*weight
+
+def interpolate_bad_columns(frame, mask, output):
+    """ Interpolate the pixels of the boolean 'mask' in the SCI, VAR and
+        DQ extensions of 'frame' and write them to 'output'. """
+
+    if os.path.exists(output):
+        os.remove(output)
+
+    pairs = interpolation_pairs(mask)
+    with opened_fits(frame) as hdulist:
+        for hdu in hdulist[1:]:
+            if hdu.header.get('EXTNAME') in ('SCI', 'VAR', 'DQ') and hdu.data.shape == mask.shape:
+                interpolate_pixels(pairs, hdu.data, hdu.header['EXTNAME'])
+        hdulist.writeto(output)
+
+# Cosmic ray rejection, as an alternative to the cosmic ray cleaning of
+# gsreduce (fl_crspec) and gemfix, with the Laplacian edge detection of L.A.Cosmic
+# (van Dokkum 2001, PASP 113, 1420). Cosmic rays are sharper than the
+# spectra and the sky lines, so they stand out in the Laplacian of the
+# frame divided by its noise, taken from the VAR extension. Pixels above
+# 'cosmic_clip' times the noise, and 'cosmic_contrast' times the fine
+# structure of the frame, are cosmic rays, and so are their neighbours
+# above 'cosmic_fraction' of the limit. The cosmic rays are replaced by
+# the median of the good pixels around them and the search is repeated,
+# up to 'cosmic_iterations' times. Each amplifier is cut in tiles of
+# 'cosmic_tile' pixels, processed in parallel with a margin of
+# 'cosmic_margin' pixels around them. It is used when 'cosmic_method' is
+# set to 'native' in the manifest; by default gsreduce and gemfix clean
+# the cosmic rays.
+cosmic_method = 'gemfix'
+if answers is not None and 'cosmic_method' in answers:
+    cosmic_method = answers['cosmic_method']
+cosmic_clip = 4.5
+cosmic_fraction = 0.3
+cosmic_contrast = 5.0
+cosmic_iterations = 4
+cosmic_tile = 256
+cosmic_margin = 16
+# DQ value of the cosmic rays, the bit masked by gemfix.
+cosmic_ray = 8
+
+def median_filter(data, size):
+    """ Median of the 'size' by 'size' box around each pixel of 'data',
+        with the edges reflected. """
+
+    half = size//2
+    padded = np.pad(data, half, mode='reflect')
+    windows = np.lib.stride_tricks.as_strided(
+        padded, shape=data.shape + (size, size), strides=padded.strides*2)
+    windows = windows.reshape(data.shape + (size*size,))
+
+    return np.partition(windows, size*size//2, axis=-1)[..., size*size//2]
+
+def grow_mask(mask):
+    """ Mask with the 8 neighbours of every pixel of 'mask' added. """
+
+    padded = np.pad(mask, 1, mode='constant')
+    grown = mask.copy()
+    ny, nx = mask.shape
+    for dy in range(3):
+        for dx in range(3):
+            grown |= padded[dy:dy + ny, dx:dx + nx]
+
+    return grown
+
+def replace_masked(data, mask, size=5):
+    """ Replace the pixels of 'mask' in 'data', in place, with the median
+        of the pixels outside the mask in the 'size' by 'size' box around
+        them. Pixels with no good neighbour are left as they are. """
+
+    y, x = np.nonzero(mask)
+    if len(y) == 0:
+        return
+    half = size//2
+    offsets = np.arange(-half, half + 1)
+    ys = np.clip(y[:, None, None] + offsets[None, :, None], 0, data.shape[0] - 1)
+    xs = np.clip(x[:, None, None] + offsets[None, None, :], 0, data.shape[1] - 1)
+    values = np.where(mask[ys, xs], np.inf, data[ys, xs]).reshape(len(y), -1)
+    count = np.isfinite(values).sum(axis=1)
+    median = np.sort(values, axis=1)[np.arange(len(y)), np.maximum(count - 1, 0)//2]
+    data[y[count > 0], x[count > 0]] = median[count > 0]
+
+def find_cosmic_rays(data, variance):
+    """ Boolean mask of the cosmic rays of a SCI array, with its VAR
+        array. """
+
+    clean = data.astype(np.float32)
+    noise = np.sqrt(np.maximum(median_filter(variance.astype(np.float32), 5), 1e-6))
+    mask = np.zeros(data.shape, dtype=bool)
+    ny, nx = data.shape
+    for iteration in range(cosmic_iterations):
+        # Positive Laplacian of the frame sampled twice as finely, binned
+        # back to the pixels of the frame.
+        fine = np.pad(np.repeat(np.repeat(clean, 2, axis=0), 2, axis=1), 1, mode='edge')
+        laplacian = (4*fine[1:-1, 1:-1] - fine[:-2, 1:-1] - fine[2:, 1:-1]
+                     - fine[1:-1, :-2] - fine[1:-1, 2:])
+        laplacian = np.maximum(laplacian, 0).reshape(ny, 2, nx, 2).mean(axis=(1, 3))
+
+        significance = laplacian/(2*noise)
+        significance -= median_filter(significance, 5)
+        smooth = median_filter(clean, 3)
+        structure = np.maximum((smooth - median_filter(smooth, 7))/noise, 0.01)
+
+        found = (significance > cosmic_clip) & (significance/structure > cosmic_contrast)
+        found = grow_mask(found) & (significance > cosmic_clip)
+        found = grow_mask(found) & (significance > cosmic_fraction*cosmic_clip)
+        found &= ~mask
+        if not found.any():
+            break
+        mask |= found
+        replace_masked(clean, mask)
+
+    return mask
+
+def cosmic_ray_tile(job):
+    """ Mask of the cosmic rays of a tile of an amplifier. 'job' is the
+        SCI and VAR arrays of the amplifier and the rows and columns of
+        the tile. """
+
+    data, variance, rows, columns = job
+    # The tile is searched with a margin, so the filters see the same
+    # pixels as in the whole amplifier.
+    y1 = max(rows.start - cosmic_margin, 0)
+    y2 = min(rows.stop + cosmic_margin, data.shape[0])
+    x1 = max(columns.start - cosmic_margin, 0)
+    x2 = min(columns.stop + cosmic_margin, data.shape[1])
+    mask = find_cosmic_rays(data[y1:y2, x1:x2], variance[y1:y2, x1:x2])
+
+    return mask[rows.start - y1:rows.stop - y1, columns.start - x1:columns.stop - x1]
+
+def clean_cosmic_rays(frame, output):
+    """ Find the cosmic rays of the SCI extensions of 'frame', replace
+        them in SCI and VAR, flag them in DQ and write the frame to
+        'output'. Returns the number of pixels flagged. """
+
+    if os.path.exists(output):
+        os.remove(output)
+
+    with opened_fits(frame) as hdulist:
+        amplifiers = []
+        jobs = []
+        for hdu in hdulist[1:]:
+            if hdu.header.get('EXTNAME') != 'SCI':
+                continue
+            version = hdu.header.get('EXTVER', 1)
+            amplifier = [hdu, hdulist['VAR', version], hdulist['DQ', version], []]
+            ny, nx = hdu.data.shape
+            for y in range(0, ny, cosmic_tile):
+                for x in range(0, nx, cosmic_tile):
+                    tile = (slice(y, min(y + cosmic_tile, ny)), slice(x, min(x + cosmic_tile, nx)))
+                    amplifier[3].append(tile)
+                    jobs.append((hdu.data, amplifier[1].data) + tile)
+            amplifiers.append(amplifier)
+
+        pool = multiprocessing.pool.ThreadPool(max(1, min(frame_processes, len(jobs))))
+        masks = iter(pool.map(cosmic_ray_tile, jobs))
+        pool.close()
+        pool.join()
+
+        flagged = 0
+        for sci, var, dq, tiles in amplifiers:
+            mask = np.zeros(sci.data.shape, dtype=bool)
+            for tile in tiles:
+                mask[tile] = next(masks)
+            replace_masked(sci.data, mask)
+            replace_masked(var.data, mask)
+            dq.data[mask] |= cosmic_ray
+            flagged += int(mask.sum())
+
+        hdulist.writeto(output)
+
+    return flagged
+
 def std_gbias():
     """ Apply overscan correction and trim individual bias frames.
         Create Master Bias. Plot Master Bias and pixel counting. """
@@ -742,74 +2778,29 @@ def std_gbias():
     if os.path.exists('Bias_std.fits'):
         os.remove('Bias_std.fits')
 
-    gmos.gbias.unlearn() # Debug gbias.
-    # Set the task parameters.
-    biasFlags = {'rawpath':'raw', 'fl_over':'yes',
-                'fl_trim':'yes', 'fl_vardq':'yes'}
-    # Create Master Bias.
-    gmos.gbias('@bias_std.txt', 'Bias_std.fits', **biasFlags) # IRAF task gbias.
+    # Take the Master Bias from the calibration library if it was
+    # already made from the same bias frames.
+    biases = [bias.replace('\n','') for bias in open('bias_std.txt')]
+    bias_key = master_key('bias', biases, method='native')
+    with library_lock(bias_key):
+        if not fetch_master(bias_key, 'Bias_std.fits'):
+            # Create Master Bias.
+            combine_biases(biases, 'Bias_std.fits')
+            store_master(bias_key, 'Bias_std.fits')
 
     # Load Master Bias.
-    obj=fits.open('Bias_std.fits')
-    obj_data = obj[2].data
+    obj=open_fits('Bias_std.fits')
+    obj_data = obj['SCI', 1].data
     obj_shape = obj_data.shape
 
     # Print Master Bias.
-    fig = plt.figure(figsize=(14.0,4.0))
-    for i in range(len(np.arange(0,12,1))):
-        ax = plt.subplot(1, 12,i+1)
-        plt.imshow(obj[i+1].data, origin='lower',cmap='afmhot',
-                   vmin=np.percentile(obj[i+1].data,5),
-                   vmax=np.percentile(obj[i+1].data,90), aspect='auto')
-        if i == 0:
-            ax.yaxis.set_visible(True)
-            ax.set_ylabel('Position Along Slit', fontsize=14)
-        else:
-            ax.yaxis.set_visible(False)
-    plt.tight_layout(w_pad=-0.9)
-    plt.suptitle('Master BIAS', y=1.0, fontsize=14)
-    plt.savefig('master-bias-std-{}.png'.format(obj_std_name[0]))
-
-    plt.show()
-    plt.clf()
-    plt.close()
+    show_figure(plot_images, {'images':[[qa_image(obj, ('SCI', i+1)) for i in range(12)]],
+                              'figsize':(14.0,4.0), 'title':'Master BIAS'},
+                'master-bias-std-{}.png'.format(obj_std_name[0]))
 
     # Print the pixel counting through a line cut.
-    plt.figure(figsize=(16.0,8.0))
-    for j in range(len(np.arange(0,12,1))):
-        ax1 = plt.subplot(3, 12,j+1)
-        ax1.set_ylim(min(obj[1].data[int(0.3*obj_shape[0]),1:obj_shape[1]]),
-                        max(obj[1].data[int(0.3*obj_shape[0]),1:obj_shape[1]]))
-        ax1.plot(np.arange(1,obj_shape[1],1),
-                    obj[j+1].data[int(0.3*obj_shape[0]),1:obj_shape[1]],linewidth=0.5)
-
-        ax2 = plt.subplot(3, 12,12+j+1)
-        ax2.set_ylim(min(obj[1].data[int(0.5*obj_shape[0]),1:obj_shape[1]]),
-                        max(obj[1].data[int(0.5*obj_shape[0]),1:obj_shape[1]]))
-        ax2.plot(np.arange(1,obj_shape[1],1),
-                    obj[j+1].data[int(0.5*obj_shape[0]),1:obj_shape[1]],linewidth=0.5)
-
-        ax3 = plt.subplot(3, 12, 24+j+1)
-        ax3.set_ylim(min(obj[1].data[int(0.7*obj_shape[0]),1:obj_shape[1]]),
-                        max(obj[1].data[int(0.7*obj_shape[0]),1:obj_shape[1]]))
-        ax3.plot(np.arange(1,obj_shape[1],1),
-                    obj[j+1].data[int(0.7*obj_shape[0]),1:obj_shape[1]],linewidth=0.5)
-        if j == 0:
-            ax1.yaxis.set_visible(True)
-            ax1.set_ylabel('Counts [row={}]'.format(int(0.3*obj_shape[0])), fontsize=14)
-            ax2.yaxis.set_visible(True)
-            ax2.set_ylabel('Counts [row={}]'.format(int(0.5*obj_shape[0])), fontsize=14)
-            ax3.yaxis.set_visible(True)
-            ax3.set_ylabel('Counts [row={}]'.format(int(0.7*obj_shape[0])), fontsize=14)
-        else:
-            ax1.yaxis.set_visible(False)
-            ax2.yaxis.set_visible(False)
-            ax3.yaxis.set_visible(False)
-    plt.tight_layout(w_pad=-0.9)
-    plt.suptitle('Pixel Counting',y=1.0, fontsize=14)
-    plt.savefig('pixel-counting-bias-std-{}.png'.format(obj_std_name[0]))
-    plt.show()
-    plt.close()
+    show_figure(plot_line_cuts, line_cuts(obj, [('SCI', i) for i in range(1,13)], ('SCI', 1)),
+                'pixel-counting-bias-std-{}.png'.format(obj_std_name[0]))
 
 def std_reduc_arc():
     """ Apply overscan correction and mosaic arc frames. """
@@ -836,260 +2827,100 @@ def std_wavelength_arc():
     print('# CALIBRATING WAVELENGTH #')
 
     # Remove pre-existing wavelength solution files on database directory.
-    if os.path.exists('database/idgs{}_001'.format(arc_std_name[0].replace('.fits',''))):
-        os.remove('database/idgs{}_001'.format(arc_std_name[0].replace('.fits','')))
+    for prefix in ('id', 'fc'):
+        if os.path.exists('database/{}gs{}_001'.format(prefix, arc_std_name[0].replace('.fits',''))):
+            os.remove('database/{}gs{}_001'.format(prefix, arc_std_name[0].replace('.fits','')))
 
     # Load reduced arc frame.
-    obj=fits.open('gs{}'.format(arc_std_name[0]))
+    obj=open_fits('gs{}'.format(arc_std_name[0]))
     obj_data = obj[2].data
     arc_shape = obj_data.shape
 
-    gmos.gswavelength.unlearn() # Debug gswavelength.
-    # Set the task parameters.
-    gswavelengthFlags={'nsum':str(arc_shape[0]/3), 'step':str(arc_shape[0]/3),
-                        'fwidth':'7', 'gsigma':'1.5','cradius':'12',
-                        'minsep':'7', 'order':'6','fl_inter':'no'}
-    # Create wavelength solution.
-    gmos.gswavelength('gs{}'.format(arc_std_name[0]), **gswavelengthFlags) # IRAF task gswavelength.
-
-    # Read wavelength solution file on database directory.
-    # Autoidentify.
-    # Number of calculated features.
-    number_of_features_auto = np.genfromtxt('database/idgs{}_001'.format(arc_std_name[0].replace('.fits','')),
-                                            skip_header=6, usecols=1, max_rows=1, invalid_raise=False)
-    # Number of calculated coefficients.
-    number_of_coefficients_auto = np.genfromtxt('database/idgs{}_001'.format(arc_std_name[0].replace('.fits','')),
-                                            skip_header=7+int(number_of_features_auto)+8, usecols=1,
-                                                max_rows=1, invalid_raise=False)
-    # gswavelength flags to discard outlier values.
-    wave_flag_auto = np.genfromtxt('database/idgs{}_001'.format(arc_std_name[0].replace('.fits','')), skip_header=7,
-                                usecols=5, max_rows=int(number_of_features_auto), invalid_raise=False)
-    # Row number.
-    wave_auto_col_0 = np.genfromtxt('database/idgs{}_001'.format(arc_std_name[0].replace('.fits','')), skip_header=7,
-                                usecols=0, max_rows=int(number_of_features_auto), invalid_raise=False)
-    # Corrected line wavelength.
-    wave_auto_col_1  = np.genfromtxt('database/idgs{}_001'.format(arc_std_name[0].replace('.fits','')), skip_header=7,
-                                usecols=1, max_rows=int(number_of_features_auto), invalid_raise=False)
-    # Calculated line wavelength.
-    wave_auto_col_2  = np.genfromtxt('database/idgs{}_001'.format(arc_std_name[0].replace('.fits','')), skip_header=7,
-                                usecols=2, max_rows=int(number_of_features_auto), invalid_raise=False)
-
-    # Reidentify.
-    # Number of calculated features.
-    number_of_features_re1 = np.genfromtxt('database/idgs{}_001'.format(arc_std_name[0].replace('.fits','')),
-                             skip_header=7+int(number_of_features_auto)+9+int(number_of_coefficients_auto)+7,
-                                        usecols=1, max_rows=1, invalid_raise=False)
-
-    number_of_coefficients_re1 = np.genfromtxt('database/idgs{}_001'.format(arc_std_name[0].replace('.fits','')),
-           skip_header=7+int(number_of_features_auto)+9+int(number_of_coefficients_auto)+8+int(number_of_features_re1)+8,
-                                        usecols=1, max_rows=1, invalid_raise=False)
-
-    # gswavelength flags to discard outlier values.
-    wave_flag_re1 = np.genfromtxt('database/idgs{}_001'.format(arc_std_name[0].replace('.fits','')),
-                                skip_header=7+int(number_of_features_auto)+9+int(number_of_coefficients_auto)+8,
-                                usecols=5, max_rows=int(number_of_features_re1), invalid_raise=False)
-    # Row number.
-    wave_re1_col_0 = np.genfromtxt('database/idgs{}_001'.format(arc_std_name[0].replace('.fits','')),
-                                skip_header=7+int(number_of_features_auto)+9+int(number_of_coefficients_auto)+8, usecols=0,
-                                max_rows=int(number_of_features_re1), invalid_raise=False)
-    # Corrected line wavelength.
-    wave_re1_col_1 = np.genfromtxt('database/idgs{}_001'.format(arc_std_name[0].replace('.fits','')),
-                                skip_header=7+int(number_of_features_auto)+9+int(number_of_coefficients_auto)+8, usecols=1,
-                                max_rows=int(number_of_features_re1), invalid_raise=False)
-    # Calculated line wavelength.
-    wave_re1_col_2 = np.genfromtxt('database/idgs{}_001'.format(arc_std_name[0].replace('.fits','')),
-                                skip_header=7+int(number_of_features_auto)+9+int(number_of_coefficients_auto)+8, usecols=2,
-                                max_rows=int(number_of_features_re1), invalid_raise=False)
-
-    # Reidentify.
-    # Number of calculated features.
-
-    number_of_features_re2 = np.genfromtxt('database/idgs{}_001'.format(arc_std_name[0].replace('.fits','')),
-                                        skip_header=(7+int(number_of_features_auto)+9+int(number_of_coefficients_auto)
-                                        +8+int(number_of_features_re1)+9+int(number_of_coefficients_re1)+7),
-                                           usecols=1, max_rows=1, invalid_raise=False)
-
-    # gswavelength flags to discard outlier values.
-    wave_flag_re2 = np.genfromtxt('database/idgs{}_001'.format(arc_std_name[0].replace('.fits','')),
-                                skip_header=(7+int(number_of_features_auto)+9+int(number_of_coefficients_auto)
-                                        +8+int(number_of_features_re1)+9+int(number_of_coefficients_re1)+8),
-                                  usecols=5, max_rows=int(number_of_features_re2), invalid_raise=False)
-    # Row number.
-    wave_re2_col_0 = np.genfromtxt('database/idgs{}_001'.format(arc_std_name[0].replace('.fits','')),
-                                skip_header=(7+int(number_of_features_auto)+9+int(number_of_coefficients_auto)
-                                        +8+int(number_of_features_re1)+9+int(number_of_coefficients_re1)+8),
-                                  usecols=0, max_rows=int(number_of_features_re2), invalid_raise=False)
-    # Corrected line wavelength.
-    wave_re2_col_1 = np.genfromtxt('database/idgs{}_001'.format(arc_std_name[0].replace('.fits','')),
-                                skip_header=(7+int(number_of_features_auto)+9+int(number_of_coefficients_auto)
-                                        +8+int(number_of_features_re1)+9+int(number_of_coefficients_re1)+8),
-                                  usecols=1, max_rows=int(number_of_features_re2), invalid_raise=False)
-    # Calculated line wavelength.
-    wave_re2_col_2 = np.genfromtxt('database/idgs{}_001'.format(arc_std_name[0].replace('.fits','')),
-                                skip_header=(7+int(number_of_features_auto)+9+int(number_of_coefficients_auto)
-                                        +8+int(number_of_features_re1)+9+int(number_of_coefficients_re1)+8),
-                                  usecols=2, max_rows=int(number_of_features_re2), invalid_raise=False)
-
-    # gswavelength flags
-    flag_auto = np.where(wave_flag_auto[0:,] == 1) # Autoidentify.
-    flag_re1 = np.where(wave_flag_re1[0:,] == 1) # Reidentify.
-    flag_re2 = np.where(wave_flag_re2[0:,] == 1) # Reidentify.
-
-    # RMS estimate.
-
-    # Autoidentify.
-    rows_auto = wave_auto_col_0[0:,][flag_auto]
-    delta_lambda_auto = wave_auto_col_2[0:,][flag_auto] - wave_auto_col_1[0:,][flag_auto]
-    rms_auto = np.sqrt(np.sum(delta_lambda_auto**2) / len(rows_auto))
-
-    print('[AUTOIDENTIFY] RMS = ', rms_auto)
-
-    hig_than_rms_auto=[] # Values higher than RMS.
-    for l in range(len(delta_lambda_auto)):
-        if np.abs(delta_lambda_auto[l]) > rms_auto:
-            hig_than_rms_auto.append( wave_auto_col_2[0:,][flag_auto][l])
-    # Print number of lines with values diverging from the correct value
-    # whith a difference higher thant the RMS.
-    print("[AUTOIDENTIFY] There are {} identified lines diverging from the"
-            " observed value with differences higher than the RMS :".format(len(hig_than_rms_auto)), hig_than_rms_auto)
-
-     # Reidentify.
-    rows_re1 = wave_re1_col_0[0:,][flag_re1]
-    delta_lambda_re1 = wave_re1_col_2[0:,][flag_re1] - wave_re1_col_1[0:,][flag_re1]
-    rms_re1 = np.sqrt(np.sum(delta_lambda_re1**2) / len(rows_re1))
-
-    print('[REIDENTIFY] RMS = ', rms_re1)
-
-    hig_than_rms_re1=[] # Values higher than RMS.
-    for l in range(len(delta_lambda_re1)):
-        if np.abs(delta_lambda_re1[l]) > rms_re1:
-            hig_than_rms_re1.append(wave_re1_col_2[0:,][flag_re1][l])
-    # Print number of lines with values diverging from the correct value
-    # whith a difference higher thant the RMS.
-    print("[REIDENTIFY] There are {} identified lines diverging from the"
-            " observed value with differences higher than the RMS :".format(len(hig_than_rms_re1)), hig_than_rms_re1)
-
-    # Reidentify.
-    rows_re2 = wave_re2_col_0[0:,][flag_re2]
-    delta_lambda_re2 = wave_re2_col_2[0:,][flag_re2] - wave_re2_col_1[0:,][flag_re2]
-    rms_re2 = np.sqrt(np.sum(delta_lambda_re2**2) / len(rows_re2))
-
-    print('[REIDENTIFY] RMS = ', rms_re2)
-
-    hig_than_rms_re2=[]  # Values higher than RMS.
-    for l in range(len(delta_lambda_re2)):
-        if np.abs(delta_lambda_re2[l]) > rms_re2:
-            hig_than_rms_re2.append(wave_re2_col_2[0:,][flag_re2][l])
-    # Print number of lines with values diverging from the correct value
-    # whith a difference higher thant the RMS.
-    print("[REIDENTIFY] There are {} identified lines diverging from the"
-            " observed value with differences higher than the RMS :".format(len(hig_than_rms_re2)), hig_than_rms_re2)
+    # Shift the library solution of an arc with the same settings, or
+    # identify the lines again if there is none or it does not match.
+    shifted = shift_arc_solution(arc_std_name[0])
+    if not shifted:
+        gmos.gswavelength.unlearn() # Debug gswavelength.
+        # Set the task parameters.
+        gswavelengthFlags={'nsum':str(arc_shape[0]/3), 'step':str(arc_shape[0]/3),
+                            'fwidth':'7', 'gsigma':'1.5','cradius':'12',
+                            'minsep':'7', 'order':'6','fl_inter':'no'}
+        # Create wavelength solution.
+        gmos.gswavelength('gs{}'.format(arc_std_name[0]), **gswavelengthFlags) # IRAF task gswavelength.
+
+    # Read wavelength solution file on database directory: the
+    # autoidentify block and the reidentify blocks.
+    solution = read_database('database/idgs{}_001'.format(arc_std_name[0].replace('.fits','')))
+    qa = wavelength_qa(solution)
+    print_wavelength_qa(qa)
+    stage_metrics['wavelength'] = wavelength_metrics(qa)
 
     # Print the difference of the calculated and correct wavelength values
     # for the estimated lines.
-    # Autoidentify.
-    fig = plt.figure(figsize=(14.0,6.0))
-    ax1 = fig.add_subplot(111)
-    ax2 = ax1.twiny()
-    ax3 = ax1.twiny()
-    ax4 = ax1.twiny()
-    ax1.scatter(rows_auto,np.abs(delta_lambda_auto), color='white' )
-    ax2.scatter(wave_auto_col_2[0:,][flag_auto], np.abs(delta_lambda_auto), color='coral')
-    ax2.invert_xaxis()
-    plt.title('Autoidentify', y=1.10, fontsize=14)
-    ax2.set_xlabel(r'$\lambda_{identified} \ [\AA]$', fontsize=14)
-    ax1.set_xlabel('Pixel position', fontsize=14)
-    ax1.set_ylabel(r'|$\lambda_{identified} - \lambda_{fitted}| \ [\AA]$', fontsize=14)
-    ax3.axhline(y=0.2, linestyle='--')
-    ax3.xaxis.set_visible(False)
-    ax4.axhline(y=rms_auto, linestyle=':', label='RMS = {}'.format(rms_auto))
-    ax4.xaxis.set_visible(False)
-    plt.tight_layout(w_pad=-0.9)
-    ax4.legend()
-    plt.savefig('autoidentify_std-{}.png'.format(obj_std_name[0]))
-    plt.show()
-    plt.close()
-
-    # Reidentify.
-    fig = plt.figure(figsize=(14.0,6.0))
-    ax1 = fig.add_subplot(111)
-    ax2 = ax1.twiny()
-    ax3 = ax1.twiny()
-    ax4 = ax1.twiny()
-    ax1.scatter(rows_re1,np.abs(delta_lambda_re1), color='white' )
-    ax2.scatter(wave_re1_col_2[0:,][flag_re1] ,np.abs(delta_lambda_re1), color='coral')
-    ax2.invert_xaxis()
-    plt.title('Reidentify', y=1.10, fontsize=14)
-    ax2.set_xlabel(r'$\lambda_{identified} \ [\AA]$', fontsize=14)
-    ax1.set_xlabel('Pixel position', fontsize=14)
-    ax1.set_ylabel(r'|$\lambda_{identified} - \lambda_{fitted}| \ [\AA]$', fontsize=14)
-    ax3.axhline(y=0.2, linestyle='--')
-    ax3.xaxis.set_visible(False)
-    ax4.axhline(y=rms_re1, linestyle=':', label='RMS = {}'.format(rms_re1))
-    ax4.xaxis.set_visible(False)
-    plt.tight_layout(w_pad=-0.9)
-    ax4.legend()
-    plt.show()
-    plt.close()
-
-    # Reidentify.
-    fig = plt.figure(figsize=(14.0,6.0))
-    ax1 = fig.add_subplot(111)
-    ax2 = ax1.twiny()
-    ax3 = ax1.twiny()
-    ax4 = ax1.twiny()
-    ax1.scatter(rows_re2,np.abs(delta_lambda_re2), color='white' )
-    ax2.scatter(wave_re2_col_2[0:,][flag_re2] ,np.abs(delta_lambda_re2), color='coral')
-    ax2.invert_xaxis()
-    plt.title('Reidentify', y=1.10, fontsize=14)
-    ax2.set_xlabel(r'$\lambda_{identified} \ [\AA]$', fontsize=14)
-    ax1.set_xlabel('Pixel position', fontsize=14)
-    ax1.set_ylabel(r'|$\lambda_{identified} - \lambda_{fitted}| \ [\AA]$', fontsize=14)
-    ax3.axhline(y=0.2, linestyle='--')
-    ax3.xaxis.set_visible(False)
-    ax4.axhline(y=rms_re2, linestyle=':', label='RMS = {}'.format(rms_re2))
-    ax4.xaxis.set_visible(False)
-    plt.tight_layout(w_pad=-0.9)
-    ax4.legend()
-    plt.show()
-    plt.close()
+    for i, block in enumerate(qa['blocks']):
+        show_figure(plot_identify, {'title':'Autoidentify' if i == 0 else 'Reidentify',
+                                    'pixels':block['pixels'], 'wavelengths':block['wavelengths'],
+                                    'delta':block['delta'], 'rms':block['clipped_rms']},
+                    'autoidentify_std-{}.png'.format(obj_std_name[0]) if i == 0 else None)
+    show_figure(plot_residual_map, {'title':'Wavelength residuals', 'map':qa['map'],
+                                    'pixels':qa['pixels'],
+                                    'rows':[block['row'] for block in qa['blocks']]},
+                'wavelength_residuals_std-{}.png'.format(obj_std_name[0]))
+
+    check_wavelength_qa(qa, arc_std_name[0])
+    if not shifted:
+        store_arc_solution(arc_std_name[0])
 
 def std_transf_arc():
     """ Transform arc files. """
 
     print('# TRANSFORMING ARC FILES #')
 
-    # Remove pre-existing transformed files.
-    if os.path.exists('tgs{}'.format(arc_std_name[0])):
-        os.remove('tgs{}'.format(arc_std_name[0]))
+    # Rectify the arc with its own wavelength solution. The files made
+    # before are replaced.
+    transform_frame('gs{}'.format(arc_std_name[0]), 'gs{}'.format(arc_std_name[0]))
 
-    gmos.gstransform.unlearn() # Debug gstransform.
-    # Set the task parameters.
-    gstransformFlags={'wavtranam':'gs{}'.format(arc_std_name[0])}
-    # Transform arc files.
-    gmos.gstransform('gs{}'.format(arc_std_name[0]), **gstransformFlags) # IRAF task gstransform.
+def std_flat_key(kind='flat'):
+    """ Library key of the Master Flat, or with kind 'qecorr' of the
+        quantum efficiency correction image kept with it. The flat frames
+        are bias subtracted and quantum-efficiency corrected with the ARC
+        as reference. """
+
+    flats = [flat.replace('\n','') for flat in open('flat_std.txt')]
+    biases = [bias.replace('\n','') for bias in open('bias_std.txt')]
+
+    return master_key(kind, flats, biases + [arc_std_name[0]],
+                      method='native' if kind == 'flat' else None)
+
+def std_flat_in_library():
+    """ True if the Master Flat and its quantum efficiency correction
+        image are both in the calibration library. """
+
+    return (find_master(std_flat_key()) is not None
+            and find_master(std_flat_key('qecorr')) is not None)
 
 def std_reduc_flat():
     """ Subtract bias from individual flat frames. """
 
     print('# REDUCING RAW FLATS #')
 
-    # Open individual flat frames.
-    f = open('flat_std.txt', 'r')
-    for flatfile in f:
-        # Remove pre-existing processed files.
-        if os.path.exists('gs{}'.format(flatfile.replace('\n',''))):
-            os.remove('gs{}'.format(flatfile.replace('\n','')))
+    # The individual flat frames are not needed if the Master Flat is
+    # in the calibration library.
+    if std_flat_in_library():
+        print('Master Flat found in the calibration library.')
+        return
 
-        gmos.gsreduce.unlearn() # Debug gsreduce.
-        # Set the task parameters.
-        gsreduceFlags={'rawpath':'raw', 'fl_bias':'yes',
-                        'fl_flat':'no', 'fl_fixpix':'no',
-                        'bias':'Bias_std.fits','fl_gmos':'no',
-                        'fl_gsappwave':'no', 'fl_cut':'no'}
-        # Reduce flat files.
-        gmos.gsreduce(str(flatfile.replace('\n','')), **gsreduceFlags) # IRAF task gsreduce.
-    f.close()
+    # Individual flat frames.
+    flats = [flat.replace('\n','') for flat in open('flat_std.txt')]
+
+    # Set the task parameters.
+    gsreduceFlags={'rawpath':'raw', 'fl_bias':'yes',
+                    'fl_flat':'no', 'fl_fixpix':'no',
+                    'bias':'Bias_std.fits','fl_gmos':'no',
+                    'fl_gsappwave':'no', 'fl_cut':'no'}
+    # Reduce flat files, several at a time.
+    run_frame_tasks([('gsreduce', flat, 'gs'+flat, gsreduceFlags)
+                     for flat in flats], 'std_reduc_flat') # IRAF task gsreduce.
 
 def std_qecorr_flat():
     """ Apply quantum efficiency correction to individual
@@ -1097,50 +2928,60 @@ def std_qecorr_flat():
 
     print('# QUANTUM-CORRECTING FLAT#')
 
-    # Open individual flat frames.
-    f = open('flat_std.txt', 'r')
-    for flatfile in f:
-        # Remove pre-existing processed files.
-        if os.path.exists('qgs{}'.format(flatfile.replace('\n',''))):
-            os.remove('qgs{}'.format(flatfile.replace('\n','')))
+    # Remove the correction image made from a previous ARC solution.
+    if os.path.exists('qecorrgs{}'.format(arc_std_name[0])):
+        os.remove('qecorrgs{}'.format(arc_std_name[0]))
 
-        gmos.gqecorr.unlearn() # Debug gqecorr.
-        # Set the task parameters.
-        qecorrFlags= {'refimage':'gs{}'.format(arc_std_name[0]),
-                    'fl_keep':'yes'}
-        # Apply quantum efficiency correction.
-        gmos.gqecorr('gs{}'.format(flatfile.replace('\n','')), **qecorrFlags) # IRAF task gqecorr.
-    f.close()
+    # Set the task parameters.
+    qecorrFlags= {'refimage':'gs{}'.format(arc_std_name[0]),
+                'fl_keep':'yes', 'corrimages':'qecorrgs{}'.format(arc_std_name[0])}
+
+    # The flat frames are not corrected if the Master Flat is in the
+    # calibration library: the correction image kept with it is used.
+    if std_flat_in_library():
+        print('Master Flat found in the calibration library.')
+        fetch_master(std_flat_key('qecorr'), 'qecorrgs{}'.format(arc_std_name[0]))
+        return
+
+    # Individual flat frames.
+    flats = [flat.replace('\n','') for flat in open('flat_std.txt')]
+
+    # Apply quantum efficiency correction. The correction image made from
+    # the ARC is kept by the first frame and reused by the others, which
+    # then run several at a time.
+    jobs = [('gqecorr', 'gs'+flat, 'qgs'+flat, qecorrFlags) for flat in flats]
+    run_frame_tasks(jobs[:1], 'std_qecorr_flat') # IRAF task gqecorr.
+    store_master(std_flat_key('qecorr'), 'qecorrgs{}'.format(arc_std_name[0]))
+    run_frame_tasks(jobs[1:], 'std_qecorr_flat')
 
 def std_gmosaic_flat():
     """ Mosaic individual flat frames. """
 
     print('# MOSAIC FLAT#')
 
+    if std_flat_in_library():
+        print('Master Flat found in the calibration library.')
+        return
+
     # Remove pre-existing list.
     if os.path.exists("mqgsflat_std.txt"):
         os.remove("mqgsflat_std.txt")
 
-    # Open individual flat frames.
-    f = open('flat_std.txt', 'r')
-    for flatfile in f:
-        # Remove pre-existing processed files.
-        if os.path.exists('mqgs{}'.format(flatfile.replace('\n',''))):
-            os.remove('mqgs{}'.format(flatfile.replace('\n','')))
+    # Individual flat frames.
+    flats = [flat.replace('\n','') for flat in open('flat_std.txt')]
 
-        gmos.gmosaic.unlearn() # Debug gmosaic.
-        # Set the task parameters.
-        gmosaicFlags= {'fl_fixpix':'yes'}
-        # Mosaic flat frames.
-        gmos.gmosaic('qgs{}'.format(flatfile.replace('\n','')), **gmosaicFlags) # IRAF task gmosaic.
-
-        # Write name of processed files on list.
-        mqgsflat = open("mqgsflat_std.txt","a")
-        mqgsflat.write('mqgs{}'.format(flatfile.replace('\n','')))
+    # Set the task parameters.
+    gmosaicFlags= {'fl_fixpix':'yes'}
+    # Mosaic flat frames, several at a time.
+    run_frame_tasks([('gmosaic', 'qgs'+flat, 'mqgs'+flat, gmosaicFlags)
+                     for flat in flats], 'std_gmosaic_flat') # IRAF task gmosaic.
+
+    # Write name of processed files on list, in the order of the flat list.
+    mqgsflat = open("mqgsflat_std.txt","w")
+    for flat in flats:
+        mqgsflat.write('mqgs{}'.format(flat))
         mqgsflat.write("\n")
-        mqgsflat.close()
-
-    f.close()
+    mqgsflat.close()
 
 def std_masterflat():
     """ Trim individual flat frames and create Master Flat.
@@ -1152,60 +2993,29 @@ def std_masterflat():
     if os.path.exists('qFlat_std.fits'):
         os.remove('qFlat_std.fits')
 
-    gmos.gsflat.unlearn() # Debug gsflat.
-    # Set the task parameters.
-    flatFlags = {'fl_bias':'no', 'order':'29',
-                'fl_over':'no', 'fl_trim':'no',
-                'fl_usegrad':'yes'}
-    # Create Master Flat.
-    gmos.gsflat('@mqgsflat_std.txt', 'qFlat_std.fits', **flatFlags) # IRAF task gsflat.
+    # Take the Master Flat from the calibration library if it was
+    # already made from the same frames.
+    flat_key = std_flat_key()
+    with library_lock(flat_key):
+        if not (std_flat_in_library() and fetch_master(flat_key, 'qFlat_std.fits')):
+            # Create Master Flat.
+            build_flat([flat.replace('\n','') for flat in open('mqgsflat_std.txt')], 'qFlat_std.fits')
+            store_master(flat_key, 'qFlat_std.fits')
 
     # Load Master Flat.
-    obj=fits.open('qFlat_std.fits')
+    obj=open_fits('qFlat_std.fits')
     obj_data = obj[2].data
     obj_shape = obj_data.shape
 
     # Plot Master Flat.
-    plt.figure(figsize=(12.0,4.0))
-    plt.imshow(obj[2].data, origin='lower',cmap='afmhot',
-               vmin=np.percentile(obj[2].data,5),
-               vmax=np.percentile(obj[2].data,90), aspect='auto')
-    plt.ylabel('Position Along Slit', fontsize=14)
-    plt.xlabel('Dispersion Axis', fontsize=14)
-    plt.tight_layout(w_pad=-0.9)
-    plt.suptitle('Master FLAT', y=1.0, fontsize=14)
-    plt.savefig('master-flat-std-{}.png'.format(obj_std_name[0]))
-    plt.show()
-    plt.clf()
-    plt.close()
+    show_figure(plot_images, {'images':[[qa_image(obj, 2)]], 'figsize':(12.0,4.0),
+                              'xlabel':'Dispersion Axis', 'title':'Master FLAT'},
+                'master-flat-std-{}.png'.format(obj_std_name[0]))
 
     # Print the pixel counting through a line cut.
-    plt.figure(figsize=(16.0,8.0))
-    ax1 = plt.subplot(3, 1, 1)
-    ax1.set_ylim(min(obj[2].data[int(0.3*obj_shape[0]),1:obj_shape[1]]),
-                    max(obj[2].data[int(0.3*obj_shape[0]),1:obj_shape[1]]))
-    ax1.set_ylabel('Counts [row={}]'.format(int(0.3*obj_shape[0])), fontsize=14)
-    ax1.plot(np.arange(1,obj_shape[1],1),
-                obj[2].data[int(0.3*obj_shape[0]),1:obj_shape[1]],linewidth=0.5)
-
-    ax2 = plt.subplot(3, 1, 2)
-    ax2.set_ylim(min(obj[2].data[int(0.5*obj_shape[0]),1:obj_shape[1]]),
-                    max(obj[2].data[int(0.5*obj_shape[0]),1:obj_shape[1]]))
-    ax2.set_ylabel('Counts [row={}]'.format(int(0.5*obj_shape[0])), fontsize=14)
-    ax2.plot(np.arange(1,obj_shape[1],1),
-                obj[2].data[int(0.5*obj_shape[0]),1:obj_shape[1]],linewidth=0.5)
-    ax3 = plt.subplot(3, 1, 3)
-    ax3.set_ylim(min(obj[2].data[int(0.7*obj_shape[0]),1:obj_shape[1]]),
-                    max(obj[2].data[int(0.7*obj_shape[0]),1:obj_shape[1]]))
-    ax3.set_ylabel('Counts [row={}]'.format(int(0.7*obj_shape[0])), fontsize=14)
-    ax3.plot(np.arange(1,obj_shape[1],1),
-                obj[2].data[int(0.7*obj_shape[0]),1:obj_shape[1]],linewidth=0.5)
-    ax3.set_xlabel('Dispersion Axis', fontsize=14)
-    plt.tight_layout(w_pad=-0.9)
-    plt.suptitle('Pixel Counting',y=1.0, fontsize=14)
-    plt.savefig('pixel-counting-flat-std-{}.png'.format(obj_std_name[0]))
-    plt.show()
-    plt.close()
+    spec = line_cuts(obj, [2], 2)
+    spec['xlabel'] = 'Dispersion Axis'
+    show_figure(plot_line_cuts, spec, 'pixel-counting-flat-std-{}.png'.format(obj_std_name[0]))
 
 def std_reduc1_std():
     """ Subtract bias, apply overscan and cosmic ray correction
@@ -1224,7 +3034,8 @@ def std_reduc1_std():
                     'fl_fulldq':'yes', 'fl_bias':'yes',
                     'bias':'Bias_std', 'fl_inter':'no',
                     'fl_cut':'no', 'fl_gsappwave':'no',
-                    'fl_over':'yes', 'fl_crspec':'yes'}
+                    'fl_over':'yes',
+                    'fl_crspec':'yes' if cosmic_method == 'gemfix' else 'no'}
     # Reduce standard star files.
     gmos.gsreduce(str(obj_std_name[0]), **gsreduceFlags) # IRAF task gsreduce.
 
@@ -1237,60 +3048,31 @@ def std_gemfix_std():
     # Remove pre-existing processed files.
     if os.path.exists('gemgs{}'.format(obj_std_name[0])):
         os.remove('gemgs{}'.format(obj_std_name[0]))
-    if os.path.exists('copy_gemgs{}'.format(obj_std_name[0])):
-        os.remove('copy_gemgs{}'.format(obj_std_name[0]))
-
-    gemini.gemfix.unlearn() # Debug gemfix.
-    # Task parameters.
-    gemfixFlags={'outimages':'gemgs{}'.format(obj_std_name[0]),
-                    'method':'fixpix', 'bitmask':'8'}
-    # Fix bad pixels.
-    gemini.gemfix('gs{}'.format(obj_std_name[0]), **gemfixFlags) # IRAF task gemfix.
-
-    # Load raw files.
-    obj=fits.open('raw/{}'.format(obj_std_name[0]))
-    obj_data = obj[2].data
-    obj_shape = obj_data.shape
 
-    # Load processed files.
-    gemobj=fits.open('gemgs{}'.format(obj_std_name[0]))
-    gemobj_data = gemobj[2].data
-    gemobj_shape = gemobj_data.shape
-
-    # Create copy of processed file.
-    copy_gemobj = fits.HDUList([gemobj[0]])
-    for n in np.arange(2,37,3):
-        copy_gemobj.append(gemobj[n])
-    copy_gemobj.writeto('copy_gemgs{}'.format(obj_std_name[0]))
-    new_gemobj = fits.open('copy_gemgs{}'.format(obj_std_name[0]))
-    gemobj_data = gemobj[2].data
-    gemobj_shape = gemobj_data.shape
+    if cosmic_method == 'native':
+        # Find and replace the cosmic rays.
+        flagged = clean_cosmic_rays('gs{}'.format(obj_std_name[0]), 'gemgs{}'.format(obj_std_name[0]))
+        print('Cosmic ray pixels flagged: {}'.format(flagged))
+        stage_metrics['cosmic_ray_pixels'] = flagged
+    else:
+        gemini.gemfix.unlearn() # Debug gemfix.
+        # Task parameters.
+        gemfixFlags={'outimages':'gemgs{}'.format(obj_std_name[0]),
+                        'method':'fixpix', 'bitmask':'8'}
+        # Fix bad pixels.
+        gemini.gemfix('gs{}'.format(obj_std_name[0]), **gemfixFlags) # IRAF task gemfix.
+
+    # Load raw and processed files. The figure takes the SCI extensions
+    # of the processed file from its memory map.
+    obj=open_fits('raw/{}'.format(obj_std_name[0]))
+    gemobj=open_fits('gemgs{}'.format(obj_std_name[0]))
 
     # Print raw and corrected files.
-    plt.figure(figsize=(16.0,8.0))
-    for i in range(len(np.arange(0,12,1))):
-        ax1 = plt.subplot(2,12,i+1)
-        ax1.imshow(obj[i+1].data, origin='lower',cmap='afmhot',
-                   vmin=np.percentile(obj[i+1].data,5),
-                   vmax=np.percentile(obj[i+1].data,90), aspect='auto')
-        ax2 = plt.subplot(2,12,12+i+1)
-        ax2.imshow(new_gemobj[i+1].data, origin='lower',cmap='afmhot',
-                   vmin=np.percentile(new_gemobj[i+1].data,5),
-                   vmax=np.percentile(new_gemobj[i+1].data,90), aspect='auto')
-        if i == 0:
-            ax1.yaxis.set_visible(True)
-            ax1.set_ylabel('Position Along Slit', fontsize=14)
-            ax2.yaxis.set_visible(True)
-            ax2.set_ylabel('Position Along Slit', fontsize=14)
-        else:
-            ax1.yaxis.set_visible(False)
-            ax2.yaxis.set_visible(False)
-    plt.tight_layout(w_pad=-0.9)
-    plt.suptitle('Pre- and Post- Cosmic Ray Rejection', y=1.0, fontsize=14)
-    plt.savefig('gemfix_std-{}.png'.format(obj_std_name[0]))
-    plt.show()
-    plt.clf()
-    plt.close()
+    show_figure(plot_images, {'images':[[qa_image(obj, i+1) for i in range(12)],
+                                        [qa_image(gemobj, ('SCI', i+1)) for i in range(12)]],
+                              'figsize':(16.0,8.0),
+                              'title':'Pre- and Post- Cosmic Ray Rejection'},
+                'gemfix_std-{}.png'.format(obj_std_name[0]))
 
 def std_qecorr_std():
     """ Apply quantum efficiency correction to standard
@@ -1302,17 +3084,10 @@ def std_qecorr_std():
     if os.path.exists('qgemgs{}'.format(obj_std_name[0])):
         os.remove('qgemgs{}'.format(obj_std_name[0]))
 
-    # Open list of individual flat frames.
-    flatfile_list=[]
-    f = open('flat_std.txt', 'r')
-    for flatfile in f:
-        flatfile_list.append(flatfile)
-    f.close()
-
     gmos.gqecorr.unlearn() # Debug gqecorr.
-    # Task parameters
-    qecorrFlags= {'refimage':'gs{}'.format(arc_std_name[0]),
-                    'corrima':'qgs{}'.format(flatfile_list[0].replace('\n',''))}
+    # Task parameters. The correction image made from the ARC is reused.
+    qecorrFlags= {'refimage':'gs{}'.format(arc_std_name[0]), 'fl_keep':'yes',
+                    'corrimages':'qecorrgs{}'.format(arc_std_name[0])}
     # Apply quantum efficiency correction.
     gmos.gqecorr('gemgs{}'.format(obj_std_name[0]), **qecorrFlags) # IRAF task gqecorr.
 
@@ -1334,49 +3109,64 @@ def std_reduc2_std():
     gmos.gsreduce('qgemgs{}'.format(obj_std_name[0]), **gsreduceFlags) # IRAF task gsreduce.
 
 def std_badcolumn_std():
-    """ Print standard star frame for bad column checking.
-        Interpolate bad columns. """
+    """ Find the bad columns of the standard star frame and interpolate
+        them. The columns can then be checked, and more columns added,
+        by hand. """
 
     print('# BAD COLUMN CHECKING #')
 
-    # Remove pre-existing processed files.
-    if os.path.exists('bcgsqgemgs{}'.format(obj_std_name[0])):
-        os.remove('bcgsqgemgs{}'.format(obj_std_name[0]))
-    # Create copy of science object file to apply bad column correction.
-    iraf.copy('gsqgemgs{}'.format(obj_std_name[0]), 'bcgsqgemgs{}'.format(obj_std_name[0]))
-    # Load copy.
-    obj=fits.open('bcgsqgemgs{}'.format(obj_std_name[0]))
-
-    # Check if a bad column mask is already available in the directory.
-    if os.path.exists("maskbadcol.txt"):
-        while True:
-            try:
-                print('')
-                answer = raw_input("The file 'maskbadcol.txt' is available in this directory. "
-                                    " Do you wish to apply this mask to your spectrum? (y/n) ")
-                if answer=='y':
-                    # Remove pre-existing mask.
-                    if os.path.exists("maskbadcol.pl"):
-                        os.remove("maskbadcol.pl")
-
-                    # Create mask based on coordinates text file.
-                    iraf.text2mask('maskbadcol.txt', 'maskbadcol.pl',
-                                    obj[2].shape[1], obj[2].shape[0]) # IRAF task 'text2mask'.
+    # Load the frame. The corrected frame is written from it at once.
+    obj=open_fits('gsqgemgs{}'.format(obj_std_name[0]))
 
-                    # Interpolate bad columns using mask.
-                    iraf.fixpix('bcgsqgemgs{}[2]'.format(obj_std_name[0]),
-                                    'maskbadcol.pl', linterp='1,2,3,4') # IRAF task 'fixpix'.
-                    break
+    # Start from the bad column mask of the calibration library for the
+    # detector, binning and region of interest of the frame.
+    mask_library_key = mask_key(obj_std_name[0])
+    mask = library_mask(mask_library_key, obj[2].shape)
 
-                if answer=='n':
-                    break
+    # Check if a bad column mask is already available in the directory or
+    # in the calibration library. It is kept, and the columns found below
+    # are added to it, or it is made again: the file is then removed and
+    # the library mask is neither used nor updated by this reduction.
+    if os.path.exists("maskbadcol.txt") or mask.any():
+        while True:
+            print('')
+            answer = ask('std.badcolumn.apply_mask', "A bad column mask is available in this directory "
+                                "('maskbadcol.txt') or in the calibration library. "
+                                " Do you wish to apply this mask to your spectrum? (y/n) ",
+                         default='y')
+            if answer=='y':
+                if os.path.exists("maskbadcol.txt"):
+                    mask_columns(mask, read_bad_columns("maskbadcol.txt"))
+                break
+            if answer=='n':
+                if os.path.exists("maskbadcol.txt"):
+                    os.remove("maskbadcol.txt")
+                mask[:] = False
+                mask_library_key = None
+                break
+            else:
+                print('Please, type y or n ')
 
-                else:
-                    print('Please, type y or n ')
+    # Find the bad columns and interpolate them.
+    columns = detect_bad_columns(obj[2].data)
+    print('Bad columns found (x min, x max): ', columns)
+    add_bad_columns("maskbadcol.txt", columns, obj[2].shape[0])
+    mask_columns(mask, columns)
+    interpolate_bad_columns('gsqgemgs{}'.format(obj_std_name[0]), mask, 'bcgsqgemgs{}'.format(obj_std_name[0]))
+    obj=open_fits('bcgsqgemgs{}'.format(obj_std_name[0]))
 
-            except(NameError, SyntaxError,IndexError):
-                    print('')
-                    print("Check if you typed a correct line number. ")
+    # The bad columns are only checked by hand on request. The columns
+    # found are otherwise added to the library mask as candidates.
+    while True:
+        print('')
+        answer = ask('std.badcolumn.review', 'Do you wish to check the bad columns? (y/n) ',
+                     default='y' if has_answer('std.badcolumn.xmin') else 'n')
+        if answer in ('y', 'n'):
+            break
+        print('Please, type y or n ')
+    if answer=='n':
+        merge_columns(mask_library_key, mask.shape, columns, checked=False)
+        return
 
     # Select a line in the science object frame and print the pixel counting
     # through the line for bad column checking.
@@ -1384,7 +3174,8 @@ def std_badcolumn_std():
         try:
             print('')
             # Selected line.
-            line = int(input('Choose a line for bad column checking: ' ))
+            line = int(ask('std.badcolumn.line', 'Choose a line for bad column checking: ',
+                           default=obj[2].shape[0]//2))
             print('')
 
             xaxis=np.arange(1, obj[2].data.shape[1],1)
@@ -1392,22 +3183,11 @@ def std_badcolumn_std():
 
             # Print science object frame and pixel counting
             # through the selected line.
-            plt.figure(figsize=(16.0,8.0))
-            plt.figure(figsize=(16.0,8.0))
-            ax1=plt.subplot(211)
-            ax1.imshow(obj[2].data, origin='lower',cmap='afmhot',
-                           vmin=np.percentile(obj[2].data,1),
-                           vmax=np.percentile(obj[2].data,99), aspect='auto')
-            ax1.axhline(y=line, linestyle='--', color='red',linewidth=2., alpha=0.7)
-            ax1.set_ylabel('Position Along Slit', fontsize=14)
-            ax2=plt.subplot(212)
-            ax2.plot(xaxis, yaxis, color='red' )
-            ax2.set_xlim(left=np.min(xaxis), right=np.max(xaxis))
-            ax2.set_ylabel('Counts', fontsize=14)
-            ax2.set_xlabel('Dispersion Axis', fontsize=14)
-            plt.show()
-
-            answer = raw_input('Do you wish to select another line? (y/n) ')
+            show_figure(plot_line_check, {'image':qa_image(obj, 2, (1, 99)), 'line':line,
+                                          'x':xaxis, 'y':yaxis})
+
+            answer = ask('std.badcolumn.another_line', 'Do you wish to select another line? (y/n) ',
+                         default='n')
 
             if answer=='n':
                 break
@@ -1416,17 +3196,30 @@ def std_badcolumn_std():
             else:
                 print('Please, type y or n ')
 
-        except(NameError, SyntaxError,IndexError):
+        except(NameError, SyntaxError, IndexError, ValueError):
                 print('')
                 print("Check if you typed a correct line number. ")
 
+    # Add the columns found to the library mask once they are checked.
+    while columns:
+        print('')
+        answer = ask('std.badcolumn.keep_found', 'Do you wish to add the bad columns found to the mask '
+                     'of the calibration library? (y/n) ', default='y')
+        if answer=='y':
+            merge_columns(mask_library_key, mask.shape, columns)
+            break
+        if answer=='n':
+            break
+        print('Please, type y or n ')
+
     # Select the inital and final position along the x-axis of
     # the columns to interpolate.
     # Create a mask and interpolate bad column.
     while True:
         try:
             print('')
-            answer2 = raw_input('Do you wish to interpolate a bad column? (y/n) ')
+            answer2 = ask('std.badcolumn.interpolate', 'Do you wish to interpolate a bad column? (y/n) ',
+                          default='y' if has_answer('std.badcolumn.xmin') else 'n')
             print('')
 
             if answer2=='n':
@@ -1437,50 +3230,29 @@ def std_badcolumn_std():
                     try:
                         print('')
                         # Inital x position of the bad column.
-                        x1 = int(input('Select a column to interpolate (x min): ' ))
+                        x1 = int(ask('std.badcolumn.xmin', 'Select a column to interpolate (x min): '))
                         print('')
                         # Final x position of the bad column.
-                        x2 = int(input('Select a column to interpolate (x max): ' ))
-
-                        # Create text file with the column coordinates.
-                        bias_obj_txt = open("maskbadcol.txt","a")
-                        bias_obj_txt.write('{} {} 1 {}'.format(x1, x2, obj[2].shape[0]))
-                        bias_obj_txt.write("\n")
-                        bias_obj_txt.close()
-
-                        # Remove pre-existing mask.
-                        if os.path.exists("maskbadcol.pl"):
-                            os.remove("maskbadcol.pl")
-
-                        # Create mask based on coordinates text file.
-                        iraf.text2mask('maskbadcol.txt', 'maskbadcol.pl',
-                                        obj[2].shape[1], obj[2].shape[0]) # IRAF task 'text2mask'.
+                        x2 = int(ask('std.badcolumn.xmax', 'Select a column to interpolate (x max): '))
 
-                        # Interpolate bad columns using mask.
-                        iraf.fixpix('bcgsqgemgs{}[2]'.format(obj_std_name[0]),
-                                        'maskbadcol.pl', linterp='1,2,3,4') # IRAF task 'fixpix'.
+                        # Add the column to the mask and interpolate it.
+                        add_bad_columns("maskbadcol.txt", [(x1, x2)], obj[2].shape[0])
+                        mask_columns(mask, [(x1, x2)])
+                        interpolate_bad_columns('gsqgemgs{}'.format(obj_std_name[0]), mask,
+                                                'bcgsqgemgs{}'.format(obj_std_name[0]))
+                        merge_columns(mask_library_key, mask.shape, [(x1, x2)])
 
                         # Print corrected science object frame and pixel counting
                         # through the selected line.
-                        obj2=fits.open('bcgsqgemgs{}'.format(obj_std_name[0]))
+                        obj=open_fits('bcgsqgemgs{}'.format(obj_std_name[0]))
                         xaxis=np.arange(1, obj[2].data.shape[1],1)
                         yaxis=obj[2].data[line,1:obj[2].data.shape[1]]
-                        plt.figure(figsize=(16.0,8.0))
-                        ax1=plt.subplot(211)
-                        ax1.imshow(obj[2].data, origin='lower',cmap='afmhot',
-                                   vmin=np.percentile(obj[2].data,1),
-                                   vmax=np.percentile(obj[2].data,99), aspect='auto')
-                        ax1.axhline(y=line, linestyle='--', color='red',linewidth=2., alpha=0.7)
-                        ax1.set_ylabel('Position Along Slit', fontsize=14)
-                        ax2=plt.subplot(212)
-                        ax2.plot(xaxis, yaxis, color='red' )
-                        ax2.set_xlim(left=np.min(xaxis), right=np.max(xaxis))
-                        ax2.set_ylabel('Counts', fontsize=14)
-                        ax2.set_xlabel('Dispersion Axis', fontsize=14)
-                        plt.show()
+                        show_figure(plot_line_check, {'image':qa_image(obj, 2, (1, 99)), 'line':line,
+                                                      'x':xaxis, 'y':yaxis})
 
                         print('')
-                        answer3 = raw_input('Do you wish to interpolate another bad column? (y/n) ' )
+                        answer3 = ask('std.badcolumn.another', 'Do you wish to interpolate another bad column? (y/n) ',
+                                      default='y' if has_answer('std.badcolumn.xmin') else 'n')
 
                         if answer3=='n':
                             break
@@ -1489,14 +3261,14 @@ def std_badcolumn_std():
                         else:
                             print('Please, type y or n ')
 
-                    except(NameError, SyntaxError,IndexError):
+                    except(NameError, SyntaxError, IndexError, ValueError):
                             print('')
                             print("Check if you typed a correct line number. ")
                 break
             else:
                 print('Please, type y or n ')
 
-        except(NameError, SyntaxError,IndexError):
+        except(NameError, SyntaxError, IndexError, ValueError):
                 print('')
                 print("Check if you typed a correct line number. ")
 
@@ -1505,16 +3277,9 @@ def std_transf_std():
 
     print('# TRANSFORMING STANDARD STAR #')
 
-    # Remove pre-existing processed files.
-    if os.path.exists('tbcgsqgemgs{}'.format(obj_std_name[0])):
-        os.remove('tbcgsqgemgs{}'.format(obj_std_name[0]))
-
-    gmos.gstransform.unlearn() # Debug gstransform.
-    # Task parameters.
-    gstransformFlags={'wavtranam':'gs{}'.format(arc_std_name[0]),
-                    'fl_vardq':'yes'}
-    # Transform spectrum.
-    gmos.gstransform('bcgsqgemgs{}'.format(obj_std_name[0]), **gstransformFlags) # IRAF task gstransform.
+    # Rectify the SCI, VAR and DQ planes with the wavelength solution of
+    # the arc. The files made before are replaced.
+    transform_frame('bcgsqgemgs{}'.format(obj_std_name[0]), 'gs{}'.format(arc_std_name[0]))
 
 def std_sky_sub_std():
     """ Subtract sky background from standard star frame.
@@ -1533,30 +3298,16 @@ def std_sky_sub_std():
     gmos.gsskysub('tbcgsqgemgs{}'.format(obj_std_name[0]), **gsskysubFlags) # IRAF task gsskysub.
 
     # Print frames with and without sky correction.
-    obj=fits.open('tbcgsqgemgs{}'.format(obj_std_name[0]))
-    subobj=fits.open('stbcgsqgemgs{}'.format(obj_std_name[0]))
+    obj=open_fits('tbcgsqgemgs{}'.format(obj_std_name[0]))
+    subobj=open_fits('stbcgsqgemgs{}'.format(obj_std_name[0]))
     obj_data = obj[2].data
     subobj_data = subobj[2].data
     obj_shape = obj_data.shape
     subobj_shape = subobj_data.shape
-    plt.figure(figsize=(16.0,8.0))
-    plt.subplot(2, 1, 1)
-    plt.imshow(obj[2].data, origin='lower',cmap='afmhot',
-                   vmin=np.percentile(obj[2].data,5),
-                   vmax=np.percentile(obj[2].data,90), aspect='auto')
-    plt.ylabel('Position Along Slit', fontsize=14)
-    plt.subplot(2, 1, 2)
-    plt.imshow(subobj[2].data, origin='lower',cmap='afmhot',
-                   vmin=np.percentile(subobj[2].data,5),
-                   vmax=np.percentile(subobj[2].data,90), aspect='auto')
-    plt.xlabel('Dispersion Axis', fontsize=14)
-    plt.ylabel('Position Along Slit', fontsize=14)
-    plt.tight_layout(w_pad=-0.9)
-    plt.suptitle('Pre- and Post- Sky Subtraction', y=1.0)
-    plt.savefig('skysub-std-{}.png'.format(obj_std_name[0]))
-    plt.show()
-    plt.clf()
-    plt.close()
+    show_figure(plot_images, {'images':[[qa_image(obj, 2)], [qa_image(subobj, 2)]],
+                              'figsize':(16.0,8.0), 'xlabel':'Dispersion Axis',
+                              'title':'Pre- and Post- Sky Subtraction'},
+                'skysub-std-{}.png'.format(obj_std_name[0]))
 
 def std_extract_std():
     """ Extract standard star spectrum.
@@ -1583,37 +3334,28 @@ def std_extract_std():
                         max_rows=1, usecols=2, invalid_raise=False)
 
     # Load standard star frame.
-    obj=fits.open('stbcgsqgemgs{}'.format(obj_std_name[0]))
+    obj=open_fits('stbcgsqgemgs{}'.format(obj_std_name[0]))
     obj_data = obj[2].data
     obj_shape = obj_data.shape
 
     # Print frame with row of extracted spectrum.
-    fig = plt.figure(figsize=(14.0,6.0))
-    ax1 = fig.add_subplot(111)
-    plt.imshow(obj[2].data, origin='lower',cmap='afmhot',
-                   vmin=np.percentile(obj[2].data,5),
-                   vmax=np.percentile(obj[2].data,90), aspect='auto')
-    ax1.axhline(y=center, linestyle='--', color='red',linewidth=2., alpha=0.7)
-    plt.tight_layout(w_pad=-0.9)
-    plt.ylabel('Position Along Slit', fontsize=14)
-    plt.xlabel('Dispersion Axis', fontsize=14)
-    plt.suptitle('Extracted Spectrum Position', y=1.0, fontsize=14)
-    plt.savefig('extract_std-{}.png'.format(obj_std_name[0]))
-    plt.show()
-    plt.clf()
-    plt.close()
+    show_figure(plot_images, {'images':[[qa_image(obj, 2)]], 'line':center,
+                              'figsize':(14.0,6.0), 'xlabel':'Dispersion Axis',
+                              'title':'Extracted Spectrum Position'},
+                'extract_std-{}.png'.format(obj_std_name[0]))
 
     # Check if the spectrum position is correct.
     # Select another row to extract the spectrum.
     while True:
         print('')
-        answer1 = raw_input('Are you satisfied with the extracted spectrum position? [y/n]')
+        answer1 = ask('std.extract.satisfied', 'Are you satisfied with the extracted spectrum position? [y/n]',
+                      default='n' if has_answer('std.extract.row') else 'y')
         if answer1 == "y":
             break
 
         if answer1 == "n":
             print('')
-            answer2 = raw_input('Type the new row position for extracting the spectrum: ')
+            answer2 = ask('std.extract.row', 'Type the new row position for extracting the spectrum: ')
 
             # Remove extraction info (last) file in the database directory.
             os.remove('database/aplast')
@@ -1637,31 +3379,21 @@ def std_extract_std():
                         max_rows=1, usecols=2, invalid_raise=False)
 
             # Load standard star frame.
-            obj=fits.open('stbcgsqgemgs{}'.format(obj_std_name[0]))
+            obj=open_fits('stbcgsqgemgs{}'.format(obj_std_name[0]))
             obj_data = obj[2].data
             obj_shape = obj_data.shape
 
             # Print frame with row of extracted spectrum.
-            fig = plt.figure(figsize=(14.0,6.0))
-            ax1 = fig.add_subplot(111)
-            plt.imshow(obj[2].data, origin='lower',cmap='afmhot',
-                           vmin=np.percentile(obj[2].data,5),
-                           vmax=np.percentile(obj[2].data,90), aspect='auto')
-            ax1.axhline(y=center, linestyle='--', color='red',linewidth=2., alpha=0.7)
-            plt.tight_layout(w_pad=-0.9)
-            plt.ylabel('Position Along Slit', fontsize=14)
-            plt.xlabel('Dispersion Axis', fontsize=14)
-            plt.suptitle('Extracted Spectrum Position', y=1.0, fontsize=14)
-            plt.savefig('extract_std-{}.png'.format(obj_std_name[0]))
-            plt.show()
-            plt.clf()
-            plt.close()
+            show_figure(plot_images, {'images':[[qa_image(obj, 2)]], 'line':center,
+                                      'figsize':(14.0,6.0), 'xlabel':'Dispersion Axis',
+                                      'title':'Extracted Spectrum Position'},
+                        'extract_std-{}.png'.format(obj_std_name[0]))
 
         else:
             print "Type y or n"
 
     # Load extracted standard star spectrum.
-    obj=fits.open('estbcgsqgemgs{}'.format(obj_std_name[0]))
+    obj=open_fits('estbcgsqgemgs{}'.format(obj_std_name[0]))
     obj_header = obj[2].header
     obj_data = obj[2].data
     obj_shape = obj_data.shape
@@ -1669,19 +3401,11 @@ def std_extract_std():
     cd1_1 = obj_header['CD1_1']
 
     # Print extracted standard star spectrum
-    fig, ax = plt.subplots(figsize=(14.0,6.0))
-    plt.plot(crval + cd1_1*np.arange(1,len(obj[2].data)+1,1), obj[2].data, linewidth=0.55)
-    ax.xaxis.set_major_locator(MultipleLocator(500))
-    ax.xaxis.set_minor_locator(MultipleLocator(50))
-    ax.set_ylim(np.percentile(obj[2].data,5), np.percentile(obj[2].data,95))
-    plt.ylabel('Counts', fontsize=14)
-    plt.xlabel(r'Wavelength $\ [\AA]$', fontsize=14)
-    plt.title('Extracted Spectrum', fontsize=14)
-    plt.tight_layout(w_pad=-0.9)
-    plt.savefig('extracted_spec_std-{}.png'.format(obj_std_name[0]))
-    plt.show()
-    plt.clf()
-    plt.close()
+    show_figure(plot_spectra, {'curves':[(crval + cd1_1*np.arange(1,len(obj[2].data)+1,1),
+                                          obj[2].data, {'linewidth':0.55})],
+                               'ylim':(np.percentile(obj[2].data,5), np.percentile(obj[2].data,95)),
+                               'ylabel':'Counts', 'title':'Extracted Spectrum'},
+                'extracted_spec_std-{}.png'.format(obj_std_name[0]))
 
 def std_calib_std():
     """ Create sensitivity function for the standard star.
@@ -1704,7 +3428,7 @@ def std_calib_std():
         os.remove('logstandard')
 
     # Load standard star file.
-    obj = fits.open('estbcgsqgemgs{}'.format(obj_std_name[0]))
+    obj = open_fits('estbcgsqgemgs{}'.format(obj_std_name[0]))
     obj_header = obj[0].header
     # Name of standard star.
     obj_name = obj_header['OBJECT']
@@ -1758,7 +3482,7 @@ def std_calib_std():
     gmos.gsstandard('estbcgsqgemgs{}'.format(obj_std_name[0]), **gsstandardFlags) # IRAF task gsstandard.
 
     # Load sensitivity function.
-    sens = fits.open('sens.fits')
+    sens = open_fits('sens.fits')
     sens_data = sens[0].data
     sens_header = sens[0].header
     crval1 = sens[0].header['CRVAL1']
@@ -1783,21 +3507,11 @@ def std_calib_std():
                                     max_rows = number_of_lines, invalid_raise=False)
 
     # Plot sensitivity function, its order, RMS and residual.
-    plt.figure(figsize=(14.0,6.0))
-    ax1 = plt.subplot(2,1,1)
-    ax1.plot(wavelength_sens, sens_data)
-    ax1.scatter(wavelength_logstandard, fit_logstandard, color='red', s=25, marker='x')
-    ax1.set_ylabel('Sensitivity', fontsize=12)
-    ax1.set_xlabel('Wavelength', fontsize=12)
-    ax2 = plt.subplot(2,1,2)
-    ax2.scatter(wavelength_logstandard, resid_logstandard, s=25, color='red', marker='x')
-    ax2.axhline(y=0, linestyle='--')
-    ax2.set_xlabel('Wavelength', fontsize=12)
-    ax2.set_ylabel('Residual', fontsize=12)
-    plt.tight_layout(w_pad=-0.9)
-    plt.suptitle('Function = {}  Order = {} RMS = {}'.format(func, ord, RMS_logstandard), fontsize=12,y=1.0)
-    plt.savefig('plot-gsstandard-{}.png'.format(obj_std_name[0]))
-    plt.show()
+    show_figure(plot_sensitivity, {'wavelength':wavelength_sens, 'sensitivity':sens_data,
+                                   'points':wavelength_logstandard, 'fit':fit_logstandard,
+                                   'residual':resid_logstandard,
+                                   'title':'Function = {}  Order = {} RMS = {}'.format(func, ord, RMS_logstandard)},
+                'plot-gsstandard-{}.png'.format(obj_std_name[0]))
 
     print('# CALIBRATING... # ')
 
@@ -1810,7 +3524,7 @@ def std_calib_std():
     gmos.gscalibrate('estbcgsqgemgs{}'.format(obj_std_name[0])) # IRAF task gscalibrate.
 
     # Load calibrated spectrum.
-    obj=fits.open('cestbcgsqgemgs{}'.format(obj_std_name[0]))
+    obj=open_fits('cestbcgsqgemgs{}'.format(obj_std_name[0]))
     obj_header = obj[2].header
     obj_data = obj[2].data
     obj_shape = obj_data.shape
@@ -1818,19 +3532,12 @@ def std_calib_std():
     cd1_1 = obj_header['CD1_1']
 
     # Plot calibrated spectrum of standard star.
-    fig, ax = plt.subplots(figsize=(14.0,6.0))
-    plt.plot(crval + cd1_1*np.arange(1,obj_shape[0]+1,1), obj[2].data,linewidth=0.55)
-    ax.xaxis.set_major_locator(MultipleLocator(500))
-    ax.xaxis.set_minor_locator(MultipleLocator(50))
-    ax.set_ylim(np.percentile(obj[2].data,5), np.percentile(obj[2].data,95))
-    plt.ylabel('Flux [ergs cm$^{-2}$ s$^{-1}$ $\ \AA$$^{-1}$] ', fontsize=14)
-    plt.xlabel(r'Wavelength $\ [\AA]$', fontsize=14)
-    plt.title('Calibrated Spectrum', fontsize=14)
-    plt.tight_layout(w_pad=-0.9)
-    plt.savefig('calib-spec-std-{}.png'.format(obj_std_name[0]))
-    plt.show()
-    plt.clf()
-    plt.close()
+    show_figure(plot_spectra, {'curves':[(crval + cd1_1*np.arange(1,obj_shape[0]+1,1),
+                                          obj[2].data, {'linewidth':0.55})],
+                               'ylim':(np.percentile(obj[2].data,5), np.percentile(obj[2].data,95)),
+                               'ylabel':'Flux [ergs cm$^{-2}$ s$^{-1}$ $\ \AA$$^{-1}$] ',
+                               'title':'Calibrated Spectrum'},
+                'calib-spec-std-{}.png'.format(obj_std_name[0]))
 
 # Reduction and calibration of SCIENCE OBJECT files.
 print "------------------------------"
@@ -1847,75 +3554,29 @@ def obj_gbias():
     if os.path.exists('Bias.fits'):
         os.remove('Bias.fits')
 
-    gmos.gbias.unlearn() # Debug gbias.
-    # Set the task parameters.
-    biasFlags = {'rawpath':'raw', 'fl_over':'yes',
-                'fl_trim':'yes', 'fl_vardq':'yes'}
-    # Create Master Bias.
-    gmos.gbias('@bias_obj.txt', 'Bias.fits', **biasFlags) # IRAF task gbias.
+    # Take the Master Bias from the calibration library if it was
+    # already made from the same bias frames.
+    biases = [bias.replace('\n','') for bias in open('bias_obj.txt')]
+    bias_key = master_key('bias', biases, method='native')
+    with library_lock(bias_key):
+        if not fetch_master(bias_key, 'Bias.fits'):
+            # Create Master Bias.
+            combine_biases(biases, 'Bias.fits')
+            store_master(bias_key, 'Bias.fits')
 
     # Load Master Bias.
-    obj=fits.open('Bias.fits')
-    obj_data = obj[2].data
+    obj=open_fits('Bias.fits')
+    obj_data = obj['SCI', 1].data
     obj_shape = obj_data.shape
 
     # Print Master Bias.
-    plt.figure(figsize=(14.0,4.0))
-    for i in range(len(np.arange(0,12,1))):
-        ax = plt.subplot(1, 12,i+1)
-        plt.imshow(obj[i+1].data, origin='lower',cmap='afmhot',
-                   vmin=np.percentile(obj[i+1].data,5),
-                   vmax=np.percentile(obj[i+1].data,90), aspect='auto')
-        if i == 0:
-            ax.yaxis.set_visible(True)
-            ax.set_ylabel('Position Along Slit', fontsize=14)
-        else:
-            ax.yaxis.set_visible(False)
-
-    plt.tight_layout(w_pad=-0.9)
-    plt.suptitle('Master BIAS', y=1.0, fontsize=14)
-    plt.savefig('master-bias-obj-{}.png'.format(obj_sci_name[0]))
-    plt.show()
-    plt.clf()
-    plt.close()
+    show_figure(plot_images, {'images':[[qa_image(obj, ('SCI', i+1)) for i in range(12)]],
+                              'figsize':(14.0,4.0), 'title':'Master BIAS'},
+                'master-bias-obj-{}.png'.format(obj_sci_name[0]))
 
     # Print the pixel counting through a line cut.
-    plt.figure(figsize=(16.0,8.0))
-    for j in range(len(np.arange(0,12,1))):
-        ax1 = plt.subplot(3, 12,j+1)
-        ax1.set_ylim(min(obj[1].data[int(0.3*obj_shape[0]),1:obj_shape[1]]),
-                        max(obj[1].data[int(0.3*obj_shape[0]),1:obj_shape[1]]))
-        ax1.plot(np.arange(1,obj_shape[1],1),
-                    obj[j+1].data[int(0.3*obj_shape[0]),1:obj_shape[1]],linewidth=0.5)
-
-        ax2 = plt.subplot(3, 12,12+j+1)
-        ax2.set_ylim(min(obj[1].data[int(0.5*obj_shape[0]),1:obj_shape[1]]),
-                        max(obj[1].data[int(0.5*obj_shape[0]),1:obj_shape[1]]))
-        ax2.plot(np.arange(1,obj_shape[1],1),
-                    obj[j+1].data[int(0.5*obj_shape[0]),1:obj_shape[1]],linewidth=0.5)
-
-        ax3 = plt.subplot(3, 12, 24+j+1)
-        ax3.set_ylim(min(obj[1].data[int(0.7*obj_shape[0]),1:obj_shape[1]]),
-                        max(obj[1].data[int(0.7*obj_shape[0]),1:obj_shape[1]]))
-        ax3.plot(np.arange(1,obj_shape[1],1),
-                    obj[j+1].data[int(0.7*obj_shape[0]),1:obj_shape[1]],linewidth=0.5)
-        if j == 0:
-            ax1.yaxis.set_visible(True)
-            ax1.set_ylabel('Counts [row={}]'.format(int(0.3*obj_shape[0])), fontsize=14)
-            ax2.yaxis.set_visible(True)
-            ax2.set_ylabel('Counts [row={}]'.format(int(0.5*obj_shape[0])), fontsize=14)
-            ax3.yaxis.set_visible(True)
-            ax3.set_ylabel('Counts [row={}]'.format(int(0.7*obj_shape[0])), fontsize=14)
-        else:
-            ax1.yaxis.set_visible(False)
-            ax2.yaxis.set_visible(False)
-            ax3.yaxis.set_visible(False)
-
-    plt.tight_layout(w_pad=-0.9)
-    plt.suptitle('Pixel Counting',y=1.0, fontsize=14)
-    plt.savefig('pixel-counting-bias-obj-{}.png'.format(obj_sci_name[0]))
-    plt.show()
-    plt.close()
+    show_figure(plot_line_cuts, line_cuts(obj, [('SCI', i) for i in range(1,13)], ('SCI', 1)),
+                'pixel-counting-bias-obj-{}.png'.format(obj_sci_name[0]))
 
 def obj_reduc_arc():
     """ Apply overscan correction and mosaic arc frames. """
@@ -1942,260 +3603,99 @@ def obj_wavelength_arc():
     print('# CALIBRATING WAVELENGTH #')
 
     # Remove pre-existing wavelength solution files on database directory.
-    if os.path.exists('database/idgs{}_001'.format(arc_sci_name[0].replace('.fits',''))):
-        os.remove('database/idgs{}_001'.format(arc_sci_name[0].replace('.fits','')))
+    for prefix in ('id', 'fc'):
+        if os.path.exists('database/{}gs{}_001'.format(prefix, arc_sci_name[0].replace('.fits',''))):
+            os.remove('database/{}gs{}_001'.format(prefix, arc_sci_name[0].replace('.fits','')))
 
     # Load reduced arc frame.
-    obj=fits.open('gs{}'.format(arc_sci_name[0]))
+    obj=open_fits('gs{}'.format(arc_sci_name[0]))
     obj_data = obj[2].data
     arc_shape = obj_data.shape
 
-    gmos.gswavelength.unlearn() # Debug gswavelength.
-    # Set the task parameters.
-    gswavelengthFlags={'nsum':str(arc_shape[0]/3), 'step':str(arc_shape[0]/3),
-                        'fwidth':'7', 'gsigma':'1.5','cradius':'12',
-                        'minsep':'7', 'order':'6', 'fl_inter':'no'}
-    gmos.gswavelength('gs{}'.format(arc_sci_name[0]), **gswavelengthFlags) # IRAF task gswavelength.
-
-    # Read wavelength solution file on database directory.
-    # Autoidentify.
-    # Number of calculated features.
-    number_of_features_auto = np.genfromtxt('database/idgs{}_001'.format(arc_sci_name[0].replace('.fits','')),
-                                            skip_header=6, usecols=1, max_rows=1, invalid_raise=False)
-    # Number of calculated coefficients.
-    number_of_coefficients_auto = np.genfromtxt('database/idgs{}_001'.format(arc_sci_name[0].replace('.fits','')),
-                                            skip_header=7+int(number_of_features_auto)+8, usecols=1,
-                                                max_rows=1, invalid_raise=False)
-    # gswavelength flags to discard outlier values.
-    wave_flag_auto = np.genfromtxt('database/idgs{}_001'.format(arc_sci_name[0].replace('.fits','')), skip_header=7,
-                                usecols=5, max_rows=int(number_of_features_auto), invalid_raise=False)
-    # Row number.
-    wave_auto_col_0 = np.genfromtxt('database/idgs{}_001'.format(arc_sci_name[0].replace('.fits','')), skip_header=7,
-                                usecols=0, max_rows=int(number_of_features_auto), invalid_raise=False)
-    # Corrected line wavelength.
-    wave_auto_col_1  = np.genfromtxt('database/idgs{}_001'.format(arc_sci_name[0].replace('.fits','')), skip_header=7,
-                                usecols=1, max_rows=int(number_of_features_auto), invalid_raise=False)
-    # Calculated line wavelength.
-    wave_auto_col_2  = np.genfromtxt('database/idgs{}_001'.format(arc_sci_name[0].replace('.fits','')), skip_header=7,
-                                usecols=2, max_rows=int(number_of_features_auto), invalid_raise=False)
-
-    # Reidentify.
-    # Number of calculated features.
-    number_of_features_re1 = np.genfromtxt('database/idgs{}_001'.format(arc_sci_name[0].replace('.fits','')),
-                             skip_header=7+int(number_of_features_auto)+9+int(number_of_coefficients_auto)+7,
-                                        usecols=1, max_rows=1, invalid_raise=False)
-
-    number_of_coefficients_re1 = np.genfromtxt('database/idgs{}_001'.format(arc_sci_name[0].replace('.fits','')),
-           skip_header=7+int(number_of_features_auto)+9+int(number_of_coefficients_auto)+8+int(number_of_features_re1)+8,
-                                        usecols=1, max_rows=1, invalid_raise=False)
-
-    # gswavelength flags to discard outlier values.
-    wave_flag_re1 = np.genfromtxt('database/idgs{}_001'.format(arc_sci_name[0].replace('.fits','')),
-                                skip_header=7+int(number_of_features_auto)+9+int(number_of_coefficients_auto)+8,
-                                usecols=5, max_rows=int(number_of_features_re1), invalid_raise=False)
-    # Row number.
-    wave_re1_col_0 = np.genfromtxt('database/idgs{}_001'.format(arc_sci_name[0].replace('.fits','')),
-                                skip_header=7+int(number_of_features_auto)+9+int(number_of_coefficients_auto)+8, usecols=0,
-                                max_rows=int(number_of_features_re1), invalid_raise=False)
-    # Corrected line wavelength.
-    wave_re1_col_1 = np.genfromtxt('database/idgs{}_001'.format(arc_sci_name[0].replace('.fits','')),
-                                skip_header=7+int(number_of_features_auto)+9+int(number_of_coefficients_auto)+8, usecols=1,
-                                max_rows=int(number_of_features_re1), invalid_raise=False)
-    # Calculated line wavelength.
-    wave_re1_col_2 = np.genfromtxt('database/idgs{}_001'.format(arc_sci_name[0].replace('.fits','')),
-                                skip_header=7+int(number_of_features_auto)+9+int(number_of_coefficients_auto)+8, usecols=2,
-                                max_rows=int(number_of_features_re1), invalid_raise=False)
-
-    # Reidentify.
-    # Number of calculated features.
-
-    number_of_features_re2 = np.genfromtxt('database/idgs{}_001'.format(arc_sci_name[0].replace('.fits','')),
-                                        skip_header=(7+int(number_of_features_auto)+9+int(number_of_coefficients_auto)
-                                        +8+int(number_of_features_re1)+9+int(number_of_coefficients_re1)+7),
-                                           usecols=1, max_rows=1, invalid_raise=False)
-
-    # gswavelength flags to discard outlier values.
-    wave_flag_re2 = np.genfromtxt('database/idgs{}_001'.format(arc_sci_name[0].replace('.fits','')),
-                                skip_header=(7+int(number_of_features_auto)+9+int(number_of_coefficients_auto)
-                                        +8+int(number_of_features_re1)+9+int(number_of_coefficients_re1)+8),
-                                  usecols=5, max_rows=int(number_of_features_re2), invalid_raise=False)
-    # Row number.
-    wave_re2_col_0 = np.genfromtxt('database/idgs{}_001'.format(arc_sci_name[0].replace('.fits','')),
-                                skip_header=(7+int(number_of_features_auto)+9+int(number_of_coefficients_auto)
-                                        +8+int(number_of_features_re1)+9+int(number_of_coefficients_re1)+8),
-                                  usecols=0, max_rows=int(number_of_features_re2), invalid_raise=False)
-    # Corrected line wavelength.
-    wave_re2_col_1 = np.genfromtxt('database/idgs{}_001'.format(arc_sci_name[0].replace('.fits','')),
-                                skip_header=(7+int(number_of_features_auto)+9+int(number_of_coefficients_auto)
-                                        +8+int(number_of_features_re1)+9+int(number_of_coefficients_re1)+8),
-                                  usecols=1, max_rows=int(number_of_features_re2), invalid_raise=False)
-    # Calculated line wavelength.
-    wave_re2_col_2 = np.genfromtxt('database/idgs{}_001'.format(arc_sci_name[0].replace('.fits','')),
-                                skip_header=(7+int(number_of_features_auto)+9+int(number_of_coefficients_auto)
-                                        +8+int(number_of_features_re1)+9+int(number_of_coefficients_re1)+8),
-                                  usecols=2, max_rows=int(number_of_features_re2), invalid_raise=False)
-
-    # gswavelength flags
-    flag_auto = np.where(wave_flag_auto[0:,] == 1) # Autoidentify.
-    flag_re1 = np.where(wave_flag_re1[0:,] == 1) # Reidentify.
-    flag_re2 = np.where(wave_flag_re2[0:,] == 1) # Reidentify.
-
-    # RMS estimate.
-
-    # Autoidentify.
-    rows_auto = wave_auto_col_0[0:,][flag_auto]
-    delta_lambda_auto = wave_auto_col_2[0:,][flag_auto] - wave_auto_col_1[0:,][flag_auto]
-    rms_auto = np.sqrt(np.sum(delta_lambda_auto**2) / len(rows_auto))
-
-    print("[AUTOIDENTIFY] RMS = ", rms_auto)
-
-    hig_than_rms_auto=[] # Values higher than RMS.
-    for l in range(len(delta_lambda_auto)):
-        if np.abs(delta_lambda_auto[l]) > rms_auto:
-            hig_than_rms_auto.append( wave_auto_col_2[0:,][flag_auto][l])
-    # Print number of lines with values diverging from the correct value
-    # whith a difference higher thant the RMS.
-    print("[AUTOIDENTIFY] There are {} identified lines diverging from the"
-            " observed value with differences higher than the RMS :".format(len(hig_than_rms_auto)), hig_than_rms_auto)
-
-     # Reidentify.
-    rows_re1 = wave_re1_col_0[0:,][flag_re1]
-    delta_lambda_re1 = wave_re1_col_2[0:,][flag_re1] - wave_re1_col_1[0:,][flag_re1]
-    rms_re1 = np.sqrt(np.sum(delta_lambda_re1**2) / len(rows_re1))
-
-    print('[REIDENTIFY] RMS = ', rms_re1)
-
-    hig_than_rms_re1=[] # Values higher than RMS.
-    for l in range(len(delta_lambda_re1)):
-        if np.abs(delta_lambda_re1[l]) > rms_re1:
-            hig_than_rms_re1.append(wave_re1_col_2[0:,][flag_re1][l])
-    # Print number of lines with values diverging from the correct value
-    # whith a difference higher thant the RMS.
-    print("[REIDENTIFY] There are {} identified lines diverging from the"
-            " observed value with differences higher than the RMS :".format(len(hig_than_rms_re1)), hig_than_rms_re1)
-
-    # Reidentify.
-    rows_re2 = wave_re2_col_0[0:,][flag_re2]
-    delta_lambda_re2 = wave_re2_col_2[0:,][flag_re2] - wave_re2_col_1[0:,][flag_re2]
-    rms_re2 = np.sqrt(np.sum(delta_lambda_re2**2) / len(rows_re2))
-
-    print('[REIDENTIFY] RMS = ', rms_re2)
-
-    hig_than_rms_re2=[]  # Values higher than RMS.
-    for l in range(len(delta_lambda_re2)):
-        if np.abs(delta_lambda_re2[l]) > rms_re2:
-            hig_than_rms_re2.append(wave_re2_col_2[0:,][flag_re2][l])
-    # Print number of lines with values diverging from the correct value
-    # whith a difference higher thant the RMS.
-    print("[REIDENTIFY] There are {} identified lines diverging from the"
-            " observed value with differences higher than the RMS :".format(len(hig_than_rms_re2)), hig_than_rms_re2)
+    # Shift the library solution of an arc with the same settings, or
+    # identify the lines again if there is none or it does not match.
+    shifted = shift_arc_solution(arc_sci_name[0])
+    if not shifted:
+        gmos.gswavelength.unlearn() # Debug gswavelength.
+        # Set the task parameters.
+        gswavelengthFlags={'nsum':str(arc_shape[0]/3), 'step':str(arc_shape[0]/3),
+                            'fwidth':'7', 'gsigma':'1.5','cradius':'12',
+                            'minsep':'7', 'order':'6', 'fl_inter':'no'}
+        gmos.gswavelength('gs{}'.format(arc_sci_name[0]), **gswavelengthFlags) # IRAF task gswavelength.
+
+    # Read wavelength solution file on database directory: the
+    # autoidentify block and the reidentify blocks.
+    solution = read_database('database/idgs{}_001'.format(arc_sci_name[0].replace('.fits','')))
+    qa = wavelength_qa(solution)
+    print_wavelength_qa(qa)
+    stage_metrics['wavelength'] = wavelength_metrics(qa)
 
     # Print the difference of the calculated and correct wavelength values
     # for the estimated lines.
-    # Autoidentify.
-    fig = plt.figure(figsize=(14.0,6.0))
-    ax1 = fig.add_subplot(111)
-    ax2 = ax1.twiny()
-    ax3 = ax1.twiny()
-    ax4 = ax1.twiny()
-    ax1.scatter(rows_auto,np.abs(delta_lambda_auto), color='white' )
-    ax2.scatter(wave_auto_col_2[0:,][flag_auto], np.abs(delta_lambda_auto), color='coral')
-    ax2.invert_xaxis()
-    plt.title('Autoidentify', y=1.10, fontsize=14)
-    ax2.set_xlabel(r'$\lambda_{identified} \ [\AA]$', fontsize=14)
-    ax1.set_xlabel('Pixel position', fontsize=14)
-    ax1.set_ylabel(r'|$\lambda_{identified} - \lambda_{fitted}| \ [\AA]$', fontsize=14)
-    ax3.axhline(y=0.2, linestyle='--')
-    ax3.xaxis.set_visible(False)
-    ax4.axhline(y=rms_auto, linestyle=':', label='RMS = {}'.format(rms_auto))
-    ax4.xaxis.set_visible(False)
-    plt.tight_layout(w_pad=-0.9)
-    ax4.legend()
-    plt.savefig('autoidentify_obj-{}.png'.format(obj_sci_name[0]))
-    plt.show()
-    plt.close()
-
-    # Reidentify.
-    fig = plt.figure(figsize=(14.0,6.0))
-    ax1 = fig.add_subplot(111)
-    ax2 = ax1.twiny()
-    ax3 = ax1.twiny()
-    ax4 = ax1.twiny()
-    ax1.scatter(rows_re1,np.abs(delta_lambda_re1), color='white' )
-    ax2.scatter(wave_re1_col_2[0:,][flag_re1] ,np.abs(delta_lambda_re1), color='coral')
-    ax2.invert_xaxis()
-    plt.title('Reidentify', y=1.10, fontsize=14)
-    ax2.set_xlabel(r'$\lambda_{identified} \ [\AA]$', fontsize=14)
-    ax1.set_xlabel('Pixel position', fontsize=14)
-    ax1.set_ylabel(r'|$\lambda_{identified} - \lambda_{fitted}| \ [\AA]$', fontsize=14)
-    ax3.axhline(y=0.2, linestyle='--')
-    ax3.xaxis.set_visible(False)
-    ax4.axhline(y=rms_re1, linestyle=':', label='RMS = {}'.format(rms_re1))
-    ax4.xaxis.set_visible(False)
-    plt.tight_layout(w_pad=-0.9)
-    ax4.legend()
-    plt.show()
-    plt.close()
-
-    # Reidentify.
-    fig = plt.figure(figsize=(14.0,6.0))
-    ax1 = fig.add_subplot(111)
-    ax2 = ax1.twiny()
-    ax3 = ax1.twiny()
-    ax4 = ax1.twiny()
-    ax1.scatter(rows_re2,np.abs(delta_lambda_re2), color='white' )
-    ax2.scatter(wave_re2_col_2[0:,][flag_re2] ,np.abs(delta_lambda_re2), color='coral')
-    ax2.invert_xaxis()
-    plt.title('Reidentify', y=1.10, fontsize=14)
-    ax2.set_xlabel(r'$\lambda_{identified} \ [\AA]$', fontsize=14)
-    ax1.set_xlabel('Pixel position', fontsize=14)
-    ax1.set_ylabel(r'|$\lambda_{identified} - \lambda_{fitted}| \ [\AA]$', fontsize=14)
-    ax3.axhline(y=0.2, linestyle='--')
-    ax3.xaxis.set_visible(False)
-    ax4.axhline(y=rms_re2, linestyle=':', label='RMS = {}'.format(rms_re2))
-    ax4.xaxis.set_visible(False)
-    plt.tight_layout(w_pad=-0.9)
-    ax4.legend()
-    plt.show()
-    plt.close()
-
+    for i, block in enumerate(qa['blocks']):
+        show_figure(plot_identify, {'title':'Autoidentify' if i == 0 else 'Reidentify',
+                                    'pixels':block['pixels'], 'wavelengths':block['wavelengths'],
+                                    'delta':block['delta'], 'rms':block['clipped_rms']},
+                    'autoidentify_obj-{}.png'.format(obj_sci_name[0]) if i == 0 else None)
+    show_figure(plot_residual_map, {'title':'Wavelength residuals', 'map':qa['map'],
+                                    'pixels':qa['pixels'],
+                                    'rows':[block['row'] for block in qa['blocks']]},
+                'wavelength_residuals_obj-{}.png'.format(obj_sci_name[0]))
+
+    check_wavelength_qa(qa, arc_sci_name[0])
+    if not shifted:
+        store_arc_solution(arc_sci_name[0])
 
 def obj_transf_arc():
     """ Transform arc files. """
 
     print('# TRANSFORMING ARC #')
 
-    # Remove pre-existing transformed files.
-    if os.path.exists('tgs{}'.format(arc_sci_name[0])):
-        os.remove('tgs{}'.format(arc_sci_name[0]))
+    # Rectify the arc with its own wavelength solution. The files made
+    # before are replaced.
+    transform_frame('gs{}'.format(arc_sci_name[0]), 'gs{}'.format(arc_sci_name[0]))
 
-    gmos.gstransform.unlearn() # Debug gstransform.
-    # Set the task parameters.
-    gstransformFlags={'wavtranam':'gs{}'.format(arc_sci_name[0])}
-    # Transform arc files.
-    gmos.gstransform('gs{}'.format(arc_sci_name[0]), **gstransformFlags) # IRAF task gstransform.
+def obj_flat_key(kind='flat'):
+    """ Library key of the Master Flat, or with kind 'qecorr' of the
+        quantum efficiency correction image kept with it. The flat frames
+        are bias subtracted and quantum-efficiency corrected with the ARC
+        as reference. """
+
+    flats = [flat.replace('\n','') for flat in open('flat_obj.txt')]
+    biases = [bias.replace('\n','') for bias in open('bias_obj.txt')]
+
+    return master_key(kind, flats, biases + [arc_sci_name[0]],
+                      method='native' if kind == 'flat' else None)
+
+def obj_flat_in_library():
+    """ True if the Master Flat and its quantum efficiency correction
+        image are both in the calibration library. """
+
+    return (find_master(obj_flat_key()) is not None
+            and find_master(obj_flat_key('qecorr')) is not None)
 
 def obj_reduc_flat():
     """ Subtract bias from individual flat frames. """
 
     print('# REDUCING RAW FLATS #')
 
-    # Open individual flat frames.
-    f = open('flat_obj.txt', 'r')
-    for flatfile in f:
-        # Remove pre-existing processed files.
-        if os.path.exists('gs{}'.format(flatfile.replace('\n',''))):
-            os.remove('gs{}'.format(flatfile.replace('\n','')))
+    # The individual flat frames are not needed if the Master Flat is
+    # in the calibration library.
+    if obj_flat_in_library():
+        print('Master Flat found in the calibration library.')
+        return
 
-        gmos.gsreduce.unlearn() # Debug gsreduce.
-        # Set the task parameters.
-        gsreduceFlags={'rawpath':'raw', 'fl_bias':'yes',
-                        'fl_flat':'no', 'fl_fixpix':'no',
-                        'bias':'Bias.fits','fl_gmos':'no',
-                        'fl_gsappwave':'no', 'fl_cut':'no'}
-        # Reduce flat files.
-        gmos.gsreduce(str(flatfile.replace('\n','')), **gsreduceFlags) # IRAF task gsreduce.
-    f.close()
+    # Individual flat frames.
+    flats = [flat.replace('\n','') for flat in open('flat_obj.txt')]
+
+    # Set the task parameters.
+    gsreduceFlags={'rawpath':'raw', 'fl_bias':'yes',
+                    'fl_flat':'no', 'fl_fixpix':'no',
+                    'bias':'Bias.fits','fl_gmos':'no',
+                    'fl_gsappwave':'no', 'fl_cut':'no'}
+    # Reduce flat files, several at a time.
+    run_frame_tasks([('gsreduce', flat, 'gs'+flat, gsreduceFlags)
+                     for flat in flats], 'obj_reduc_flat') # IRAF task gsreduce.
 
 def obj_qecorr_flat():
     """ Apply quantum efficiency correction to individual
@@ -2203,50 +3703,60 @@ def obj_qecorr_flat():
 
     print('# QUANTUM-CORRECTING FLAT #')
 
-    # Open individual flat frames.
-    f = open('flat_obj.txt', 'r')
-    for flatfile in f:
-        # Remove pre-existing processed files.
-        if os.path.exists('qgs{}'.format(flatfile.replace('\n',''))):
-            os.remove('qgs{}'.format(flatfile.replace('\n','')))
+    # Remove the correction image made from a previous ARC solution.
+    if os.path.exists('qecorrgs{}'.format(arc_sci_name[0])):
+        os.remove('qecorrgs{}'.format(arc_sci_name[0]))
 
-        gmos.gqecorr.unlearn() # Debug gqecorr.
-        # Set the task parameters.
-        qecorrFlags= {'refimage':'gs{}'.format(arc_sci_name[0]),
-                    'fl_keep':'yes'}
-        # Apply quantum efficiency correction.
-        gmos.gqecorr('gs{}'.format(flatfile.replace('\n','')), **qecorrFlags) # IRAF task gqecorr.
-    f.close()
+    # Set the task parameters.
+    qecorrFlags= {'refimage':'gs{}'.format(arc_sci_name[0]),
+                'fl_keep':'yes', 'corrimages':'qecorrgs{}'.format(arc_sci_name[0])}
+
+    # The flat frames are not corrected if the Master Flat is in the
+    # calibration library: the correction image kept with it is used.
+    if obj_flat_in_library():
+        print('Master Flat found in the calibration library.')
+        fetch_master(obj_flat_key('qecorr'), 'qecorrgs{}'.format(arc_sci_name[0]))
+        return
+
+    # Individual flat frames.
+    flats = [flat.replace('\n','') for flat in open('flat_obj.txt')]
+
+    # Apply quantum efficiency correction. The correction image made from
+    # the ARC is kept by the first frame and reused by the others, which
+    # then run several at a time.
+    jobs = [('gqecorr', 'gs'+flat, 'qgs'+flat, qecorrFlags) for flat in flats]
+    run_frame_tasks(jobs[:1], 'obj_qecorr_flat') # IRAF task gqecorr.
+    store_master(obj_flat_key('qecorr'), 'qecorrgs{}'.format(arc_sci_name[0]))
+    run_frame_tasks(jobs[1:], 'obj_qecorr_flat')
 
 def obj_gmosaic_flat():
     """ Mosaic individual flat frames. """
 
     print('# MOSAIC FLAT#')
 
+    if obj_flat_in_library():
+        print('Master Flat found in the calibration library.')
+        return
+
     # Remove pre-existing list.
     if os.path.exists("mqgsflat_obj.txt"):
         os.remove("mqgsflat_obj.txt")
 
-    # Open individual flat frames.
-    f = open('flat_obj.txt', 'r')
-    for flatfile in f:
-        # Remove pre-existing processed files.
-        if os.path.exists('mqgs{}'.format(flatfile.replace('\n',''))):
-            os.remove('mqgs{}'.format(flatfile.replace('\n','')))
-
-        gmos.gmosaic.unlearn() # Debug gmosaic.
-        # Set the task parameters.
-        gmosaicFlags= {'fl_fixpix':'yes'}
-        # Mosaic flat frames.
-        gmos.gmosaic('qgs{}'.format(flatfile.replace('\n','')), **gmosaicFlags) # IRAF task gmosaic.
+    # Individual flat frames.
+    flats = [flat.replace('\n','') for flat in open('flat_obj.txt')]
 
-        # Write name of processed files on list.
-        mqgsflat = open("mqgsflat_obj.txt","a")
-        mqgsflat.write('mqgs{}'.format(flatfile.replace('\n','')))
+    # Set the task parameters.
+    gmosaicFlags= {'fl_fixpix':'yes'}
+    # Mosaic flat frames, several at a time.
+    run_frame_tasks([('gmosaic', 'qgs'+flat, 'mqgs'+flat, gmosaicFlags)
+                     for flat in flats], 'obj_gmosaic_flat') # IRAF task gmosaic.
+
+    # Write name of processed files on list, in the order of the flat list.
+    mqgsflat = open("mqgsflat_obj.txt","w")
+    for flat in flats:
+        mqgsflat.write('mqgs{}'.format(flat))
         mqgsflat.write("\n")
-        mqgsflat.close()
-
-    f.close()
+    mqgsflat.close()
 
 def obj_masterflat():
     """ Trim individual flat frames and create Master Flat.
@@ -2258,62 +3768,29 @@ def obj_masterflat():
     if os.path.exists('qFlat.fits'):
         os.remove('qFlat.fits')
 
-    gmos.gsflat.unlearn() # Debug gsflat.
-    # Set the task parameters.
-    flatFlags = {'fl_bias':'no', 'order':'29',
-                'fl_over':'no', 'fl_trim':'no',
-                'fl_usegrad':'yes'}
-    # Create Master Flat.
-    gmos.gsflat('@mqgsflat_obj.txt', 'qFlat.fits', **flatFlags) # IRAF task gsflat.
+    # Take the Master Flat from the calibration library if it was
+    # already made from the same frames.
+    flat_key = obj_flat_key()
+    with library_lock(flat_key):
+        if not (obj_flat_in_library() and fetch_master(flat_key, 'qFlat.fits')):
+            # Create Master Flat.
+            build_flat([flat.replace('\n','') for flat in open('mqgsflat_obj.txt')], 'qFlat.fits')
+            store_master(flat_key, 'qFlat.fits')
 
     # Load Master Flat.
-    obj=fits.open('qFlat.fits')
+    obj=open_fits('qFlat.fits')
     obj_data = obj[2].data
     obj_shape = obj_data.shape
 
     # Plot Master Flat.
-    plt.figure(figsize=(12.0,4.0))
-    plt.imshow(obj[2].data, origin='lower',cmap='afmhot',
-               vmin=np.percentile(obj[2].data,5),
-               vmax=np.percentile(obj[2].data,90), aspect='auto')
-    plt.ylabel('Position Along Slit', fontsize=14)
-    plt.xlabel('Dispersion Axis', fontsize=14)
-    plt.tight_layout(w_pad=-0.9)
-    plt.suptitle('Master FLAT', y=1.0, fontsize=14)
-    plt.savefig('master-flat-obj-{}.png'.format(obj_sci_name[0]))
-    plt.show()
-    plt.clf()
-    plt.close()
+    show_figure(plot_images, {'images':[[qa_image(obj, 2)]], 'figsize':(12.0,4.0),
+                              'xlabel':'Dispersion Axis', 'title':'Master FLAT'},
+                'master-flat-obj-{}.png'.format(obj_sci_name[0]))
 
     # Print the pixel counting through a line cut.
-    plt.figure(figsize=(16.0,8.0))
-    ax1 = plt.subplot(3, 1, 1)
-    ax1.set_ylim(min(obj[2].data[int(0.3*obj_shape[0]),1:obj_shape[1]]),
-                    max(obj[2].data[int(0.3*obj_shape[0]),1:obj_shape[1]]))
-    ax1.set_ylabel('Counts [row={}]'.format(int(0.3*obj_shape[0])), fontsize=14)
-    ax1.plot(np.arange(1,obj_shape[1],1),
-                obj[2].data[int(0.3*obj_shape[0]),1:obj_shape[1]],linewidth=0.5)
-
-    ax2 = plt.subplot(3, 1, 2)
-    ax2.set_ylim(min(obj[2].data[int(0.5*obj_shape[0]),1:obj_shape[1]]),
-                    max(obj[2].data[int(0.5*obj_shape[0]),1:obj_shape[1]]))
-    ax2.set_ylabel('Counts [row={}]'.format(int(0.5*obj_shape[0])), fontsize=14)
-    ax2.plot(np.arange(1,obj_shape[1],1),
-                obj[2].data[int(0.5*obj_shape[0]),1:obj_shape[1]],linewidth=0.5)
-
-    ax3 = plt.subplot(3, 1, 3)
-    ax3.set_ylim(min(obj[2].data[int(0.7*obj_shape[0]),1:obj_shape[1]]),
-                    max(obj[2].data[int(0.7*obj_shape[0]),1:obj_shape[1]]))
-    ax3.set_ylabel('Counts [row={}]'.format(int(0.7*obj_shape[0])), fontsize=14)
-    ax3.plot(np.arange(1,obj_shape[1],1),
-                obj[2].data[int(0.7*obj_shape[0]),1:obj_shape[1]],linewidth=0.5)
-    ax3.set_xlabel('Dispersion Axis', fontsize=14)
-
-    plt.tight_layout(w_pad=-0.9)
-    plt.suptitle('Pixel Counting',y=1.0, fontsize=14)
-    plt.savefig('pixel-counting-flat-{}.png'.format(obj_sci_name[0]))
-    plt.show()
-    plt.close()
+    spec = line_cuts(obj, [2], 2)
+    spec['xlabel'] = 'Dispersion Axis'
+    show_figure(plot_line_cuts, spec, 'pixel-counting-flat-{}.png'.format(obj_sci_name[0]))
 
 def obj_reduc1_obj():
     """ Subtract bias, apply overscan and cosmic ray correction
@@ -2332,7 +3809,8 @@ def obj_reduc1_obj():
                     'fl_fulldq':'yes', 'fl_bias':'yes',
                     'bias':'Bias', 'fl_inter':'no',
                     'fl_cut':'no', 'fl_gsappwave':'no',
-                    'fl_over':'yes', 'fl_crspec':'yes'}
+                    'fl_over':'yes',
+                    'fl_crspec':'yes' if cosmic_method == 'gemfix' else 'no'}
     # Reduce science object files.
     gmos.gsreduce(str(obj_sci_name[0]), **gsreduceFlags) # IRAF task gsreduce.
 
@@ -2345,60 +3823,31 @@ def obj_gemfix_obj():
     # Remove pre-existing processed files.
     if os.path.exists('gemgs{}'.format(obj_sci_name[0])):
         os.remove('gemgs{}'.format(obj_sci_name[0]))
-    if os.path.exists('copy_gemgs{}'.format(obj_sci_name[0])):
-        os.remove('copy_gemgs{}'.format(obj_sci_name[0]))
-
-    gemini.gemfix.unlearn() # Debug gemfix.
-    # Task parameters.
-    gemfixFlags={'outimages':'gemgs{}'.format(obj_sci_name[0]),
-                    'method':'fixpix', 'bitmask':'8'}
-    # Fix bad pixels.
-    gemini.gemfix('gs{}'.format(obj_sci_name[0]), **gemfixFlags) # IRAF task gemfix.
-
-    # Load raw files.
-    obj=fits.open('raw/{}'.format(obj_sci_name[0]))
-    obj_data = obj[2].data
-    obj_shape = obj_data.shape
-
-    # Load processed files.
-    gemobj=fits.open('gemgs{}'.format(obj_sci_name[0]))
-    gemobj_data = gemobj[len(gemobj)-1].data
-    gemobj_shape = gemobj_data.shape
 
-    # Create copy of processed file.
-    copy_gemobj = fits.HDUList([gemobj[0]])
-    for n in np.arange(2,37,3):
-        copy_gemobj.append(gemobj[n])
-    copy_gemobj.writeto('copy_gemgs{}'.format(obj_sci_name[0]))
-    new_gemobj = fits.open('copy_gemgs{}'.format(obj_sci_name[0]))
-    gemobj_data = gemobj[len(gemobj)-1].data
-    gemobj_shape = gemobj_data.shape
+    if cosmic_method == 'native':
+        # Find and replace the cosmic rays.
+        flagged = clean_cosmic_rays('gs{}'.format(obj_sci_name[0]), 'gemgs{}'.format(obj_sci_name[0]))
+        print('Cosmic ray pixels flagged: {}'.format(flagged))
+        stage_metrics['cosmic_ray_pixels'] = flagged
+    else:
+        gemini.gemfix.unlearn() # Debug gemfix.
+        # Task parameters.
+        gemfixFlags={'outimages':'gemgs{}'.format(obj_sci_name[0]),
+                        'method':'fixpix', 'bitmask':'8'}
+        # Fix bad pixels.
+        gemini.gemfix('gs{}'.format(obj_sci_name[0]), **gemfixFlags) # IRAF task gemfix.
+
+    # Load raw and processed files. The figure takes the SCI extensions
+    # of the processed file from its memory map.
+    obj=open_fits('raw/{}'.format(obj_sci_name[0]))
+    gemobj=open_fits('gemgs{}'.format(obj_sci_name[0]))
 
     # Print raw and corrected files.
-    plt.figure(figsize=(16.0,8.0))
-    for i in range(len(np.arange(0,12,1))):
-        ax1 = plt.subplot(2,12,i+1)
-        ax1.imshow(obj[i+1].data, origin='lower',cmap='afmhot',
-                   vmin=np.percentile(obj[i+1].data,5),
-                   vmax=np.percentile(obj[i+1].data,90), aspect='auto')
-        ax2 = plt.subplot(2,12,12+i+1)
-        ax2.imshow(new_gemobj[i+1].data, origin='lower',cmap='afmhot',
-                   vmin=np.percentile(new_gemobj[i+1].data,5),
-                   vmax=np.percentile(new_gemobj[i+1].data,90), aspect='auto')
-        if i == 0:
-            ax1.yaxis.set_visible(True)
-            ax1.set_ylabel('Position Along Slit', fontsize=14)
-            ax2.yaxis.set_visible(True)
-            ax2.set_ylabel('Position Along Slit', fontsize=14)
-        else:
-            ax1.yaxis.set_visible(False)
-            ax2.yaxis.set_visible(False)
-    plt.tight_layout(w_pad=-0.9)
-    plt.suptitle('Pre- and Post- Cosmic Ray Rejection', y=1.0, fontsize=14)
-    plt.savefig('gemfix_obj_{}.png'.format(obj_sci_name[0]))
-    plt.show()
-    plt.clf()
-    plt.close()
+    show_figure(plot_images, {'images':[[qa_image(obj, i+1) for i in range(12)],
+                                        [qa_image(gemobj, ('SCI', i+1)) for i in range(12)]],
+                              'figsize':(16.0,8.0),
+                              'title':'Pre- and Post- Cosmic Ray Rejection'},
+                'gemfix_obj_{}.png'.format(obj_sci_name[0]))
 
 
 def obj_qecorr_obj():
@@ -2410,17 +3859,10 @@ def obj_qecorr_obj():
     if os.path.exists('qgemgs{}'.format(obj_sci_name[0])):
         os.remove('qgemgs{}'.format(obj_sci_name[0]))
 
-    # Open list of individual flat frames.
-    flatfile_list=[]
-    f = open('flat_obj.txt', 'r')
-    for flatfile in f:
-        flatfile_list.append(flatfile)
-    f.close()
-
     gmos.gqecorr.unlearn() # Debug gqecorr.
-    # Task parameters
-    qecorrFlags= {'refimage':'gs{}'.format(arc_sci_name[0]),
-                    'corrima':'qgs{}'.format(flatfile_list[0].replace('\n',''))}
+    # Task parameters. The correction image made from the ARC is reused.
+    qecorrFlags= {'refimage':'gs{}'.format(arc_sci_name[0]), 'fl_keep':'yes',
+                    'corrimages':'qecorrgs{}'.format(arc_sci_name[0])}
     # Apply quantum efficiency correction.
     gmos.gqecorr('gemgs{}'.format(obj_sci_name[0]), **qecorrFlags) # IRAF task gqecorr.
 
@@ -2442,49 +3884,64 @@ def obj_reduc2_obj():
     gmos.gsreduce('qgemgs{}'.format(obj_sci_name[0]), **gsreduceFlags) # IRAF task gsreduce.
 
 def obj_badcolumn_obj():
-    """ Print science object frame for bad column checking.
-        Interpolate bad columns. """
+    """ Find the bad columns of the science object frame and interpolate
+        them. The columns can then be checked, and more columns added,
+        by hand. """
 
     print('# BAD COLUMN CHECKING #')
 
-    # Remove pre-existing processed files.
-    if os.path.exists('bcgsqgemgs{}'.format(obj_sci_name[0])):
-        os.remove('bcgsqgemgs{}'.format(obj_sci_name[0]))
-    # Create copy of science object file to apply bad column correction.
-    iraf.copy('gsqgemgs{}'.format(obj_sci_name[0]), 'bcgsqgemgs{}'.format(obj_sci_name[0]))
-    # Load copy.
-    obj=fits.open('bcgsqgemgs{}'.format(obj_sci_name[0]))
-
-    # Check if a bad column mask is already available in the directory.
-    if os.path.exists("maskbadcol.txt"):
-        while True:
-            try:
-                print('')
-                answer = raw_input("The file 'maskbadcol.txt' is available in this directory. "
-                                    " Do you wish to apply this mask to your spectrum? (y/n) ")
-                if answer=='y':
-                    # Remove pre-existing mask.
-                    if os.path.exists("maskbadcol.pl"):
-                        os.remove("maskbadcol.pl")
-
-                    # Create mask based on coordinates text file.
-                    iraf.text2mask('maskbadcol.txt', 'maskbadcol.pl',
-                                    obj[2].shape[1], obj[2].shape[0]) # IRAF task 'text2mask'.
+    # Load the frame. The corrected frame is written from it at once.
+    obj=open_fits('gsqgemgs{}'.format(obj_sci_name[0]))
 
-                    # Interpolate bad columns using mask.
-                    iraf.fixpix('bcgsqgemgs{}[2]'.format(obj_sci_name[0]),
-                                    'maskbadcol.pl', linterp='1,2,3,4') # IRAF task 'fixpix'.
-                    break
+    # Start from the bad column mask of the calibration library for the
+    # detector, binning and region of interest of the frame.
+    mask_library_key = mask_key(obj_sci_name[0])
+    mask = library_mask(mask_library_key, obj[2].shape)
 
-                if answer=='n':
-                    break
+    # Check if a bad column mask is already available in the directory or
+    # in the calibration library. It is kept, and the columns found below
+    # are added to it, or it is made again: the file is then removed and
+    # the library mask is neither used nor updated by this reduction.
+    if os.path.exists("maskbadcol.txt") or mask.any():
+        while True:
+            print('')
+            answer = ask('obj.badcolumn.apply_mask', "A bad column mask is available in this directory "
+                                "('maskbadcol.txt') or in the calibration library. "
+                                " Do you wish to apply this mask to your spectrum? (y/n) ",
+                         default='y')
+            if answer=='y':
+                if os.path.exists("maskbadcol.txt"):
+                    mask_columns(mask, read_bad_columns("maskbadcol.txt"))
+                break
+            if answer=='n':
+                if os.path.exists("maskbadcol.txt"):
+                    os.remove("maskbadcol.txt")
+                mask[:] = False
+                mask_library_key = None
+                break
+            else:
+                print('Please, type y or n ')
 
-                else:
-                    print('Please, type y or n ')
+    # Find the bad columns and interpolate them.
+    columns = detect_bad_columns(obj[2].data)
+    print('Bad columns found (x min, x max): ', columns)
+    add_bad_columns("maskbadcol.txt", columns, obj[2].shape[0])
+    mask_columns(mask, columns)
+    interpolate_bad_columns('gsqgemgs{}'.format(obj_sci_name[0]), mask, 'bcgsqgemgs{}'.format(obj_sci_name[0]))
+    obj=open_fits('bcgsqgemgs{}'.format(obj_sci_name[0]))
 
-            except(NameError, SyntaxError,IndexError):
-                    print('')
-                    print("Check if you typed a correct line number. ")
+    # The bad columns are only checked by hand on request. The columns
+    # found are otherwise added to the library mask as candidates.
+    while True:
+        print('')
+        answer = ask('obj.badcolumn.review', 'Do you wish to check the bad columns? (y/n) ',
+                     default='y' if has_answer('obj.badcolumn.xmin') else 'n')
+        if answer in ('y', 'n'):
+            break
+        print('Please, type y or n ')
+    if answer=='n':
+        merge_columns(mask_library_key, mask.shape, columns, checked=False)
+        return
 
     # Select a line in the science object frame and print the pixel counting
     # through the line for bad column checking.
@@ -2492,7 +3949,8 @@ def obj_badcolumn_obj():
         try:
             print('')
             # Selected line.
-            line = int(input('Choose a line for bad column checking: ' ))
+            line = int(ask('obj.badcolumn.line', 'Choose a line for bad column checking: ',
+                           default=obj[2].shape[0]//2))
             print('')
 
             xaxis=np.arange(1, obj[2].data.shape[1],1)
@@ -2500,22 +3958,11 @@ def obj_badcolumn_obj():
 
             # Print science object frame and pixel counting
             # through the selected line.
-            plt.figure(figsize=(16.0,8.0))
-            plt.figure(figsize=(16.0,8.0))
-            ax1=plt.subplot(211)
-            ax1.imshow(obj[2].data, origin='lower',cmap='afmhot',
-                           vmin=np.percentile(obj[2].data,1),
-                           vmax=np.percentile(obj[2].data,99), aspect='auto')
-            ax1.axhline(y=line, linestyle='--', color='red',linewidth=2., alpha=0.7)
-            ax1.set_ylabel('Position Along Slit', fontsize=14)
-            ax2=plt.subplot(212)
-            ax2.plot(xaxis, yaxis, color='red' )
-            ax2.set_xlim(left=np.min(xaxis), right=np.max(xaxis))
-            ax2.set_ylabel('Counts', fontsize=14)
-            ax2.set_xlabel('Dispersion Axis', fontsize=14)
-            plt.show()
-
-            answer = raw_input('Do you wish to select another line? (y/n) ')
+            show_figure(plot_line_check, {'image':qa_image(obj, 2, (1, 99)), 'line':line,
+                                          'x':xaxis, 'y':yaxis})
+
+            answer = ask('obj.badcolumn.another_line', 'Do you wish to select another line? (y/n) ',
+                         default='n')
 
             if answer=='n':
                 break
@@ -2524,17 +3971,30 @@ def obj_badcolumn_obj():
             else:
                 print('Please, type y or n ')
 
-        except(NameError, SyntaxError,IndexError):
+        except(NameError, SyntaxError, IndexError, ValueError):
                 print('')
                 print("Check if you typed a correct line number. ")
 
+    # Add the columns found to the library mask once they are checked.
+    while columns:
+        print('')
+        answer = ask('obj.badcolumn.keep_found', 'Do you wish to add the bad columns found to the mask '
+                     'of the calibration library? (y/n) ', default='y')
+        if answer=='y':
+            merge_columns(mask_library_key, mask.shape, columns)
+            break
+        if answer=='n':
+            break
+        print('Please, type y or n ')
+
     # Select the inital and final position along the x-axis of
     # the columns to interpolate.
     # Create a mask and interpolate bad column.
     while True:
         try:
             print('')
-            answer2 = raw_input('Do you wish to interpolate a bad column? (y/n) ')
+            answer2 = ask('obj.badcolumn.interpolate', 'Do you wish to interpolate a bad column? (y/n) ',
+                          default='y' if has_answer('obj.badcolumn.xmin') else 'n')
             print('')
 
             if answer2=='n':
@@ -2545,50 +4005,29 @@ def obj_badcolumn_obj():
                     try:
                         print('')
                         # Inital x position of the bad column.
-                        x1 = int(input('Select a column to interpolate (x min): ' ))
+                        x1 = int(ask('obj.badcolumn.xmin', 'Select a column to interpolate (x min): '))
                         print('')
                         # Final x position of the bad column.
-                        x2 = int(input('Select a column to interpolate (x max): ' ))
-
-                        # Create text file with the column coordinates.
-                        bias_obj_txt = open("maskbadcol.txt","a")
-                        bias_obj_txt.write('{} {} 1 {}'.format(x1, x2, obj[2].shape[0]))
-                        bias_obj_txt.write("\n")
-                        bias_obj_txt.close()
+                        x2 = int(ask('obj.badcolumn.xmax', 'Select a column to interpolate (x max): '))
 
-                        # Remove pre-existing mask.
-                        if os.path.exists("maskbadcol.pl"):
-                            os.remove("maskbadcol.pl")
-
-                        # Create mask based on coordinates text file.
-                        iraf.text2mask('maskbadcol.txt', 'maskbadcol.pl',
-                                        obj[2].shape[1], obj[2].shape[0]) # IRAF task 'text2mask'.
-
-                        # Interpolate bad columns using mask.
-                        iraf.fixpix('bcgsqgemgs{}[2]'.format(obj_sci_name[0]),
-                                        'maskbadcol.pl', linterp='1,2,3,4') # IRAF task 'fixpix'.
+                        # Add the column to the mask and interpolate it.
+                        add_bad_columns("maskbadcol.txt", [(x1, x2)], obj[2].shape[0])
+                        mask_columns(mask, [(x1, x2)])
+                        interpolate_bad_columns('gsqgemgs{}'.format(obj_sci_name[0]), mask,
+                                                'bcgsqgemgs{}'.format(obj_sci_name[0]))
+                        merge_columns(mask_library_key, mask.shape, [(x1, x2)])
 
                         # Print corrected science object frame and pixel counting
                         # through the selected line.
-                        obj2=fits.open('bcgsqgemgs{}'.format(obj_sci_name[0]))
+                        obj=open_fits('bcgsqgemgs{}'.format(obj_sci_name[0]))
                         xaxis=np.arange(1, obj[2].data.shape[1],1)
                         yaxis=obj[2].data[line,1:obj[2].data.shape[1]]
-                        plt.figure(figsize=(16.0,8.0))
-                        ax1=plt.subplot(211)
-                        ax1.imshow(obj[2].data, origin='lower',cmap='afmhot',
-                                   vmin=np.percentile(obj[2].data,1),
-                                   vmax=np.percentile(obj[2].data,99), aspect='auto')
-                        ax1.axhline(y=line, linestyle='--', color='red',linewidth=2., alpha=0.7)
-                        ax1.set_ylabel('Position Along Slit', fontsize=14)
-                        ax2=plt.subplot(212)
-                        ax2.plot(xaxis, yaxis, color='red' )
-                        ax2.set_xlim(left=np.min(xaxis), right=np.max(xaxis))
-                        ax2.set_ylabel('Counts', fontsize=14)
-                        ax2.set_xlabel('Dispersion Axis', fontsize=14)
-                        plt.show()
+                        show_figure(plot_line_check, {'image':qa_image(obj, 2, (1, 99)), 'line':line,
+                                                      'x':xaxis, 'y':yaxis})
 
                         print('')
-                        answer3 = raw_input('Do you wish to interpolate another bad column? (y/n) ' )
+                        answer3 = ask('obj.badcolumn.another', 'Do you wish to interpolate another bad column? (y/n) ',
+                                      default='y' if has_answer('obj.badcolumn.xmin') else 'n')
 
                         if answer3=='n':
                             break
@@ -2597,14 +4036,14 @@ def obj_badcolumn_obj():
                         else:
                             print('Please, type y or n ')
 
-                    except(NameError, SyntaxError,IndexError):
+                    except(NameError, SyntaxError, IndexError, ValueError):
                             print('')
                             print("Check if you typed a correct line number. ")
                 break
             else:
                 print('Please, type y or n ')
 
-        except(NameError, SyntaxError,IndexError):
+        except(NameError, SyntaxError, IndexError, ValueError):
                 print('')
                 print("Check if you typed a correct line number. ")
 
@@ -2614,16 +4053,9 @@ def obj_transf_obj():
 
     print('# TRANSFORMING SCIENCE SPECTRUM #')
 
-    # Remove pre-existing processed files.
-    if os.path.exists('tbcgsqgemgs{}'.format(obj_sci_name[0])):
-        os.remove('tbcgsqgemgs{}'.format(obj_sci_name[0]))
-
-    gmos.gstransform.unlearn() # Debug gstransform.
-    # Task parameters.
-    gstransformFlags={'wavtranam':'gs{}'.format(arc_sci_name[0]),
-                    'fl_vardq':'yes'}
-    # Transform spectrum.
-    gmos.gstransform('bcgsqgemgs{}'.format(obj_sci_name[0]), **gstransformFlags) # IRAF task gstransform.
+    # Rectify the SCI, VAR and DQ planes with the wavelength solution of
+    # the arc. The files made before are replaced.
+    transform_frame('bcgsqgemgs{}'.format(obj_sci_name[0]), 'gs{}'.format(arc_sci_name[0]))
 
 def obj_sky_sub_obj():
     """ Subtract sky background from science object frame.
@@ -2642,31 +4074,17 @@ def obj_sky_sub_obj():
     gmos.gsskysub('tbcgsqgemgs{}'.format(obj_sci_name[0]), **gsskysubFlags) # IRAF task gsskysub.
 
     # Print frames with and without sky correction.
-    obj=fits.open('tbcgsqgemgs{}'.format(obj_sci_name[0]))
-    subobj=fits.open('stbcgsqgemgs{}'.format(obj_sci_name[0]))
+    obj=open_fits('tbcgsqgemgs{}'.format(obj_sci_name[0]))
+    subobj=open_fits('stbcgsqgemgs{}'.format(obj_sci_name[0]))
 
     obj_data = obj[2].data
     subobj_data = subobj[2].data
     obj_shape = obj_data.shape
     subobj_shape = subobj_data.shape
-    plt.figure(figsize=(16.0,8.0))
-    plt.subplot(2, 1, 1)
-    plt.imshow(obj[2].data, origin='lower',cmap='afmhot',
-                   vmin=np.percentile(obj[2].data,5),
-                   vmax=np.percentile(obj[2].data,90), aspect='auto')
-    plt.ylabel('Position Along Slit', fontsize=14)
-    plt.subplot(2, 1, 2)
-    plt.imshow(subobj[2].data, origin='lower',cmap='afmhot',
-                   vmin=np.percentile(subobj[2].data,5),
-                   vmax=np.percentile(subobj[2].data,90), aspect='auto')
-    plt.xlabel('Dispersion Axis', fontsize=14)
-    plt.ylabel('Position Along Slit', fontsize=14)
-    plt.tight_layout(w_pad=-0.9)
-    plt.suptitle('Pre- and Post- Sky Subtraction', y=1.0)
-    plt.savefig('skysub-obj-{}.png'.format(obj_sci_name[0]))
-    plt.show()
-    plt.clf()
-    plt.close()
+    show_figure(plot_images, {'images':[[qa_image(obj, 2)], [qa_image(subobj, 2)]],
+                              'figsize':(16.0,8.0), 'xlabel':'Dispersion Axis',
+                              'title':'Pre- and Post- Sky Subtraction'},
+                'skysub-obj-{}.png'.format(obj_sci_name[0]))
 
 def obj_extract_obj():
     """ Extract science object spectrum.
@@ -2693,37 +4111,28 @@ def obj_extract_obj():
                         max_rows=1, usecols=2, invalid_raise=False)
 
     # Load science object frame.
-    obj=fits.open('stbcgsqgemgs{}'.format(obj_sci_name[0]))
+    obj=open_fits('stbcgsqgemgs{}'.format(obj_sci_name[0]))
     obj_data = obj[2].data
     obj_shape = obj_data.shape
 
     # Print frame with row of extracted spectrum.
-    fig = plt.figure(figsize=(14.0,6.0))
-    ax1 = fig.add_subplot(111)
-    plt.imshow(obj[2].data, origin='lower',cmap='afmhot',
-                   vmin=np.percentile(obj[2].data,5),
-                   vmax=np.percentile(obj[2].data,90), aspect='auto')
-    ax1.axhline(y=center, linestyle='--', color='red',linewidth=2., alpha=0.7)
-    plt.tight_layout(w_pad=-0.9)
-    plt.ylabel('Position Along Slit', fontsize=14)
-    plt.xlabel('Dispersion Axis', fontsize=14)
-    plt.suptitle('Extracted Spectrum Position', y=1.0, fontsize=14)
-    plt.savefig('extract_obj_{}.png'.format(obj_sci_name[0]))
-    plt.show()
-    plt.clf()
-    plt.close()
+    show_figure(plot_images, {'images':[[qa_image(obj, 2)]], 'line':center,
+                              'figsize':(14.0,6.0), 'xlabel':'Dispersion Axis',
+                              'title':'Extracted Spectrum Position'},
+                'extract_obj_{}.png'.format(obj_sci_name[0]))
 
     # Check if the spectrum position is correct.
     # Select another row to extract the spectrum.
     while True:
         print('')
-        answer1 = raw_input('Are you satisfied with the extracted spectrum position? [y/n]')
+        answer1 = ask('obj.extract.satisfied', 'Are you satisfied with the extracted spectrum position? [y/n]',
+                      default='n' if has_answer('obj.extract.row') else 'y')
         if answer1 == "y":
             break
 
         if answer1 == "n":
             print('')
-            answer2 = raw_input('Type the new row position for extracting the spectrum: ')
+            answer2 = ask('obj.extract.row', 'Type the new row position for extracting the spectrum: ')
 
             # Remove extraction info (last) file in the database directory.
             os.remove('database/aplast')
@@ -2747,31 +4156,21 @@ def obj_extract_obj():
                         max_rows=1, usecols=2, invalid_raise=False)
 
             # Load standard star frame.
-            obj=fits.open('stbcgsqgemgs{}'.format(obj_sci_name[0]))
+            obj=open_fits('stbcgsqgemgs{}'.format(obj_sci_name[0]))
             obj_data = obj[2].data
             obj_shape = obj_data.shape
 
             # Print frame with row of extracted spectrum.
-            fig = plt.figure(figsize=(14.0,6.0))
-            ax1 = fig.add_subplot(111)
-            plt.imshow(obj[2].data, origin='lower',cmap='afmhot',
-                           vmin=np.percentile(obj[2].data,5),
-                           vmax=np.percentile(obj[2].data,90), aspect='auto')
-            ax1.axhline(y=center, linestyle='--', color='red',linewidth=2., alpha=0.7)
-            plt.tight_layout(w_pad=-0.9)
-            plt.ylabel('Position Along Slit', fontsize=14)
-            plt.xlabel('Dispersion Axis', fontsize=14)
-            plt.suptitle('Extracted Spectrum Position', y=1.0, fontsize=14)
-            plt.savefig('extract_obj-{}.png'.format(obj_sci_name[0]))
-            plt.show()
-            plt.clf()
-            plt.close()
+            show_figure(plot_images, {'images':[[qa_image(obj, 2)]], 'line':center,
+                                      'figsize':(14.0,6.0), 'xlabel':'Dispersion Axis',
+                                      'title':'Extracted Spectrum Position'},
+                        'extract_obj-{}.png'.format(obj_sci_name[0]))
 
         else:
             print("Type y or n")
 
     # Load extracted science object spectrum.
-    obj=fits.open('estbcgsqgemgs{}'.format(obj_sci_name[0]))
+    obj=open_fits('estbcgsqgemgs{}'.format(obj_sci_name[0]))
     obj_header = obj[2].header
     obj_data = obj[2].data
     obj_shape = obj_data.shape
@@ -2779,19 +4178,11 @@ def obj_extract_obj():
     cd1_1 = obj_header['CD1_1']
 
     # Print extracted standard star spectrum
-    fig, ax = plt.subplots(figsize=(14.0,6.0))
-    plt.plot(crval + cd1_1*np.arange(1,len(obj[2].data)+1,1), obj[2].data, linewidth=0.55)
-    ax.xaxis.set_major_locator(MultipleLocator(500))
-    ax.xaxis.set_minor_locator(MultipleLocator(50))
-    ax.set_ylim(np.percentile(obj[2].data,5), np.percentile(obj[2].data,95))
-    plt.ylabel('Counts', fontsize=14)
-    plt.xlabel(r'Wavelength $\ [\AA]$', fontsize=14)
-    plt.title('Extracted Spectrum', fontsize=14)
-    plt.tight_layout(w_pad=-0.9)
-    plt.savefig('extracted_spec_obj{}.png'.format(obj_sci_name[0]))
-    plt.show()
-    plt.clf()
-    plt.close()
+    show_figure(plot_spectra, {'curves':[(crval + cd1_1*np.arange(1,len(obj[2].data)+1,1),
+                                          obj[2].data, {'linewidth':0.55})],
+                               'ylim':(np.percentile(obj[2].data,5), np.percentile(obj[2].data,95)),
+                               'ylabel':'Counts', 'title':'Extracted Spectrum'},
+                'extracted_spec_obj{}.png'.format(obj_sci_name[0]))
 
 def obj_calib_obj():
     """ Calibrate science object spectrum.
@@ -2809,7 +4200,7 @@ def obj_calib_obj():
     gmos.gscalibrate('estbcgsqgemgs{}'.format(obj_sci_name[0]), **calibrateFlags ) # IRAF task gscalibrate.
 
     # Load calibrated spectrum.
-    obj=fits.open('cestbcgsqgemgs{}'.format(obj_sci_name[0]))
+    obj=open_fits('cestbcgsqgemgs{}'.format(obj_sci_name[0]))
     obj_header = obj[2].header
     obj_data = obj[2].data
     obj_shape = obj_data.shape
@@ -2817,22 +4208,13 @@ def obj_calib_obj():
     cd1_1 = obj_header['CD1_1']
 
     # Plot calibrated spectrum of the science object.
-    fig, ax = plt.subplots(figsize=(14.0,6.0))
-    plt.plot(crval + cd1_1*np.arange(1,len(obj[2].data)+1,1), obj[2].data, linewidth=0.55)
-    plt.grid(alpha=0.8, ls='--')
-    ax.xaxis.set_major_locator(MultipleLocator(500))
-    ax.xaxis.set_minor_locator(MultipleLocator(50))
-    ax.set_ylim(np.percentile(obj[2].data,5), np.percentile(obj[2].data,95))
-    plt.ylabel('Flux [ergs cm$^{-2}$ s$^{-1}$ $\ \AA$$^{-1}$] ', fontsize=14)
-    plt.xlabel(r'Wavelength $\ [\AA]$', fontsize=14)
-    plt.title('Calibrated Spectrum', fontsize=14)
-    plt.xticks(fontsize = 11)
-    plt.yticks(fontsize = 11)
-    plt.tight_layout(w_pad=-0.9)
-    plt.savefig('calib-spec-obj-{}.png'.format(obj_sci_name[0]))
-    plt.show()
-    plt.clf()
-    plt.close()
+    show_figure(plot_spectra, {'curves':[(crval + cd1_1*np.arange(1,len(obj[2].data)+1,1),
+                                          obj[2].data, {'linewidth':0.55})],
+                               'ylim':(np.percentile(obj[2].data,5), np.percentile(obj[2].data,95)),
+                               'grid':{'alpha':0.8, 'ls':'--'}, 'ticks':11,
+                               'ylabel':'Flux [ergs cm$^{-2}$ s$^{-1}$ $\ \AA$$^{-1}$] ',
+                               'title':'Calibrated Spectrum'},
+                'calib-spec-obj-{}.png'.format(obj_sci_name[0]))
 
 def obj_despike_obj():
     """ Use the modified z-score detection of outlying points
@@ -2840,7 +4222,8 @@ def obj_despike_obj():
 
     while True:
         print('')
-        answer = raw_input('Do you wish to remove spikes in your spectrum? ')
+        answer = ask('obj.despike', 'Do you wish to remove spikes in your spectrum? ',
+                     default='n')
 
         if answer == 'n':
 
@@ -2848,7 +4231,7 @@ def obj_despike_obj():
 
         if answer == 'y':
             # Load calibrated spectrum.
-            obj=fits.open('cestbcgsqgemgs{}'.format(obj_sci_name[0]))
+            obj=open_fits('cestbcgsqgemgs{}'.format(obj_sci_name[0]))
             obj_header = obj[2].header
             obj_data = obj[2].data
             obj_shape = obj_data.shape
@@ -2873,31 +4256,20 @@ def obj_despike_obj():
             intensity_modified_z_score=np.array(np.abs(modified_z_score(delta_int)))
 
             # Print the modified z-score of Delta X (i) for the points along the spectrum.
-            fig, ax = plt.subplots(figsize=(14.0,6.0))
-            plt.plot(wavelength[1:], intensity_modified_z_score)
-            plt.plot(wavelength[1:], threshold*np.ones(len(wavelength[1:])), label = 'threshold = {}'.format(threshold))
-            plt.title('Modified z-Score of Delta x (i) [Whitaker and Hayes Approach ]', fontsize = 15)
-            plt.xticks(fontsize = 15)
-            plt.yticks(fontsize = 15)
-            plt.xlabel('Wavelength ', fontsize = 15)
-            plt.ylabel('|z-scores|', fontsize = 15)
-            plt.legend()
-            # plt.savefig('z_scores.png')
-            plt.show()
+            show_figure(plot_spectra, {'curves':[(wavelength[1:], intensity_modified_z_score, {}),
+                                                 (wavelength[1:], threshold*np.ones(len(wavelength[1:])),
+                                                  {'label':'threshold = {}'.format(threshold)})],
+                                       'locators':False, 'fontsize':15, 'ticks':15, 'legend':True,
+                                       'xlabel':'Wavelength ', 'ylabel':'|z-scores|',
+                                       'title':'Modified z-Score of Delta x (i) [Whitaker and Hayes Approach ]'})
 
             # 1 is assigned to spikes, 0 to non-spikes:
             spikes = abs(np.array(modified_z_score(intensity))) > threshold
 
             # Print the detected spikes along the spectrum.
-            fig, ax = plt.subplots(figsize=(14.0,6.0))
-            plt.plot(wavelength, spikes, color = 'red')
-            plt.title('Spikes: ' + str(np.sum(spikes)), fontsize = 15)
-            plt.grid()
-            plt.xticks(fontsize = 15)
-            plt.yticks(fontsize = 15)
-            plt.xlabel( 'Wavelength' ,fontsize = 15)
-            # plt.savefig('z_score_spikes.png')
-            plt.show()
+            show_figure(plot_spectra, {'curves':[(wavelength, spikes, {'color':'red'})],
+                                       'locators':False, 'fontsize':15, 'ticks':15, 'grid':{},
+                                       'xlabel':'Wavelength', 'title':'Spikes: ' + str(np.sum(spikes))})
 
             # Delete the spikes and fix the spectrum.
             def fixer(y,m):
@@ -2913,37 +4285,24 @@ def obj_despike_obj():
                 return y_out
 
             # Print a comparison between the original and fixed spectrum.
-            fig, ax = plt.subplots(figsize=(14.0,6.0))
-            plt.plot(wavelength, intensity, 'darkgrey',linewidth=0.55, label = 'Original Spectrum')
-            ax.xaxis.set_major_locator(MultipleLocator(500))
-            ax.xaxis.set_minor_locator(MultipleLocator(50))
-            plt.plot(wavelength, fixer(intensity,m=3), alpha=0.85, linewidth=0.55, label = 'Fixed Spectrum')
-            ax.set_ylim(np.percentile(intensity,5), np.percentile(intensity,95))
-            plt.grid(alpha=0.8, ls='--')
-            plt.ylabel('Flux [ergs cm$^{-2}$ s$^{-1}$ $\ \AA$$^{-1}$] ', fontsize=14)
-            plt.xlabel(r'Wavelength $\ [\AA]$', fontsize=14)
-            plt.title('Calibrated Spectrum', fontsize=14)
-            plt.xticks(fontsize = 11)
-            plt.yticks(fontsize = 11)
-            plt.tight_layout(w_pad=-0.9)
-            plt.legend()
-            plt.show()
+            show_figure(plot_spectra, {'curves':[(wavelength, intensity,
+                                                  {'color':'darkgrey', 'linewidth':0.55,
+                                                   'label':'Original Spectrum'}),
+                                                 (wavelength, fixer(intensity,m=3),
+                                                  {'alpha':0.85, 'linewidth':0.55,
+                                                   'label':'Fixed Spectrum'})],
+                                       'ylim':(np.percentile(intensity,5), np.percentile(intensity,95)),
+                                       'grid':{'alpha':0.8, 'ls':'--'}, 'ticks':11, 'legend':True,
+                                       'ylabel':'Flux [ergs cm$^{-2}$ s$^{-1}$ $\ \AA$$^{-1}$] ',
+                                       'title':'Calibrated Spectrum'})
 
             # Print the fixed spectrum.
-            fig, ax = plt.subplots(figsize=(14.0,6.0))
-            plt.plot(wavelength, fixer(intensity,m=3),alpha=0.85, linewidth=0.55)
-            ax.xaxis.set_major_locator(MultipleLocator(500))
-            ax.xaxis.set_minor_locator(MultipleLocator(50))
-            ax.set_ylim(np.percentile(intensity,5), np.percentile(intensity,95))
-            plt.grid(alpha=0.8, ls='--')
-            plt.ylabel('Flux [ergs cm$^{-2}$ s$^{-1}$ $\ \AA$$^{-1}$] ', fontsize=14)
-            plt.xlabel(r'Wavelength $\ [\AA]$', fontsize=14)
-            plt.title('Calibrated Spectrum', fontsize=14)
-            plt.xticks(fontsize = 11)
-            plt.yticks(fontsize = 11)
-            plt.tight_layout(w_pad=-0.9)
-            plt.legend()
-            plt.show()
+            show_figure(plot_spectra, {'curves':[(wavelength, fixer(intensity,m=3),
+                                                  {'alpha':0.85, 'linewidth':0.55})],
+                                       'ylim':(np.percentile(intensity,5), np.percentile(intensity,95)),
+                                       'grid':{'alpha':0.8, 'ls':'--'}, 'ticks':11,
+                                       'ylabel':'Flux [ergs cm$^{-2}$ s$^{-1}$ $\ \AA$$^{-1}$] ',
+                                       'title':'Calibrated Spectrum'})
 
             break
         else:
@@ -2951,111 +4310,693 @@ def obj_despike_obj():
             print "Type y or n"
             print('')
 
-# Call the reduction functions.
+# Reduction stages. Each stage declares the files it reads and writes.
+# A stage runs after the stages that write its input files, and after
+# the earlier stages that write or read its output files.
+
+def stage(run, inputs, outputs, interactive=False, questions=None, banner=None,
+          parameters=(), library=()):
+    """ Declare a reduction stage. Interactive stages, which ask questions
+        or show figures to the user, always run in the main process.
+        'questions' is the key prefix of the questions asked by the stage.
+        'parameters' are the names of the settings and helper functions of
+        the script the stage depends on, and 'library' the keys of the
+        calibrations it can take from the calibration library. """
+
+    return {'name':run.__name__, 'run':run, 'inputs':inputs,
+            'outputs':outputs, 'interactive':interactive,
+            'questions':questions, 'banner':banner,
+            'parameters':parameters, 'library':library}
+
+# Settings and helper functions the stages depend on, by kind of stage.
+bias_parameters = ('library_path', 'raw_path', 'combine_biases', 'combine_amplifier',
+                   'combine_stack', 'overscan_levels', 'section_slices', 'combine_method',
+                   'combine_clip', 'combine_iterations', 'combine_memory', 'overscan_order',
+                   'overscan_contamination')
+wavelength_parameters = ('library_path', 'shift_arc_solution', 'collapsed_arc', 'arc_shift',
+                         'line_centers', 'arc_correlation_limit', 'arc_window',
+                         'read_database', 'wavelength_qa', 'check_wavelength_qa',
+                         'wavelength_problem', 'wavelength_clip', 'wavelength_iterations',
+                         'wavelength_rms_limit')
+transform_parameters = ('transform_frame', 'rectifier', 'rectify', 'surface_values',
+                        'surface_terms', 'dispersion_values', 'polynomial_basis', 'no_data')
+flat_parameters = ('library_path', 'build_flat', 'flat_order', 'flat_threshold',
+                   'combine_stack', 'combine_method', 'combine_clip', 'combine_iterations')
+cosmic_parameters = ('cosmic_method', 'clean_cosmic_rays', 'cosmic_ray_tile',
+                     'find_cosmic_rays', 'median_filter', 'grow_mask', 'replace_masked',
+                     'cosmic_clip', 'cosmic_fraction', 'cosmic_contrast',
+                     'cosmic_iterations', 'cosmic_tile', 'cosmic_margin', 'cosmic_ray')
+badcolumn_parameters = ('library_path', 'detect_bad_columns', 'badcolumn_sigma',
+                        'badcolumn_depth', 'badcolumn_width', 'hot_column_width',
+                        'read_bad_columns', 'add_bad_columns', 'mask_columns',
+                        'library_mask', 'merge_columns',
+                        'interpolate_bad_columns', 'interpolation_pairs',
+                        'interpolate_pixels')
+
+def std_stages():
+    """ Stages of the reduction of the standard star. """
+
+    std = obj_std_name[0]
+    arc = arc_std_name[0]
+    flats = [flat.replace('\n','') for flat in open('flat_std.txt')]
+    biases = [bias.replace('\n','') for bias in open('bias_std.txt')]
+    arc_solution = 'database/idgs{}_001'.format(arc.replace('.fits',''))
+    arc_surface = 'database/fcgs{}_001'.format(arc.replace('.fits',''))
+
+    return [
+        stage(std_gbias, ['bias_std.txt'] + [os.path.join(raw_path, bias) for bias in biases],
+              ['Bias_std.fits'],
+              banner='# REDUCTION OF STANDARD STAR #', parameters=bias_parameters,
+              library=[master_key('bias', biases, method='native')]),
+        stage(std_reduc_arc, ['raw/'+arc, 'Bias_std.fits'], ['gs'+arc]),
+        stage(std_wavelength_arc, ['gs'+arc], [arc_solution, arc_surface],
+              parameters=wavelength_parameters, library=[solution_key(arc)]),
+        stage(std_transf_arc, ['gs'+arc, arc_surface], ['tgs'+arc],
+              parameters=transform_parameters),
+        stage(std_reduc_flat, ['flat_std.txt', 'Bias_std.fits'] + ['raw/'+flat for flat in flats],
+              ['gs'+flat for flat in flats],
+              parameters=('library_path',), library=[std_flat_key(), std_flat_key('qecorr')]),
+        stage(std_qecorr_flat, ['gs'+flat for flat in flats] + ['gs'+arc, arc_solution],
+              ['qgs'+flat for flat in flats] + ['qecorrgs'+arc],
+              parameters=('library_path',), library=[std_flat_key(), std_flat_key('qecorr')]),
+        stage(std_gmosaic_flat, ['qgs'+flat for flat in flats],
+              ['mqgs'+flat for flat in flats] + ['mqgsflat_std.txt'],
+              parameters=('library_path',), library=[std_flat_key(), std_flat_key('qecorr')]),
+        stage(std_masterflat, ['mqgsflat_std.txt'] + ['mqgs'+flat for flat in flats],
+              ['qFlat_std.fits'],
+              parameters=flat_parameters, library=[std_flat_key(), std_flat_key('qecorr')]),
+        stage(std_reduc1_std, ['raw/'+std, 'Bias_std.fits'], ['gs'+std],
+              parameters=('cosmic_method',)),
+        stage(std_gemfix_std, ['gs'+std, 'raw/'+std], ['gemgs'+std],
+              parameters=cosmic_parameters),
+        stage(std_qecorr_std, ['gemgs'+std, 'gs'+arc, arc_solution, 'qecorrgs'+arc],
+              ['qgemgs'+std]),
+        stage(std_reduc2_std, ['qgemgs'+std, 'qFlat_std.fits'], ['gsqgemgs'+std]),
+        stage(std_badcolumn_std, ['gsqgemgs'+std],
+              ['bcgsqgemgs'+std, 'maskbadcol.txt'], interactive=True,
+              questions='std.badcolumn', parameters=badcolumn_parameters,
+              library=[mask_key(std)]),
+        stage(std_transf_std, ['bcgsqgemgs'+std, 'gs'+arc, arc_surface],
+              ['tbcgsqgemgs'+std],
+              parameters=transform_parameters),
+        stage(std_sky_sub_std, ['tbcgsqgemgs'+std], ['stbcgsqgemgs'+std]),
+        stage(std_extract_std, ['stbcgsqgemgs'+std],
+              ['estbcgsqgemgs'+std, 'database/aplast',
+               'database/apstbcgsqgemgs'+std.replace('.fits','')+'_SCI_1_'], interactive=True,
+              questions='std.extract'),
+        stage(std_calib_std, ['estbcgsqgemgs'+std],
+              ['sens.fits', 'std', 'logstandard', 'cestbcgsqgemgs'+std]),
+        ]
+
+def obj_stages():
+    """ Stages of the reduction of the science object. """
+
+    sci = obj_sci_name[0]
+    arc = arc_sci_name[0]
+    flats = [flat.replace('\n','') for flat in open('flat_obj.txt')]
+    biases = [bias.replace('\n','') for bias in open('bias_obj.txt')]
+    arc_solution = 'database/idgs{}_001'.format(arc.replace('.fits',''))
+    arc_surface = 'database/fcgs{}_001'.format(arc.replace('.fits',''))
+
+    return [
+        stage(obj_gbias, ['bias_obj.txt'] + [os.path.join(raw_path, bias) for bias in biases],
+              ['Bias.fits'],
+              banner='# REDUCTION OF SCIENCE OBJECT #', parameters=bias_parameters,
+              library=[master_key('bias', biases, method='native')]),
+        stage(obj_reduc_arc, ['raw/'+arc, 'Bias.fits'], ['gs'+arc]),
+        stage(obj_wavelength_arc, ['gs'+arc], [arc_solution, arc_surface],
+              parameters=wavelength_parameters, library=[solution_key(arc)]),
+        stage(obj_transf_arc, ['gs'+arc, arc_surface], ['tgs'+arc],
+              parameters=transform_parameters),
+        stage(obj_reduc_flat, ['flat_obj.txt', 'Bias.fits'] + ['raw/'+flat for flat in flats],
+              ['gs'+flat for flat in flats],
+              parameters=('library_path',), library=[obj_flat_key(), obj_flat_key('qecorr')]),
+        stage(obj_qecorr_flat, ['gs'+flat for flat in flats] + ['gs'+arc, arc_solution],
+              ['qgs'+flat for flat in flats] + ['qecorrgs'+arc],
+              parameters=('library_path',), library=[obj_flat_key(), obj_flat_key('qecorr')]),
+        stage(obj_gmosaic_flat, ['qgs'+flat for flat in flats],
+              ['mqgs'+flat for flat in flats] + ['mqgsflat_obj.txt'],
+              parameters=('library_path',), library=[obj_flat_key(), obj_flat_key('qecorr')]),
+        stage(obj_masterflat, ['mqgsflat_obj.txt'] + ['mqgs'+flat for flat in flats],
+              ['qFlat.fits'],
+              parameters=flat_parameters, library=[obj_flat_key(), obj_flat_key('qecorr')]),
+        stage(obj_reduc1_obj, ['raw/'+sci, 'Bias.fits'], ['gs'+sci],
+              parameters=('cosmic_method',)),
+        stage(obj_gemfix_obj, ['gs'+sci, 'raw/'+sci], ['gemgs'+sci],
+              parameters=cosmic_parameters),
+        stage(obj_qecorr_obj, ['gemgs'+sci, 'gs'+arc, arc_solution, 'qecorrgs'+arc],
+              ['qgemgs'+sci]),
+        stage(obj_reduc2_obj, ['qgemgs'+sci, 'qFlat.fits'], ['gsqgemgs'+sci]),
+        stage(obj_badcolumn_obj, ['gsqgemgs'+sci],
+              ['bcgsqgemgs'+sci, 'maskbadcol.txt'], interactive=True,
+              questions='obj.badcolumn', parameters=badcolumn_parameters,
+              library=[mask_key(sci)]),
+        stage(obj_transf_obj, ['bcgsqgemgs'+sci, 'gs'+arc, arc_surface],
+              ['tbcgsqgemgs'+sci],
+              parameters=transform_parameters),
+        stage(obj_sky_sub_obj, ['tbcgsqgemgs'+sci], ['stbcgsqgemgs'+sci]),
+        stage(obj_extract_obj, ['stbcgsqgemgs'+sci],
+              ['estbcgsqgemgs'+sci, 'database/aplast',
+               'database/apstbcgsqgemgs'+sci.replace('.fits','')+'_SCI_1_'], interactive=True,
+              questions='obj.extract'),
+        stage(obj_calib_obj, ['estbcgsqgemgs'+sci, 'sens.fits'],
+              ['cestbcgsqgemgs'+sci]),
+        stage(obj_despike_obj, ['cestbcgsqgemgs'+sci], [], interactive=True,
+              questions='obj.despike'),
+        ]
+
+def stage_dependencies(stages):
+    """ Find the stages each stage has to wait for. """
+
+    dependencies = {}
+    for i, later in enumerate(stages):
+        dependencies[later['name']] = set()
+        for earlier in stages[:i]:
+            # Files written by an earlier stage and read or written again.
+            if set(earlier['outputs']) & set(later['inputs'] + later['outputs']):
+                dependencies[later['name']].add(earlier['name'])
+            # Files read by an earlier stage and written again.
+            elif set(earlier['inputs']) & set(later['outputs']):
+                dependencies[later['name']].add(earlier['name'])
+
+    return dependencies
+
+def isolate_iraf(name):
+    """ Give an IRAF worker process its own parameter ('uparm') and
+        scratch ('tmp') directories. """
+
+    for variable in ['uparm', 'tmp']:
+        path = os.path.join(os.getcwd(), '{}_{}'.format(variable, name), '')
+        if not os.path.exists(path):
+            os.makedirs(path)
+        iraf.set(**{variable:path})
+
+# Number of processes running an IRAF task on individual frames.
+frame_processes = multiprocessing.cpu_count()
+
+def isolate_frame_worker(name):
+    """ Give a frame worker process its own IRAF directories and its own
+        connection to the catalog. """
+
+    reopen_catalog()
+    isolate_iraf('{}_{}'.format(name, multiprocessing.current_process().name.lower()))
+
+def run_frame_task(job):
+    """ Run an IRAF task of the gmos package on a single frame. 'job' is
+        the task name, the input frame, the output frame, which is removed
+        first, and the task parameters. """
+
+    task, frame, output, flags = job
+
+    # Remove pre-existing processed file.
+    if os.path.exists(output):
+        os.remove(output)
+
+    getattr(gmos, task).unlearn()
+    getattr(gmos, task)(str(frame), **flags)
+
+def run_frame_tasks(jobs, name):
+    """ Run IRAF tasks on independent frames in a pool of worker
+        processes, each with its own IRAF directories. """
+
+    if len(jobs) > 1 and frame_processes > 1:
+        # Do not share the IRAF processes of this process.
+        iraf.flprcache()
+        pool = multiprocessing.Pool(min(frame_processes, len(jobs)),
+                                    isolate_frame_worker, (name,))
+        timed('iraf', pool.map)(run_frame_task, jobs)
+        pool.close()
+        pool.join()
+    else:
+        for job in jobs:
+            run_frame_task(job)
+
+# Time spent in the IRAF tasks, in the pyplot functions and waiting for
+# the user, since the start of the run.
+task_times = {'iraf':0.0, 'plot':0.0, 'wait':0.0}
+timer_running = [False]
+
+def timed(kind, function):
+    """ Wrap 'function' to add its run time to 'task_times[kind]'. Calls
+        made while another timed function runs are not counted twice. """
+
+    @functools.wraps(function)
+    def timed_function(*args, **kwargs):
+        if timer_running[0]:
+            return function(*args, **kwargs)
+        timer_running[0] = True
+        start = time.time()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            task_times[kind] += time.time() - start
+            timer_running[0] = False
+
+    return timed_function
+
+# Time every IRAF task, every pyplot function and every question.
+iraftask.IrafTask.run = timed('iraf', iraftask.IrafTask.run)
+for name in dir(plt):
+    function = getattr(plt, name)
+    if inspect.isfunction(function) and function.__module__ == plt.__name__:
+        setattr(plt, name, timed('wait' if name == 'show' else 'plot', function))
+raw_input = timed('wait', raw_input)
+
+def process_io():
+    """ Bytes read and written by this process and its finished child
+        processes, or None where the kernel does not count them. """
+
+    try:
+        f = open('/proc/self/io', 'r')
+    except IOError:
+        return None, None
+    counters = dict(line.split(':') for line in f)
+    f.close()
 
-while True:
-    # Check if the calibration sensitivity functions is already available in
-    # the directory.
-    if os.path.exists('sens.fits'):
-        print('The file SENS.FITS is already available in the current directory. ')
-        print('')
-        # Ask if the user wants to remake the reduction of the standard star file.
-        answer = raw_input('Do you wish to REMAKE the reduction of the STANDARD STAR file? [y/n] ')
+    return int(counters['rchar']), int(counters['wchar'])
 
-        if answer == "n":
+def peak_memory():
+    """ Peak resident memory of this process in kB since it was last
+        reset, or None where the kernel does not count it. """
 
-            break
+    try:
+        f = open('/proc/self/status', 'r')
+    except IOError:
+        return None
+    peak = None
+    for line in f:
+        if line.startswith('VmHWM:'):
+            peak = int(line.split()[1])
+    f.close()
 
-        if answer == "y":
-            # Remove pre-existing sensitivity function files.
-            if os.path.exists('std'):
-                os.remove('std')
-            if os.path.exists('sens.fits'):
-                os.remove('sens.fits')
-
-            selec_std()
-
-            print "------------------------------"
-            print "# REDUCTION OF STANDARD STAR #"
-            print "------------------------------"
-            # Call standard star reduction functions.
-            std_gbias()
-            std_reduc_arc()
-            std_wavelength_arc()
-            std_transf_arc()
-            std_reduc_flat()
-            std_qecorr_flat()
-            std_gmosaic_flat()
-            std_masterflat()
-            std_reduc1_std()
-            std_gemfix_std()
-            std_qecorr_std()
-            std_reduc2_std()
-            std_badcolumn_std()
-            std_transf_std()
-            std_sky_sub_std()
-            std_extract_std()
-            std_calib_std()
+    return peak
+
+def measure_stage(stage):
+    """ Run a stage and return its trace record: wall and CPU time, peak
+        memory, characters read and written, and time spent in the IRAF
+        tasks, in the figures and waiting for the user. """
+
+    # Reset the peak memory of this process (VmHWM, not ru_maxrss), where
+    # the kernel allows it.
+    try:
+        f = open('/proc/self/clear_refs', 'w')
+        f.write('5')
+        f.close()
+    except IOError:
+        pass
+
+    times = dict(task_times)
+    io = process_io()
+    cpu = [resource.getrusage(who) for who in (resource.RUSAGE_SELF,
+                                               resource.RUSAGE_CHILDREN)]
+    start = time.time()
+
+    stage_metrics.clear()
+    try:
+        stage['run']()
+    finally:
+        close_fits()
+    # Stop the cached IRAF processes so their CPU time and I/O are counted.
+    iraf.flprcache()
+
+    wall = time.time() - start
+    usage = [resource.getrusage(who) for who in (resource.RUSAGE_SELF,
+                                                 resource.RUSAGE_CHILDREN)]
+    end_io = process_io()
+
+    # Peak memory in MB of the Python process during the stage, or since
+    # it started where it cannot be reset.
+    rss = peak_memory()
+    if rss is None:
+        rss = usage[0].ru_maxrss
+
+    record = {'stage':stage['name'], 'cached':False, 'wall':wall,
+              'cpu':sum(after.ru_utime + after.ru_stime - before.ru_utime - before.ru_stime
+                        for before, after in zip(cpu, usage)),
+              'rss':rss/1024.0, 'rss_iraf':None, 'rchar':None, 'wchar':None}
+    # The kernel only keeps the largest peak of all the finished IRAF
+    # processes, which belongs to this stage only if it grew during it.
+    if usage[1].ru_maxrss > cpu[1].ru_maxrss:
+        record['rss_iraf'] = usage[1].ru_maxrss/1024.0
+    # Characters read and written by the processes, including those
+    # served from the page cache and those that are not FITS files.
+    if io[0] is not None:
+        record['rchar'] = end_io[0] - io[0]
+        record['wchar'] = end_io[1] - io[1]
+    for kind in task_times:
+        record[kind] = task_times[kind] - times[kind]
+    if stage_metrics:
+        record['metrics'] = dict(stage_metrics)
+
+    return record
+
+trace_columns = ['stage', 'cached', 'start', 'wall', 'cpu', 'rss', 'rss_iraf',
+                 'rchar', 'wchar', 'iraf', 'plot', 'wait']
+trace = []
+
+def add_trace(record):
+    """ Add a stage record to the trace and write the trace files. """
+
+    trace.append(record)
+
+    f = open(options.trace + '.json', 'w')
+    json.dump(trace, f, indent=1, sort_keys=True)
+    f.close()
 
-            break
+    f = open(options.trace + '.csv', 'w')
+    # The quality metrics of the stages are only kept in the JSON file.
+    writer = csv.DictWriter(f, trace_columns, extrasaction='ignore')
+    writer.writerow(dict(zip(trace_columns, trace_columns)))
+    for row in trace:
+        writer.writerow(row)
+    f.close()
 
-        else:
-            print('')
-            print("Type y or n")
-            print('')
-    else:
-        # Call standard star reduction functions.
-        selec_std()
-        std_gbias()
-        std_reduc_arc()
-        std_wavelength_arc()
-        std_transf_arc()
-        std_reduc_flat()
-        std_qecorr_flat()
-        std_gmosaic_flat()
-        std_masterflat()
-        std_reduc1_std()
-        std_gemfix_std()
-        std_qecorr_std()
-        std_reduc2_std()
-        std_badcolumn_std()
-        std_transf_std()
-        std_sky_sub_std()
-        std_extract_std()
-        std_calib_std()
-
-        print "--------------------------------------"
-        print "# END OF THE STANDARD STAR REDUCTION #"
-        print "--------------------------------------"
+def print_trace():
+    """ Print a summary table of the trace, slowest stages first. """
+
+    def size(value):
+        if value is None:
+            return '-'
+        return '{:.1f}'.format(value/1024.0**2)
+
+    print('')
+    print('{:<22} {:>8} {:>8} {:>8} {:>9} {:>9} {:>8} {:>8} {:>8}'.format(
+            'STAGE', 'WALL[s]', 'CPU[s]', 'RSS[MB]', 'RCHAR[MB]', 'WCHAR[MB]',
+            'IRAF[s]', 'PLOT[s]', 'WAIT[s]'))
+    for row in sorted(trace, key=lambda row: -row['wall']):
+        if row['cached']:
+            print('{:<22} {:>8.1f} (cached)'.format(row['stage'], row['wall']))
+            continue
+        print('{:<22} {:>8.1f} {:>8.1f} {:>8.0f} {:>9} {:>9} {:>8.1f} {:>8.1f} {:>8.1f}'.format(
+                row['stage'], row['wall'], row['cpu'], max(row['rss'], row['rss_iraf'] or 0),
+                size(row['rchar']), size(row['wchar']),
+                row['iraf'], row['plot'], row['wait']))
+    print('Total wall time: {:.1f} s'.format(sum(row['wall'] for row in trace)))
+    for row in trace:
+        if 'wavelength' in row.get('metrics', {}):
+            metrics = row['metrics']['wavelength']
+            print('{:<22} wavelength RMS {:.4f} A, by row: {}'.format(
+                    row['stage'], metrics['rms'],
+                    ', '.join('{} {:.4f}'.format(r, rms) for r, rms in
+                              zip(metrics['block_rows'], metrics['block_rms']))))
+    print('')
+
+def run_stage_worker(stage, records):
+    """ Run a stage in a worker process and send its trace record. """
+
+    global headless, figure_pool
+
+    reopen_catalog()
+    isolate_iraf(stage['name'])
+    # Figures are only saved by the worker processes, in their own
+    # background processes.
+    headless = True
+    plt.switch_backend('Agg')
+    figure_pool = None
+    del figure_results[:]
+    record = measure_stage(stage)
+    finish_figures()
+    records.put(record)
+
+# Cache of the stage products. A stage is skipped when its function (with
+# its task parameters), its input files, its answers, the settings and
+# helper functions it depends on and the library calibrations it uses are
+# the same as in a previous run. Copies of the products are kept by content, so products
+# overwritten since then are restored.
+cache_path = 'stage_cache/'
+stage_cache = {'files':{}, 'stages':{}}
+
+def load_stage_cache():
+    """ Load the index of the stage cache. """
+
+    global stage_cache
+    if os.path.exists(cache_path + 'index.json'):
+        f = open(cache_path + 'index.json', 'r')
+        stage_cache = json.load(f)
+        f.close()
+
+def save_stage_cache():
+    """ Write the index of the stage cache. """
+
+    if not os.path.exists(cache_path + 'objects'):
+        os.makedirs(cache_path + 'objects')
+    f = open(cache_path + 'index.json', 'w')
+    json.dump(stage_cache, f, indent=1, sort_keys=True)
+    f.close()
+
+def file_digest(path):
+    """ SHA-1 digest of the content of a file, or None if the file does not
+        exist. Digests are reused while the size and modification time of
+        the file do not change. """
+
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    known = stage_cache['files'].get(path)
+    if known and known[0] == stat.st_size and known[1] == stat.st_mtime:
+        return known[2]
+
+    digest = hashlib.sha1()
+    f = open(path, 'rb')
+    for block in iter(lambda: f.read(1 << 20), b''):
+        digest.update(block)
+    f.close()
+    stage_cache['files'][path] = [stat.st_size, stat.st_mtime, digest.hexdigest()]
+
+    return digest.hexdigest()
+
+def stage_answers(stage):
+    """ Answers given up front to the questions of a stage. """
+
+    given = {}
+    if answers is not None and stage['questions']:
+        for key, value in answers.items():
+            if key == stage['questions'] or key.startswith(stage['questions'] + '.'):
+                given[key] = value
+
+    return given
+
+def stage_parameters(stage):
+    """ Values of the settings a stage depends on, and the source of its
+        helper functions. """
+
+    values = {}
+    for name in stage['parameters']:
+        value = globals()[name]
+        if inspect.isfunction(value):
+            value = inspect.getsource(value)
+        values[name] = value
+
+    return values
+
+def stage_key(stage):
+    """ Cache key of a stage, or None if the stage cannot be cached because
+        its questions are answered interactively. """
+
+    given = stage_answers(stage)
+    if stage['interactive'] and not batch and not given:
+        return None
+
+    key = hashlib.sha1()
+    key.update(inspect.getsource(stage['run']).encode('utf-8'))
+    for path in sorted(stage['inputs']):
+        key.update('{} {}'.format(path, file_digest(path)).encode('utf-8'))
+    key.update(json.dumps(given, sort_keys=True).encode('utf-8'))
+    key.update(json.dumps(stage_parameters(stage), sort_keys=True).encode('utf-8'))
+    # The calibrations of the library the stage would use now.
+    for library_key in stage['library']:
+        path = find_master(library_key)
+        key.update('{} {}'.format(path, file_digest(path) if path else None).encode('utf-8'))
+
+    return key.hexdigest()
+
+def cached_stage(stage, key):
+    """ Check if the products of a stage are in the cache, restoring the
+        products changed since they were made. """
+
+    cached = stage_cache['stages'].get(stage['name'])
+    if key is None or cached is None or cached['key'] != key:
+        return False
+
+    for path, digest in cached['outputs'].items():
+        if digest is not None and not os.path.exists(cache_path + 'objects/' + digest):
+            return False
+    for path, digest in cached['outputs'].items():
+        if file_digest(path) == digest:
+            continue
+        if os.path.exists(path):
+            os.remove(path)
+        if digest is not None:
+            shutil.copy2(cache_path + 'objects/' + digest, path)
+            file_digest(path)
+
+    # Keep the answers of the skipped questions in the decision log.
+    for name, value in sorted(stage_answers(stage).items()):
+        for item in (value if isinstance(value, list) else [value]):
+            record_decision(name, str(item))
+
+    return True
+
+def store_stage(stage, key, metrics=None):
+    """ Keep a copy of the products of a stage, and its quality metrics,
+        in the cache. """
+
+    if key is None:
+        return
+    outputs = {}
+    for path in stage['outputs']:
+        digest = file_digest(path)
+        if digest is not None and not os.path.exists(cache_path + 'objects/' + digest):
+            if not os.path.exists(cache_path + 'objects'):
+                os.makedirs(cache_path + 'objects')
+            shutil.copy2(path, cache_path + 'objects/' + digest)
+        outputs[path] = digest
+    stage_cache['stages'][stage['name']] = {'key':key, 'outputs':outputs}
+    if metrics:
+        stage_cache['stages'][stage['name']]['metrics'] = metrics
+    save_stage_cache()
+
+def run_stages(stages, jobs=1):
+    """ Run the reduction stages, skipping the stages whose products are in
+        the cache. With more than one job, the stages whose inputs are
+        ready run at the same time in worker processes. """
+
+    global figure_processes
+
+    if options.cache:
+        load_stage_cache()
+    started = time.time()
+
+    def start(stage):
+        if stage['banner']:
+            print(stage['banner'])
+        key = None
+        if options.cache:
+            begin = time.time()
+            key = stage_key(stage)
+            if cached_stage(stage, key):
+                print('# {} IS UP TO DATE #'.format(stage['name']))
+                record = {'stage':stage['name'], 'cached':True,
+                          'start':begin - started, 'wall':time.time() - begin}
+                if 'metrics' in stage_cache['stages'][stage['name']]:
+                    record['metrics'] = stage_cache['stages'][stage['name']]['metrics']
+                add_trace(record)
+                return None, True
+        return key, False
+
+    def run(stage, key):
+        begin = time.time()
+        record = measure_stage(stage)
+        record['start'] = begin - started
+        add_trace(record)
+        store_stage(stage, key, record.get('metrics'))
+
+    if jobs <= 1:
+        for stage in stages:
+            key, skipped = start(stage)
+            if not skipped:
+                run(stage, key)
+        finish_figures()
+        print_trace()
+        return
+
+    # The stage workers draw their figures in their own processes, which
+    # share the processors between them.
+    figure_processes = max(1, multiprocessing.cpu_count()//jobs)
+
+    dependencies = stage_dependencies(stages)
+    finished = set()
+    running = {}
+    while len(finished) < len(stages):
+        # Start the stages whose dependencies have finished.
+        ready = [stage for stage in stages if stage['name'] not in finished
+                 and stage['name'] not in running
+                 and dependencies[stage['name']] <= finished]
+        for stage in ready:
+            if stage['interactive'] or len(running) >= jobs:
+                continue
+            key, skipped = start(stage)
+            if skipped:
+                finished.add(stage['name'])
+                continue
+            print('# STARTING {} #'.format(stage['name']))
+            # Do not share the IRAF processes of this process.
+            iraf.flprcache()
+            records = multiprocessing.Queue()
+            worker = multiprocessing.Process(target=run_stage_worker,
+                                             args=(stage, records))
+            worker.start()
+            running[stage['name']] = (worker, stage, key, records, time.time())
+
+        # Interactive stages run here while the workers go on.
+        for stage in ready:
+            if stage['interactive']:
+                key, skipped = start(stage)
+                if not skipped:
+                    run(stage, key)
+                finished.add(stage['name'])
+                break
+
+        # Wait for the workers.
+        for name, (worker, stage, key, records, begin) in list(running.items()):
+            worker.join(0.2)
+            if worker.is_alive():
+                continue
+            del running[name]
+            if worker.exitcode != 0:
+                for other in running.values():
+                    other[0].terminate()
+                sys.exit('The stage {} failed.'.format(name))
+            print('# FINISHED {} #'.format(name))
+            record = records.get()
+            record['start'] = begin - started
+            add_trace(record)
+            store_stage(stage, key, record.get('metrics'))
+            finished.add(name)
+
+    finish_figures()
+    print_trace()
+
+# Call the reduction functions.
 
+# Check if the calibration sensitivity function is already available in
+# the directory, and ask if the standard star must be reduced again.
+remake_std = True
+while os.path.exists('sens.fits'):
+    print('The file SENS.FITS is already available in the current directory. ')
+    print('')
+    answer = ask('std.remake', 'Do you wish to REMAKE the reduction of the STANDARD STAR file? [y/n] ',
+                 default='y')
+
+    if answer == "n":
+        remake_std = False
         break
 
-# Call science object reduction functions.
+    if answer == "y":
+        # Remove pre-existing sensitivity function files.
+        if os.path.exists('std'):
+            os.remove('std')
+        if os.path.exists('sens.fits'):
+            os.remove('sens.fits')
+        break
 
+    else:
+        print('')
+        print("Type y or n")
+        print('')
+
+# Select the files of the standard star and of the science object.
+if remake_std:
+    selec_std()
 selec_obj()
 
-print "-------------------------------"
-print "# REDUCTION OF SCIENCE OBJECT #"
-print "-------------------------------"
-
-obj_gbias()
-obj_reduc_arc()
-obj_wavelength_arc()
-obj_transf_arc()
-obj_reduc_flat()
-obj_qecorr_flat()
-obj_gmosaic_flat()
-obj_masterflat()
-obj_reduc1_obj()
-obj_gemfix_obj()
-obj_qecorr_obj()
-obj_reduc2_obj()
-obj_badcolumn_obj()
-obj_transf_obj()
-obj_sky_sub_obj()
-obj_extract_obj()
-obj_calib_obj()
-obj_despike_obj()
+stages = []
+if remake_std:
+    stages += std_stages()
+stages += obj_stages()
+
+# Call the standard star and science object reduction functions.
+run_stages(stages, options.jobs)
 
 print '#------------------#'
 
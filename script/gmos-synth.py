@@ -0,0 +1,249 @@
+# Import Python Packages.
+import numpy as np
+from astropy.io import fits
+import os
+import json
+import argparse
+
+# Command line options.
+parser = argparse.ArgumentParser(description='Write synthetic GMOS-S '
+                                 'long-slit raw files, with the calibrations '
+                                 'needed to reduce them with gmos-spike.py.')
+parser.add_argument('output', help='Directory of the data set. The raw files '
+                    'are written to its raw/ subdirectory.')
+parser.add_argument('--binning', default='2x2',
+                    help='CCD binning, as XBINxYBIN (default: 2x2).')
+parser.add_argument('--rows', type=int, default=4176,
+                    help='Unbinned detector rows read out, centred on the '
+                    'slit (default: 4176, the full frame).')
+parser.add_argument('--centwave', type=int, default=700,
+                    help='Central wavelength in nm (default: 700).')
+parser.add_argument('--bias', type=int, default=5,
+                    help='Number of BIAS files (default: 5).')
+parser.add_argument('--flats', type=int, default=3,
+                    help='Number of FLAT files (default: 3).')
+parser.add_argument('--science', type=int, default=1,
+                    help='Number of science object files (default: 1).')
+parser.add_argument('--date', default='20240101',
+                    help='Date of the observations, as YYYYMMDD.')
+parser.add_argument('--seed', type=int, default=1,
+                    help='Seed of the random numbers. The same options and '
+                    'seed always give the same files.')
+options = parser.parse_args()
+
+# Detector geometry (unbinned): three Hamamatsu CCDs of 2048 x 4176 pixels,
+# each read out by four amplifiers of 512 columns.
+ccd_columns = 2048
+ccd_rows = 4176
+amp_columns = 512
+namps = 12
+overscan = 32
+gain = [1.83, 1.85, 1.80, 1.88, 1.79, 1.84, 1.82, 1.86, 1.81, 1.87, 1.83, 1.80]
+read_noise = 3.9
+bias_level = [1000.0 + 35.0*amp for amp in range(namps)]
+
+# Dispersion of the R400 grating in Angstrom per unbinned pixel.
+dispersion = 0.74
+# Spectral resolution (FWHM) in unbinned pixels.
+line_fwhm = 4.0
+
+# CuAr lines (Angstrom) and their relative intensities.
+cuar_lines = [(3948.98, 300), (4158.59, 800), (4200.67, 600), (4259.36, 400),
+              (4277.53, 500), (4348.06, 700), (4510.73, 300), (4545.05, 500),
+              (4579.35, 400), (4609.57, 600), (4657.90, 500), (4764.86, 700),
+              (4806.02, 600), (4847.81, 400), (5105.54, 300), (5153.23, 300),
+              (5218.20, 400), (5495.87, 500), (5606.73, 600), (5739.52, 400),
+              (5912.09, 600), (6032.13, 700), (6114.92, 900), (6172.28, 500),
+              (6416.31, 700), (6538.11, 400), (6677.28, 800), (6752.83, 600),
+              (6965.43, 2000), (7067.22, 1800), (7147.04, 1200), (7272.94, 900),
+              (7383.98, 1500), (7503.87, 2500), (7635.11, 2000), (7723.76, 1200),
+              (7948.18, 1800), (8006.16, 1400), (8115.31, 2500), (8264.52, 1800),
+              (8424.65, 1500), (8521.44, 1300), (9122.97, 2200), (9224.50, 1500),
+              (9657.78, 1800)]
+# Sky emission lines (Angstrom) of the science frames.
+sky_lines = [5577.34, 5889.95, 6300.30, 6363.78, 6863.96, 7276.41, 7340.89,
+             7913.71, 8344.60, 8827.10]
+
+xbin, ybin = [int(n) for n in options.binning.lower().split('x')]
+nrows = options.rows//ybin
+first_row = (ccd_rows - options.rows)//2
+random = np.random.RandomState(options.seed)
+
+# Bad columns of the detector (unbinned mosaic columns), and response of
+# each pixel, shared by all the files.
+bad_columns = [1500, 3301, 3302, 4870]
+response = [1.0 + 0.01*random.standard_normal((nrows, amp_columns//xbin))
+            for amp in range(namps)]
+
+def mosaic_columns(amp):
+    """ Unbinned mosaic column at the centre of each binned column of an
+        amplifier. """
+
+    return amp*amp_columns + xbin*np.arange(amp_columns//xbin) + 0.5*xbin
+
+def wavelength(x):
+    """ Wavelength (Angstrom) of unbinned mosaic column 'x'. """
+
+    return 10.0*options.centwave + (x - 1.5*ccd_columns)*dispersion
+
+def spectrum(x, lines):
+    """ Emission line spectrum with unit peak intensity. """
+
+    sigma = line_fwhm*dispersion/2.3548
+    flux = np.zeros(x.shape)
+    for line, intensity in lines:
+        flux += intensity*np.exp(-0.5*((wavelength(x) - line)/sigma)**2)
+    return flux/max(intensity for line, intensity in lines)
+
+def blaze(x):
+    """ Efficiency of the spectrograph along the dispersion axis. """
+
+    return 0.2 + np.exp(-0.5*((wavelength(x) - 10.0*options.centwave)/1500.0)**2)
+
+def trace(rows, center, sigma):
+    """ Spatial profile of a point source along the slit. """
+
+    return np.exp(-0.5*((rows - center)/sigma)**2)/(np.sqrt(2*np.pi)*sigma)
+
+def write_frame(obstype, obsclass, title, exptime, signal, cosmics=0):
+    """ Write a raw file. 'signal' gives the electrons per unbinned pixel
+        of an amplifier from its mosaic columns and rows. """
+
+    time = 3600*9 + 120*counter[0]
+    phu = fits.Header()
+    phu['INSTRUME'] = 'GMOS-S'
+    phu['TELESCOP'] = 'Gemini-South'
+    phu['OBSERVAT'] = 'Gemini-South'
+    phu['OBSTYPE'] = obstype
+    phu['OBSCLASS'] = obsclass
+    phu['OBJECT'] = title
+    phu['OBSMODE'] = 'LONGSLIT'
+    phu['GEMPRGID'] = 'GS-2024A-Q-1'
+    phu['OBSID'] = 'GS-2024A-Q-1-{}'.format(counter[0])
+    phu['DATALAB'] = 'GS-2024A-Q-1-{}-001'.format(counter[0])
+    phu['DATE-OBS'] = '{}-{}-{}'.format(options.date[:4], options.date[4:6], options.date[6:])
+    phu['TIME-OBS'] = '{:02d}:{:02d}:{:02d}'.format(time//3600, time//60 % 60, time % 60)
+    phu['UT'] = phu['TIME-OBS']
+    phu['EXPTIME'] = exptime
+    phu['AIRMASS'] = 1.1
+    phu['RA'] = 300.0
+    phu['DEC'] = -30.0
+    phu['GRATING'] = 'R400+_G5325'
+    phu['GRWLEN'] = float(options.centwave)
+    phu['CENTWAVE'] = float(options.centwave)
+    phu['FILTER1'] = 'open1-6'
+    phu['FILTER2'] = 'open2-8'
+    phu['MASKNAME'] = '1.0arcsec'
+    phu['MASKTYP'] = 1
+    phu['DETECTOR'] = 'GMOS + Hamamatsu_new'
+    phu['DETTYPE'] = 'S10892'
+    phu['NAMPS'] = 4
+    phu['NEXTEND'] = namps
+    phu['PIXSCALE'] = 0.08*ybin
+    phu['DETNROI'] = 1
+    phu['DETRO1X'] = 1
+    phu['DETRO1XS'] = 3*ccd_columns
+    phu['DETRO1Y'] = first_row + 1
+    phu['DETRO1YS'] = options.rows
+    hdulist = fits.HDUList([fits.PrimaryHDU(header=phu)])
+
+    rows = first_row + ybin*np.arange(nrows) + 0.5*ybin
+    ncols = amp_columns//xbin
+    noverscan = max(overscan//xbin, 8)
+    for amp in range(namps):
+        x = mosaic_columns(amp)
+        electrons = signal(x[np.newaxis,:], rows[:,np.newaxis])*xbin*ybin
+        electrons = np.broadcast_to(electrons, (nrows, ncols))*response[amp]
+        electrons = random.poisson(np.clip(electrons, 0, None)).astype(float)
+        for column in bad_columns:
+            if amp*amp_columns <= column < (amp + 1)*amp_columns:
+                electrons[:,int((column - amp*amp_columns)//xbin)] *= 0.05
+
+        data = np.empty((nrows, noverscan + ncols))
+        data[:,:noverscan] = 0.0
+        data[:,noverscan:] = electrons/gain[amp]
+        data += bias_level[amp] + 0.5*np.sin(np.arange(noverscan + ncols)/40.0)
+        data += read_noise/gain[amp]*random.standard_normal(data.shape)
+
+        # Cosmic rays hit the light-sensitive pixels.
+        for n in range(cosmics//namps):
+            row = random.randint(0, nrows - 2)
+            column = noverscan + random.randint(0, ncols - 2)
+            size = random.randint(1, 3)
+            data[row:row+size,column:column+size] += random.uniform(3000, 30000)
+
+        ccd = amp//4
+        ccd_column = (amp % 4)*amp_columns
+        header = fits.Header()
+        header['EXTNAME'] = 'SCI'
+        header['EXTVER'] = amp + 1
+        header['CCDNAME'] = ['BI5-36-4k-2', 'BI11-33-4k-1', 'BI12-34-4k-1'][ccd]
+        header['AMPNAME'] = 'AMP{}'.format(amp + 1)
+        header['CCDSUM'] = '{} {}'.format(xbin, ybin)
+        header['CCDSIZE'] = '[1:{},1:{}]'.format(ccd_columns, ccd_rows)
+        header['DETSEC'] = '[{}:{},{}:{}]'.format(amp*amp_columns + 1, (amp + 1)*amp_columns,
+                                                  first_row + 1, first_row + options.rows)
+        header['CCDSEC'] = '[{}:{},{}:{}]'.format(ccd_column + 1, ccd_column + amp_columns,
+                                                  first_row + 1, first_row + options.rows)
+        header['DATASEC'] = '[{}:{},1:{}]'.format(noverscan + 1, noverscan + ncols, nrows)
+        header['BIASSEC'] = '[1:{},1:{}]'.format(noverscan, nrows)
+        header['GAIN'] = gain[amp]
+        header['RDNOISE'] = read_noise
+        header['BUNIT'] = 'ADU'
+        hdulist.append(fits.ImageHDU(data=np.clip(data, 0, 65535).astype(np.uint16),
+                                     header=header))
+
+    filename = 'S{}S{:04d}.fits'.format(options.date, counter[0])
+    hdulist.writeto(os.path.join(options.output, 'raw', filename), overwrite=True)
+    files.append({'name':filename, 'ObsType':obstype, 'obsclass':obsclass,
+                  'title':title})
+    counter[0] += 1
+
+if not os.path.exists(os.path.join(options.output, 'raw')):
+    os.makedirs(os.path.join(options.output, 'raw'))
+counter = [1]
+files = []
+slit_center = first_row + options.rows/2.0
+
+for n in range(options.bias):
+    write_frame('BIAS', 'dayCal', 'Bias', 0.0,
+                lambda x, y: np.zeros(x.shape))
+
+for n in range(options.flats):
+    write_frame('FLAT', 'partnerCal', 'GCALflat', 2.0,
+                lambda x, y: 20000.0*blaze(x)*(1.0 - 0.1*((y - slit_center)/ccd_rows)**2))
+
+write_frame('ARC', 'progCal', 'CuAr', 90.0,
+            lambda x, y: 30000.0*spectrum(x, cuar_lines) + 0.0*y)
+
+# The standard star is bright, the science object is faint, on a sky
+# with emission lines and with cosmic rays.
+write_frame('OBJECT', 'partnerCal', 'LTT7379', 30.0,
+            lambda x, y: 50.0*blaze(x) + 2.0e6*blaze(x)*trace(y, slit_center, 3.0),
+            cosmics=60)
+for n in range(options.science):
+    write_frame('OBJECT', 'science', 'Synthetic target', 900.0,
+                lambda x, y: 300.0*blaze(x) + 4000.0*spectrum(x, [(l, 1.0) for l in sky_lines])
+                             + 1.0e5*blaze(x)*trace(y, slit_center + 20.0, 3.0),
+                cosmics=1200)
+
+# Answers of the batch mode of gmos-spike.py, and what the files contain.
+manifest = {'raw_path':'raw/',
+            'std':{'centwave':options.centwave},
+            'obj':{'centwave':options.centwave}}
+f = open(os.path.join(options.output, 'manifest.json'), 'w')
+json.dump(manifest, f, indent=1, sort_keys=True)
+f.close()
+
+truth = {'binning':options.binning, 'rows':options.rows,
+         'centwave':options.centwave, 'dispersion':dispersion,
+         'line_fwhm':line_fwhm, 'bad_columns':bad_columns,
+         'arc_lines':[line for line, intensity in cuar_lines
+                      if abs(line - 10.0*options.centwave) < 1.5*ccd_columns*dispersion],
+         'sky_lines':sky_lines, 'std_row':slit_center,
+         'science_row':slit_center + 20.0, 'files':files}
+f = open(os.path.join(options.output, 'truth.json'), 'w')
+json.dump(truth, f, indent=1, sort_keys=True)
+f.close()
+
+print('{} raw files written to {}'.format(len(files), os.path.join(options.output, 'raw')))